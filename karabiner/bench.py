@@ -0,0 +1,307 @@
+"""Synthetic keymap scaling benchmarks for the generator.
+
+Synthesises keymaps of increasing size out of the same Modification/Manipulation
+shapes generate.py builds by hand and times each pipeline stage.
+
+Usage:
+    python3 karabiner/bench.py            # compare against the stored baseline
+    python3 karabiner/bench.py --update   # overwrite the stored baseline
+"""
+
+from typing import Callable, Dict, List, Tuple, TypeVar
+import argparse
+import io
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from generator.event_utils import (
+    ConsumableKeyEvent,
+    ProducibleKeyEvent,
+)
+from generator.keys import MODIFIER_KEYS
+from generator.modification_utils import Modification
+from generate import Utils
+from generator.backends import write_config
+from generator.pipeline import derive_variants
+
+SIZES = [10, 100, 1000, 10000]
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "bench_baseline.json",
+)
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "karabiner.jsonc",
+)
+
+# Every synthetic binding needs a unique (modifiers, key) pair so select mode
+# variants and description lookups behave like the real config.
+_KEYS = list("abcdefghijklmnopqrstuvwxyz0123456789") + [
+    "<",
+    ">",
+    "-",
+    "_",
+    ";",
+    ",",
+    ".",
+    "/",
+]
+_MODIFIERS = [
+    MODIFIER_KEYS.right_control,
+    MODIFIER_KEYS.right_command,
+    MODIFIER_KEYS.right_option,
+    MODIFIER_KEYS.right_shift,
+    MODIFIER_KEYS.left_control,
+    MODIFIER_KEYS.left_command,
+    MODIFIER_KEYS.left_option,
+    MODIFIER_KEYS.fn,
+]
+_PREFIX_MODES = [
+    Utils.is_emacs_mode_none,
+    Utils.is_emacs_mode_general_extend,
+    Utils.is_emacs_mode_mode_specific,
+]
+
+Metrics = Dict[str, float]
+T = TypeVar("T")
+
+
+def synthesise(
+    size: int,
+) -> Tuple[List[Modification], List[str]]:
+    """Build `size` modifications and the descriptions that get a select mode variant.
+
+    Bindings are spread round robin over the prefix modes. Every binding in the
+    "none" emacs mode gets a select mode variant, mirroring the navigation
+    bindings in generate.py.
+    """
+    modifications: List[Modification] = []
+    select_mode_descriptions: List[str] = []
+    modifier_sets = itertools.chain.from_iterable(
+        itertools.combinations(_MODIFIERS, n)
+        for n in range(1, len(_MODIFIERS) + 1)
+    )
+    combos = itertools.product(modifier_sets, _KEYS)
+    for i, (modifiers, key) in enumerate(combos):
+        if i == size:
+            break
+        condition = _PREFIX_MODES[i % len(_PREFIX_MODES)]
+        description = "Synthetic %d" % i
+        to_event = ProducibleKeyEvent(
+            {
+                "key_code": "f%d" % (i % 20 + 1),
+                "modifiers": [MODIFIER_KEYS.right_command],
+            }
+        )
+        to: List = [to_event]
+        if condition is not Utils.is_emacs_mode_none:
+            to.append(Utils.clear_emacs_mode)
+        modifications.append(
+            Modification(
+                description=description,
+                manipulators=[
+                    {
+                        "type": "basic",
+                        "conditions": [condition],
+                        "from": ConsumableKeyEvent(
+                            {
+                                "key_code": key,
+                                "modifiers": {
+                                    "mandatory": list(
+                                        modifiers
+                                    )
+                                },
+                            }
+                        ),
+                        "to": to,
+                    }
+                ],
+            )
+        )
+        if condition is Utils.is_emacs_mode_none:
+            select_mode_descriptions.append(description)
+    if len(modifications) < size:
+        raise Exception(
+            "Cannot synthesise more than %d unique bindings"
+            % len(modifications)
+        )
+    return modifications, select_mode_descriptions
+
+
+def _derive_select_mode_variants(
+    modifications: List[Modification],
+    descriptions: List[str],
+) -> List[Modification]:
+    return list(
+        derive_variants(
+            descriptions, Utils.select_mode_variant
+        )(modifications)
+    )
+
+
+def _render(modifications: List[Modification]) -> str:
+    out = io.StringIO()
+    write_config(modifications, TEMPLATE_PATH, out=out)
+    return out.getvalue()
+
+
+def _timed(fn: Callable[[], T]) -> Tuple[T, float]:
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def _peak(fn: Callable[[], T]) -> Tuple[T, int]:
+    tracemalloc.start()
+    try:
+        result = fn()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(size: int, repeat: int = 3) -> Metrics:
+    """Time each stage for one size, then repeat under tracemalloc for peak memory.
+
+    Timings are the best of `repeat` runs, every run starts from a fresh
+    synthesised keymap.
+    tracemalloc slows allocation heavy code down a lot, so timings and memory
+    come from separate runs.
+    """
+    metrics: Metrics = {}
+
+    for _ in range(repeat):
+        timings: Metrics = {}
+        (modifications, descriptions), timings[
+            "synthesise_s"
+        ] = _timed(lambda: synthesise(size))
+        modifications, timings["select_mode_s"] = _timed(
+            lambda: _derive_select_mode_variants(
+                modifications, descriptions
+            )
+        )
+        output, timings["render_s"] = _timed(
+            lambda: _render(modifications)
+        )
+        for name, value in timings.items():
+            metrics[name] = min(
+                metrics.get(name, value), value
+            )
+    metrics["output_bytes"] = len(output.encode())
+
+    def pipeline() -> str:
+        modifications, descriptions = synthesise(size)
+        return _render(
+            _derive_select_mode_variants(
+                modifications, descriptions
+            )
+        )
+
+    _, metrics["peak_bytes"] = _peak(pipeline)
+    return metrics
+
+
+def compare(
+    results: Dict[str, Metrics],
+    baseline: Dict[str, Metrics],
+    tolerance: float,
+) -> List[str]:
+    """Return a line per metric that grew more than `tolerance` over the baseline."""
+    regressions: List[str] = []
+    for size, metrics in results.items():
+        for name, value in metrics.items():
+            expected = baseline.get(size, {}).get(name)
+            if expected is None:
+                continue
+            # Timings under 10ms are dominated by noise.
+            if name.endswith("_s") and value < 0.01:
+                continue
+            if value > expected * (1 + tolerance):
+                regressions.append(
+                    "%6s %-14s %12.4g > %12.4g (+%d%%)"
+                    % (
+                        size,
+                        name,
+                        value,
+                        expected,
+                        (value / expected - 1) * 100,
+                    )
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0]
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=SIZES,
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="timings are the best of this many runs",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.5,
+        help="allowed relative growth over the baseline",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    args = parser.parse_args()
+
+    results: Dict[str, Metrics] = {}
+    for size in args.sizes:
+        results[str(size)] = metrics = run(
+            size, args.repeat
+        )
+        print(
+            "%6d  synthesise %8.4fs  select_mode %8.4fs"
+            "  render %8.4fs  peak %6.1f MiB  output %6.1f KiB"
+            % (
+                size,
+                metrics["synthesise_s"],
+                metrics["select_mode_s"],
+                metrics["render_s"],
+                metrics["peak_bytes"] / 2**20,
+                metrics["output_bytes"] / 2**10,
+            )
+        )
+
+    if args.update:
+        baseline: Dict[str, Metrics] = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as file:
+            json.dump(baseline, file, indent=4)
+            file.write("\n")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("No baseline stored, run with --update")
+        return 0
+    with open(BASELINE_PATH) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
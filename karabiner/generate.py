@@ -1,21 +1,50 @@
-from typing import List, Optional
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 from copy import deepcopy
 from generator.modification_utils import (
     SetVariable,
     Condition,
+    Manipulation,
     Modification,
     ToDelayedAction,
 )
+from generator.event_utils import (
+    ConsumableKeyEvent,
+    ProducibleKeyEvent,
+)
+from generator.keys import KeyCode, Modifier
 from generator.events import (
+    EmacsKeymap,
+    OsLevelKeymap,
+    StdIdeKeymap,
     STDEmacsKeyEvents,
     STDMacOSKeyEvents,
     STDIdeKeyEvents,
     MODIFIER_KEYS,
 )
-import json
-
-
-modifications: List[Modification] = []
+from generator.backends import write_config
+from generator.modifiers import EITHER_SIDE
+from generator.pipeline import (
+    Pipeline,
+    Stage,
+    derive_variants,
+)
+from generator import paths
+import argparse
+import importlib
+import io
+import os
+import sys
+import time
 
 
 class Utils:
@@ -137,23 +166,15 @@ class Utils:
     )
 
     @staticmethod
-    def create_select_mode_variant(
-        description: str,
-    ) -> Modification:
-        # Find the original modification
-        original_modification: Optional[Modification] = None
-        for modification in modifications:
-            if modification["description"] == description:
-                if original_modification is not None:
-                    raise Exception(
-                        "Duplicate modification: "
-                        + description
-                    )
-                original_modification = modification
-        if original_modification is None:
-            raise Exception(
-                "Modification not found: " + description
-            )
+    def select_mode_variant(
+        original_modification: Modification,
+    ) -> Tuple[Modification, Modification]:
+        """Split a modification into its select mode off and select mode on variants.
+
+        The select mode on variant holds shift on its produced event.
+        The original is copied, not changed.
+        """
+        description = original_modification["description"]
 
         # Create the variant modification
         variant_modification = deepcopy(
@@ -193,33 +214,113 @@ class Utils:
         )
         variant_to_events[0]["modifiers"] = variant_to_event_modifiers  # type: ignore
 
-        # Add the "not select mode" condition to the original modification
+        # Add the "not select mode" condition to a copy of the original modification
         assert (
             len(original_modification["manipulators"]) == 1
         )
-        assert (
-            "conditions"
-            in original_modification["manipulators"][0]
-        )
-        original_conditions = original_modification[
+        original_manipulation = original_modification[
             "manipulators"
-        ][0]["conditions"]
+        ][0]
+        assert "conditions" in original_manipulation
+        original_conditions = original_manipulation[
+            "conditions"
+        ]
         # Expecting the one emacs_mode None condition
         assert original_conditions is not None
         assert (
             len(original_conditions) == 1
         ), original_conditions
 
-        original_conditions.append(Utils.is_select_mode_off)
+        off_modification = Modification(
+            description=description,
+            manipulators=[
+                Manipulation(
+                    **{
+                        **original_manipulation,
+                        "conditions": original_conditions
+                        + [Utils.is_select_mode_off],
+                    }
+                )
+            ],
+        )
+        return off_modification, variant_modification
 
-        return variant_modification
+    @staticmethod
+    def create_tap_hold(
+        from_event: ConsumableKeyEvent,
+        tap: List[ProducibleKeyEvent],
+        hold: Modifier,
+        conditions: Optional[List[Condition]] = None,
+        threshold_ms: Optional[int] = None,
+    ) -> Manipulation:
+        """Dual role key, e.g. escape on tap and control on hold.
 
-    INDENT = "                    "
+        The hold modifier is lazy, so it is only sent together with another key.
+        It is sent as a key, so an either side modifier like control is sent as
+        its left side.
+        The tap is sent on release if no other key was pressed in between and the
+        key was released within the threshold (the template's timeout if None).
+        Check a threshold against recorded typing with `generate.py tap-hold`.
+        """
+        if hold in EITHER_SIDE:
+            hold = "left_" + hold
+        manipulation = Manipulation(
+            {
+                "type": "basic",
+                "from": from_event,
+                "to": [
+                    ProducibleKeyEvent(
+                        {"key_code": hold, "lazy": True}
+                    )
+                ],
+                "to_if_alone": tap,
+            }
+        )
+        if conditions is not None:
+            manipulation["conditions"] = conditions
+        if threshold_ms is not None:
+            manipulation["parameters"] = {
+                "basic.to_if_alone_timeout_milliseconds": threshold_ms,
+            }
+        return manipulation
+
+    @staticmethod
+    def create_chord(
+        keys: List[KeyCode],
+        to: List[Union[ProducibleKeyEvent, SetVariable]],
+        conditions: Optional[List[Condition]] = None,
+        threshold_ms: Optional[int] = None,
+    ) -> Manipulation:
+        """Keys pressed together, e.g. j+k in place of a two step emacs prefix sequence.
+
+        The keys must all go down within the threshold (the template's if None).
+        Check how often plain typing would trigger a chord with `generate.py chords`.
+        """
+        manipulation = Manipulation(
+            {
+                "type": "basic",
+                "from": ConsumableKeyEvent(
+                    {
+                        "simultaneous": [
+                            {"key_code": key} for key in keys
+                        ]
+                    }
+                ),
+                "to": to,
+            }
+        )
+        if conditions is not None:
+            manipulation["conditions"] = conditions
+        if threshold_ms is not None:
+            manipulation["parameters"] = {
+                "basic.simultaneous_threshold_milliseconds": threshold_ms,
+            }
+        return manipulation
 
 
 # Define the standard modifications
-modifications += [
-    Modification(
+def standard_modifications() -> Iterator[Modification]:
+    yield Modification(
         description="Up",
         manipulators=[
             {
@@ -229,8 +330,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.up],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Down",
         manipulators=[
             {
@@ -240,8 +341,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.down],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Left",
         manipulators=[
             {
@@ -251,8 +352,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.left],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Right",
         manipulators=[
             {
@@ -262,8 +363,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.right],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Forward Word",
         manipulators=[
             {
@@ -273,8 +374,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.word_forward],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Backward Word",
         manipulators=[
             {
@@ -284,8 +385,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.word_backward],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Line Start",
         manipulators=[
             {
@@ -295,8 +396,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.line_start],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Line End",
         manipulators=[
             {
@@ -306,8 +407,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.line_end],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Page Down",
         manipulators=[
             {
@@ -317,8 +418,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.page_down],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Page Up",
         manipulators=[
             {
@@ -328,8 +429,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.page_up],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="File Start",
         manipulators=[
             {
@@ -339,8 +440,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.file_start],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="File End",
         manipulators=[
             {
@@ -350,8 +451,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.file_end],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Wipe",
         manipulators=[
             {
@@ -366,8 +467,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Yank",
         manipulators=[
             {
@@ -376,9 +477,9 @@ modifications += [
                 "to": [STDMacOSKeyEvents.paste],
             },
         ],
-    ),
+    )
     # NOTE: kill is already standard in all apps on MacOS as "Command + k"
-    Modification(
+    yield Modification(
         description="Undo",
         manipulators=[
             {
@@ -387,8 +488,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.undo],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Redo",
         manipulators=[
             {
@@ -397,10 +498,10 @@ modifications += [
                 "to": [STDMacOSKeyEvents.redo],
             },
         ],
-    ),
+    )
     # NOTE: Using normal backspace instead of Control + h as used to that.
     #       Might be worth changing in the future?
-    Modification(
+    yield Modification(
         description="Delete Word Backward",
         manipulators=[
             {
@@ -412,8 +513,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Delete",
         manipulators=[
             {
@@ -423,8 +524,8 @@ modifications += [
                 "to": [STDMacOSKeyEvents.delete],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Delete Word Forward",
         manipulators=[
             {
@@ -436,8 +537,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Cancel",
         manipulators=[
             {
@@ -450,8 +551,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Search",
         manipulators=[
             {
@@ -464,8 +565,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Action search",
         manipulators=[
             {
@@ -479,8 +580,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Find references",
         manipulators=[
             {
@@ -492,8 +593,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Go back",
         manipulators=[
             {
@@ -505,8 +606,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Toggle comment",
         manipulators=[
             {
@@ -518,8 +619,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: General Extend: Select all",
         manipulators=[
             {
@@ -534,8 +635,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: General Extend: Save",
         manipulators=[
             {
@@ -550,8 +651,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: General Extend: Focus Next Window",
         manipulators=[
             {
@@ -566,8 +667,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs MOde: General Extend: Find File",
         manipulators=[
             {
@@ -582,8 +683,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: General Extend: Select Next Match",
         manipulators=[
             {
@@ -598,8 +699,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: Mode Specific: Rerun",
         manipulators=[
             {
@@ -614,8 +715,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: Mode Specific: Format",
         manipulators=[
             {
@@ -630,8 +731,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: Mode Specific: Find in Files",
         manipulators=[
             {
@@ -646,8 +747,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: Mode Specific: Peek Type Definition",
         manipulators=[
             {
@@ -662,29 +763,43 @@ modifications += [
                 ],
             },
         ],
-    ),
-]
+    )
+
 
 # Define the select mode modifications
-modifications += [
-    Utils.create_select_mode_variant("Up"),
-    Utils.create_select_mode_variant("Down"),
-    Utils.create_select_mode_variant("Left"),
-    Utils.create_select_mode_variant("Right"),
-    Utils.create_select_mode_variant("Forward Word"),
-    Utils.create_select_mode_variant("Backward Word"),
-    Utils.create_select_mode_variant("Line Start"),
-    Utils.create_select_mode_variant("Line End"),
-    Utils.create_select_mode_variant("Page Down"),
-    Utils.create_select_mode_variant("Page Up"),
-    Utils.create_select_mode_variant("File Start"),
-    Utils.create_select_mode_variant("File End"),
+SELECT_MODE_DESCRIPTIONS = [
+    "Up",
+    "Down",
+    "Left",
+    "Right",
+    "Forward Word",
+    "Backward Word",
+    "Line Start",
+    "Line End",
+    "Page Down",
+    "Page Up",
+    "File Start",
+    "File End",
 ]
 
+# Derives the select mode variants, after every standard modification
+STANDARD_PASSES = Pipeline(
+    [
+        Stage(
+            "select-mode",
+            derive_variants(
+                SELECT_MODE_DESCRIPTIONS,
+                Utils.select_mode_variant,
+            ),
+        ),
+    ]
+)
+
+
 # Define the mode switching.
 # NOTE: These have to be at the end of the list to allow mode specific commands to trigger before reaching these. For example C-c C-c.
-modifications += [
-    Modification(
+def mode_switching_modifications() -> Iterator[Modification]:
+    yield Modification(
         description="Emacs Mode: Mode Specific",
         manipulators=[
             {
@@ -697,8 +812,8 @@ modifications += [
                 **Utils.clear_emacs_mode_after_timeout,
             },
         ],  # type: ignore
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: General Extend",
         manipulators=[
             {
@@ -711,8 +826,8 @@ modifications += [
                 **Utils.clear_emacs_mode_after_timeout,
             },
         ],  # type: ignore
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Select Mode: On",
         manipulators=[
             {
@@ -726,8 +841,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Select Mode: Off",
         manipulators=[
             {
@@ -743,7 +858,7 @@ modifications += [
                 ],
             },
         ],
-    ),
+    )
     # TODO: Look over the rest of the approach above - some stuff not needed anymore.
     # These must be the last modifications in the list. This ensures that we are indeed in the state where:
     # - We are in an emacs mode
@@ -752,7 +867,7 @@ modifications += [
     # Then we know that we can clear the mode - aka. key combo not found.
     # NOTE: There is also the special case of switching directly between modes.
     #       Should be fine, but might interfere with certain key combos? For now testing.
-    Modification(
+    yield Modification(
         description="Emacs Mode: Special case of switching from general_extend -> mode_specific",
         manipulators=[
             {
@@ -767,8 +882,8 @@ modifications += [
                 **Utils.clear_emacs_mode_after_timeout,
             },  # type: ignore
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: Special case of switching from mode_specific -> general_extend",
         manipulators=[
             {
@@ -783,8 +898,8 @@ modifications += [
                 **Utils.clear_emacs_mode_after_timeout,
             },  # type: ignore
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: Clear on any non valid emacs mode key (emacs_mode_general_extend)",
         manipulators=[
             {
@@ -805,8 +920,8 @@ modifications += [
                 ],
             },
         ],
-    ),
-    Modification(
+    )
+    yield Modification(
         description="Emacs Mode: Clear on any non valid emacs mode key (emacs_mode_specific)",
         manipulators=[
             {
@@ -827,28 +942,682 @@ modifications += [
                 ],
             },
         ],
-    ),
-]
+    )
+
+
+def emacs_modifications(
+    standard_passes: Optional[Pipeline] = None,
+) -> Iterator[Modification]:
+    """The standard modifications, through the passes deriving their variants, then the mode switching."""
+    if standard_passes is None:
+        standard_passes = STANDARD_PASSES
+    yield from standard_passes(standard_modifications())
+    yield from mode_switching_modifications()
+
+
+def _command(
+    module: str,
+) -> Callable[[argparse.Namespace], int]:
+    """The run_command of a generator module, imported only when it runs."""
+
+    def run(args: argparse.Namespace) -> int:
+        return importlib.import_module(
+            "generator." + module
+        ).run_command(args)
+
+    return run
+
+
+def _skipped(args: argparse.Namespace) -> Set[str]:
+    skip = set(args.skip)
+    if args.no_optimise:
+        skip.add("optimise")
+    return skip
+
+
+Keymaps = Tuple[EmacsKeymap, OsLevelKeymap, StdIdeKeymap]
+
 
-with open("karabiner/karabiner.jsonc") as file:
-    while line := file.readline():
-        if line.strip().startswith("// ::commands"):
-            for i, modification in enumerate(modifications):
-                modification = json.dumps(
-                    modification, indent=4
+class Build(NamedTuple):
+    skip: Set[str]
+    keymaps: Optional[Keymaps]
+    source: Iterable[Modification]
+    # Everything before the emitted form, what variants and snapshots start from
+    passes: Pipeline
+    # The schema check comes last, after everything that rewrites
+    emitting: Pipeline
+
+
+def _build(args: argparse.Namespace) -> Build:
+    from generator.pipeline import (
+        merge_layers,
+        optimise_stage,
+        validate,
+    )
+    from generator.schema import check_schema
+
+    skip = _skipped(args)
+    keymaps: Optional[Keymaps] = None
+    source: Iterable[Modification] = emacs_modifications(
+        STANDARD_PASSES.without(skip)
+    )
+    if args.source:
+        from generator.keymap_file import load_keymap
+
+        keymap_source = load_keymap(args.source)
+        keymaps = (
+            keymap_source.emacs,
+            keymap_source.macos,
+            keymap_source.ide,
+        )
+        source = keymap_source.modifications
+    stages = [Stage("validate", validate)]
+    if args.merge:
+        from generator.importer import import_rules
+        from generator.merge import (
+            Layer,
+            format_conflicts,
+            parse_layer_spec,
+        )
+
+        layers = []
+        for spec in args.merge:
+            path, priority = parse_layer_spec(spec)
+            layers.append(
+                Layer(
+                    path,
+                    priority,
+                    import_rules(path).modifications,
                 )
-                modification = (
-                    Utils.INDENT
-                    + modification.replace(
-                        "\n", "\n" + Utils.INDENT
+            )
+        stages.append(
+            Stage(
+                "merge",
+                merge_layers(
+                    "emacs",
+                    args.emacs_priority,
+                    layers,
+                    lambda result: print(
+                        format_conflicts(result),
+                        file=sys.stderr,
+                    ),
+                ),
+                buffers=True,
+            )
+        )
+    return Build(
+        skip,
+        keymaps,
+        source,
+        Pipeline(stages).without(skip),
+        Pipeline(
+            [
+                Stage("optimise", optimise_stage),
+                Stage("schema", check_schema),
+            ]
+        ).without(skip),
+    )
+
+
+def _emitted(
+    args: argparse.Namespace, build: Build
+) -> Iterable[Modification]:
+    if not args.report_events:
+        return build.emitting(build.passes(build.source))
+    from generator.optimise import (
+        event_report,
+        format_event_report,
+    )
+
+    merged = list(build.passes(build.source))
+    emitted = list(build.emitting(merged))
+    print(
+        format_event_report(event_report(merged, emitted)),
+        file=sys.stderr,
+    )
+    return emitted
+
+
+def _export_keymap(args: argparse.Namespace) -> int:
+    from generator.keymap_file import export_keymap
+
+    with open(args.out, "w") as file:
+        file.write(
+            export_keymap(
+                STDEmacsKeyEvents,
+                STDMacOSKeyEvents,
+                STDIdeKeyEvents,
+                list(
+                    emacs_modifications(
+                        STANDARD_PASSES.without(
+                            _skipped(args)
+                        )
                     )
+                ),
+            )
+        )
+    return 0
+
+
+def _passes(args: argparse.Namespace) -> int:
+    from generator.pipeline import format_timings
+
+    build = _build(args)
+    if not args.source:
+        print(
+            format_timings(
+                STANDARD_PASSES.without(build.skip).time(
+                    standard_modifications()
                 )
+            )
+        )
+    print(
+        format_timings(
+            Pipeline(
+                build.passes.stages + build.emitting.stages
+            ).time(build.source)
+        )
+    )
+    return 0
+
+
+def _variants(args: argparse.Namespace) -> int:
+    from generator.ir import KeymapIR
+    from generator.variants import (
+        DEVICES,
+        PROFILES,
+        build_matrix,
+        format_matrix,
+    )
+
+    build = _build(args)
+    # Every variant is optimised on its own
+    built = build_matrix(
+        KeymapIR.build(
+            list(build.passes(build.source)), build.keymaps
+        ),
+        [PROFILES[p] for p in args.profiles.split(",")],
+        [DEVICES[d] for d in args.devices.split(",")],
+        args.out,
+        jobs=args.jobs,
+        no_optimise="optimise" in build.skip,
+    )
+    print(format_matrix(built))
+    return 0
+
+
+def _snapshot(args: argparse.Namespace) -> int:
+    from generator.ir import KeymapIR
+    from generator.snapshot import (
+        check,
+        format_mismatches,
+        render_all,
+        update,
+    )
+
+    build = _build(args)
+    start = time.perf_counter()
+    # Every output is optimised on its own
+    outputs = render_all(
+        KeymapIR.build(
+            list(build.passes(build.source)), build.keymaps
+        ),
+        no_optimise="optimise" in build.skip,
+        workers=args.jobs,
+    )
+    if args.update:
+        for name in update(outputs, args.golden):
+            print("updated " + name)
+        return 0
+    mismatches = check(outputs, args.golden)
+    print(
+        format_mismatches(
+            mismatches,
+            len(outputs),
+            time.perf_counter() - start,
+        )
+    )
+    return 1 if mismatches else 0
+
+
+def _compile_all(args: argparse.Namespace) -> int:
+    from generator.backends import compile_all
+    from generator.ir import KeymapIR
+
+    build = _build(args)
+    compile_all(
+        KeymapIR.build(
+            list(_emitted(args, build)), build.keymaps
+        ),
+        {
+            "karabiner": args.karabiner,
+            "vscode": args.vscode,
+            "intellij": args.intellij,
+        },
+    )
+    return 0
+
+
+def _write_config(args: argparse.Namespace) -> int:
+    emitted = _emitted(args, _build(args))
+    # Rendered in full first, a pass failing halfway must not leave half a
+    # config behind
+    rendered = io.StringIO()
+    write_config(emitted, paths.TEMPLATE, out=rendered)
+    if args.output is None:
+        sys.stdout.write(rendered.getvalue())
+        return 0
+    # Replaced in one step, through a symlink to its target
+    output = os.path.realpath(args.output)
+    with open(output + ".tmp", "w") as file:
+        file.write(rendered.getvalue())
+    os.replace(output + ".tmp", output)
+    return 0
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description="Generate the karabiner config. Without a command the config is printed to stdout."
+    )
+    parser.add_argument(
+        "--no-optimise",
+        action="store_true",
+        help="emit the to lists exactly as written",
+    )
+    parser.add_argument(
+        "--report-events",
+        action="store_true",
+        help="print the synthetic events emitted per binding to stderr",
+    )
+    parser.add_argument(
+        "--merge",
+        action="append",
+        default=[],
+        metavar="PATH[=PRIORITY]",
+        help="merge a rule-set file, the higher priority wins conflicts (default 0)",
+    )
+    parser.add_argument(
+        "--emacs-priority",
+        type=int,
+        default=100,
+        help="priority of the generated emacs layer when merging",
+    )
+    parser.add_argument(
+        "--source",
+        metavar="TOML",
+        help="read the keymaps and modifications from a keymap file instead of events.py and generate.py",
+    )
+    parser.add_argument(
+        "--output",
+        help="write the config to this file instead of stdout",
+    )
+    parser.add_argument(
+        "--skip",
+        action="append",
+        default=[],
+        choices=[
+            "select-mode",
+            "validate",
+            "merge",
+            "optimise",
+            "schema",
+        ],
+        metavar="PASS",
+        help="leave out a pass: select-mode, validate, merge, optimise or schema",
+    )
+    parser.set_defaults(func=_write_config)
+    commands = parser.add_subparsers(dest="command")
+
+    report = commands.add_parser(
+        "report",
+        help="print per-keystroke cost metrics of a generated config",
+    )
+    report.set_defaults(func=_command("report"))
+    report.add_argument(
+        "path", nargs="?", default=paths.CONFIG
+    )
+    report.add_argument(
+        "--json", action="store_true", help="output JSON"
+    )
+
+    diff = commands.add_parser(
+        "diff",
+        help="semantic diff between two generated configs",
+    )
+    diff.set_defaults(func=_command("diff"))
+    diff.add_argument(
+        "old", nargs="?", default=paths.BACKUP
+    )
+    diff.add_argument(
+        "new", nargs="?", default=paths.CONFIG
+    )
+    diff.add_argument(
+        "--json", action="store_true", help="output JSON"
+    )
+
+    equiv = commands.add_parser(
+        "equiv",
+        help="check that two generated configs behave the same",
+    )
+    equiv.set_defaults(func=_command("equivalence"))
+    equiv.add_argument(
+        "old", nargs="?", default=paths.BACKUP
+    )
+    equiv.add_argument(
+        "new", nargs="?", default=paths.CONFIG
+    )
+    equiv.add_argument("--walks", type=int, default=1000)
+    equiv.add_argument("--length", type=int, default=8)
+    equiv.add_argument("--seed", type=int, default=0)
+    equiv.add_argument("--jobs", type=int, default=None)
+
+    check_modes = commands.add_parser(
+        "check-modes",
+        help="model check the emacs_mode/select_mode state machine",
+    )
+    check_modes.set_defaults(func=_command("modelcheck"))
+    check_modes.add_argument(
+        "path", nargs="?", default=paths.CONFIG
+    )
+    check_modes.add_argument(
+        "--home",
+        default="emacs_mode=none,select_mode=off",
+        help="state every mode must be able to return to",
+    )
+
+    profile = commands.add_parser(
+        "profile",
+        help="fold keystroke traces into a frequency profile",
+    )
+    profile.set_defaults(func=_command("trace"))
+    profile.add_argument("traces", nargs="+")
+    profile.add_argument(
+        "--format",
+        choices=["auto", "eventviewer", "simple", "binary"],
+        default="auto",
+    )
+    profile.add_argument(
+        "--config",
+        default=paths.CONFIG,
+        help="generated config used to replay emacs modes and keymap fields",
+    )
+    profile.add_argument(
+        "--out",
+        default=paths.PROFILE,
+        help="profile file, counts are added to it if it exists",
+    )
+    profile.add_argument(
+        "--initial",
+        default="emacs_mode=none,select_mode=off",
+        help="variable state the traces start in",
+    )
+    profile.add_argument("--top", type=int, default=20)
+
+    heatmap = commands.add_parser(
+        "heatmap",
+        help="count how often each rule fires and is checked over traces",
+    )
+    heatmap.set_defaults(func=_command("coverage"))
+    heatmap.add_argument("traces", nargs="+")
+    heatmap.add_argument(
+        "--format",
+        choices=["auto", "eventviewer", "simple", "binary"],
+        default="auto",
+    )
+    heatmap.add_argument(
+        "--config", default=paths.CONFIG
+    )
+    heatmap.add_argument(
+        "--initial",
+        default="emacs_mode=none,select_mode=off",
+        help="variable state the traces start in",
+    )
+    heatmap.add_argument(
+        "--json", action="store_true", help="output JSON"
+    )
+
+    replay_bench = commands.add_parser(
+        "replay-bench",
+        help="compare the NumPy batch replay with the scalar engine",
+    )
+    replay_bench.set_defaults(func=_command("batch"))
+    replay_bench.add_argument(
+        "traces",
+        nargs="*",
+        help="traces to replay, random key presses if none",
+    )
+    replay_bench.add_argument(
+        "--format",
+        choices=["auto", "eventviewer", "simple", "binary"],
+        default="auto",
+    )
+    replay_bench.add_argument(
+        "--config", default=paths.CONFIG
+    )
+    replay_bench.add_argument(
+        "--presses",
+        type=int,
+        default=200000,
+        help="number of random key presses",
+    )
+    replay_bench.add_argument("--seed", type=int, default=0)
+    replay_bench.add_argument(
+        "--initial",
+        default="emacs_mode=none,select_mode=off",
+        help="variable state the replay starts in",
+    )
+
+    explain = commands.add_parser(
+        "explain",
+        help="show which rule handles a key sequence, and what it shadows",
+    )
+    explain.set_defaults(func=_command("explain"))
+    explain.add_argument(
+        "keys",
+        nargs="+",
+        help='key presses like right_control+x, or "wait" for the delayed action timeout',
+    )
+    explain.add_argument(
+        "--state",
+        default="emacs_mode=none,select_mode=off",
+        help="variable state the sequence starts in",
+    )
+    explain.add_argument("--config", default=paths.CONFIG)
+
+    tap_hold = commands.add_parser(
+        "tap-hold",
+        help="replay traces through the tap/hold timing and count misfires per threshold",
+    )
+    tap_hold.set_defaults(func=_command("taphold"))
+    tap_hold.add_argument("traces", nargs="+")
+    tap_hold.add_argument(
+        "--format",
+        choices=["auto", "eventviewer", "simple", "binary"],
+        default="auto",
+    )
+    tap_hold.add_argument(
+        "--config",
+        default=paths.CONFIG,
+        help="config whose tap/hold manipulators are replayed",
+    )
+    tap_hold.add_argument(
+        "--key",
+        action="append",
+        default=[],
+        help="also try a key that is not tap/hold yet, as a lazy modifier plus to_if_alone",
+    )
+    tap_hold.add_argument(
+        "--thresholds",
+        default="100,150,200,250,300,400,500",
+        help="comma separated milliseconds",
+    )
+
+    chord_collisions = commands.add_parser(
+        "chords",
+        help="count how often typing in traces would falsely trigger simultaneous chords",
+    )
+    chord_collisions.set_defaults(func=_command("chords"))
+    chord_collisions.add_argument("traces", nargs="+")
+    chord_collisions.add_argument(
+        "--format",
+        choices=["auto", "eventviewer", "simple", "binary"],
+        default="auto",
+    )
+    chord_collisions.add_argument(
+        "--config",
+        default=paths.CONFIG,
+        help="config whose simultaneous chords are replayed",
+    )
+    chord_collisions.add_argument(
+        "--chord",
+        action="append",
+        default=[],
+        help="also try a proposed chord, like j,k",
+    )
+    chord_collisions.add_argument(
+        "--threshold",
+        type=int,
+        help="threshold of the proposed chords, the config's by default",
+    )
+
+    mode_profiles = commands.add_parser(
+        "mode-profiles",
+        help="experimental: compile the emacs modes into one profile each",
+    )
+    mode_profiles.set_defaults(
+        func=_command("modeprofiles")
+    )
+    mode_profiles.add_argument(
+        "path", nargs="?", default=paths.CONFIG
+    )
+    mode_profiles.add_argument(
+        "--home",
+        default="emacs_mode=none,select_mode=off",
+        help="state the candidate counts are measured in",
+    )
+    mode_profiles.add_argument(
+        "--variable",
+        default="emacs_mode",
+        help="mode variable whose values become profiles",
+    )
+    mode_profiles.add_argument(
+        "--out",
+        help="write the compiled config here, otherwise only compare",
+    )
+
+    convert_trace = commands.add_parser(
+        "convert-trace",
+        help="convert a keystroke trace to the binary trace format",
+    )
+    convert_trace.set_defaults(func=_command("binarytrace"))
+    convert_trace.add_argument("trace")
+    convert_trace.add_argument(
+        "--format",
+        choices=["auto", "eventviewer", "simple"],
+        default="auto",
+    )
+    convert_trace.add_argument(
+        "--out", help="defaults to the trace path with .kct"
+    )
+
+    check_config = commands.add_parser(
+        "check-config",
+        help="check a config against the schema of what the generator emits",
+    )
+    check_config.set_defaults(func=_command("schema"))
+    check_config.add_argument(
+        "path", nargs="?", default=paths.CONFIG
+    )
+
+    import_rules = commands.add_parser(
+        "import",
+        help="lift a karabiner.json or rule-set file into generator source",
+    )
+    import_rules.set_defaults(func=_command("importer"))
+    import_rules.add_argument("path")
+    import_rules.add_argument(
+        "--format",
+        choices=["python", "rules"],
+        default="python",
+        help="python source, or a complex modification rule-set file",
+    )
+    import_rules.add_argument(
+        "--profile",
+        type=int,
+        default=0,
+        help="index of the karabiner.json profile to import",
+    )
+    import_rules.add_argument(
+        "--title", help="title of the emitted rule-set"
+    )
+
+    commands.add_parser(
+        "passes",
+        help="time every pass of the pipeline on its own",
+    ).set_defaults(func=_passes)
+
+    variants = commands.add_parser(
+        "variants",
+        help="build every profile x device variant in parallel",
+    )
+    variants.set_defaults(func=_variants)
+    variants.add_argument(
+        "--profiles",
+        default="full,pairing,gaming",
+        help="comma separated, from generator/variants.py",
+    )
+    variants.add_argument(
+        "--devices",
+        default="any,moonlander,macbook",
+        help="comma separated, from generator/variants.py",
+    )
+    variants.add_argument(
+        "--out", default=paths.VARIANTS
+    )
+    variants.add_argument("--jobs", type=int, default=None)
+
+    snapshot = commands.add_parser(
+        "snapshot",
+        help="compare every generated output to its golden snapshot",
+    )
+    snapshot.set_defaults(func=_snapshot)
+    snapshot.add_argument(
+        "--update",
+        action="store_true",
+        help="write the outputs as the new golden snapshots",
+    )
+    snapshot.add_argument(
+        "--golden", default=paths.GOLDEN
+    )
+    snapshot.add_argument("--jobs", type=int, default=None)
+
+    export_keymap = commands.add_parser(
+        "export-keymap",
+        help="write the keymaps and modifications as a keymap file",
+    )
+    export_keymap.set_defaults(func=_export_keymap)
+    export_keymap.add_argument(
+        "--out", default=paths.KEYMAP
+    )
+
+    compile_all = commands.add_parser(
+        "all",
+        help="build the Karabiner, VSCode and IntelliJ keybindings from one IR",
+    )
+    compile_all.set_defaults(func=_compile_all)
+    compile_all.add_argument(
+        "--karabiner", default=paths.CONFIG
+    )
+    compile_all.add_argument(
+        "--vscode", default=paths.VSCODE
+    )
+    compile_all.add_argument(
+        "--intellij", default=paths.INTELLIJ
+    )
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
 
-                if i == len(modifications) - 1:
-                    print(modification, end="\n")
-                else:
-                    print(modification, end=",\n")
-            continue
-        if line.strip().startswith("//"):
-            continue
-        print(line, end="")
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,263 @@
+"""Output targets compiled from the shared keymap IR.
+
+* Karabiner: the modifications spliced into karabiner.jsonc
+* VSCode: keybindings.json for the IDE actions VSCode has no default for
+* IntelliJ: a keymap XML binding every IDE action to what Karabiner produces
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    TextIO,
+)
+import io
+import json
+import sys
+
+from . import paths
+from .ir import KeymapIR
+from .modification_utils import Modification
+
+INDENT = "                    "
+
+VSCODE_HEADER = "// Place your key bindings in this file to override the defaults\n"
+
+# Hand written VSCode bindings with no Karabiner counterpart, kept verbatim
+VSCODE_EXTRAS: List[Dict[str, Any]] = [
+    {
+        "key": "cmd+enter",
+        "command": "editor.action.showHover",
+        "when": "editorTextFocus",
+    },
+    {
+        "key": "ctrl+c ctrl+a",
+        "command": "toggle",
+        "when": "editorTextFocus",
+        "args": {
+            "id": "toggle_inlay_hints",
+            "value": [
+                {"editor.inlayHints.enabled": "on"},
+                {"editor.inlayHints.enabled": "off"},
+            ],
+        },
+    },
+]
+
+VSCODE_MODIFIERS = {
+    "command": "cmd",
+    "control": "ctrl",
+    "option": "alt",
+    "shift": "shift",
+}
+
+VSCODE_KEYS = {
+    "hyphen": "-",
+    "slash": "/",
+    "return_or_enter": "enter",
+    "escape": "escape",
+    "spacebar": "space",
+    "period": ".",
+    "comma": ",",
+}
+
+INTELLIJ_KEYMAP_NAME = "keyboard-conf"
+INTELLIJ_PARENT_KEYMAP = "Mac OS X 10.5+"
+
+INTELLIJ_MODIFIERS = {
+    "command": "meta",
+    "control": "ctrl",
+    "option": "alt",
+    "shift": "shift",
+}
+
+INTELLIJ_KEYS = {
+    "hyphen": "MINUS",
+    "slash": "SLASH",
+    "return_or_enter": "ENTER",
+    "escape": "ESCAPE",
+    "spacebar": "SPACE",
+    "period": "PERIOD",
+    "comma": "COMMA",
+}
+
+
+def _modifier_kind(modifier: str) -> str:
+    """Drop the side, e.g. right_command -> command, as the IDEs ignore it."""
+    return modifier.split("_", 1)[-1]
+
+
+def _ide_modifier(
+    modifiers: Dict[str, str],
+    ide: str,
+    modifier: str,
+    binding: str,
+) -> str:
+    name = modifiers.get(_modifier_kind(modifier))
+    if name is None:
+        raise Exception(
+            "%s: %s has no %s modifier, bind the IDE action without it"
+            % (binding, ide, modifier)
+        )
+    return name
+
+
+def write_config(
+    modifications: Iterable[Modification],
+    template_path: str,
+    out: TextIO = sys.stdout,
+) -> None:
+    """Splice the modifications into the template at the "// ::commands" marker.
+
+    Each modification is written as soon as it is produced.
+    """
+    with open(template_path) as file:
+        while line := file.readline():
+            if line.strip().startswith("// ::commands"):
+                separator = ""
+                for modification in modifications:
+                    rendered = json.dumps(
+                        modification, indent=4
+                    )
+                    out.write(
+                        separator
+                        + INDENT
+                        + rendered.replace(
+                            "\n", "\n" + INDENT
+                        )
+                    )
+                    separator = ",\n"
+                if separator:
+                    out.write("\n")
+                continue
+            if line.strip().startswith("//"):
+                continue
+            print(line, end="", file=out)
+
+
+def karabiner(
+    ir: KeymapIR,
+    out: TextIO,
+    template_path: str = paths.TEMPLATE,
+) -> None:
+    write_config(list(ir.modifications), template_path, out)
+
+
+def _vscode_key(event: Dict[str, Any], binding: str) -> str:
+    parts = [
+        _ide_modifier(
+            VSCODE_MODIFIERS, "VSCode", m, binding
+        )
+        for m in event.get("modifiers", [])
+    ]
+    key_code = event["key_code"]
+    parts.append(VSCODE_KEYS.get(key_code, key_code))
+    return "+".join(parts)
+
+
+def vscode(ir: KeymapIR, out: TextIO) -> None:
+    bindings: List[Dict[str, Any]] = []
+    for binding in ir.ide_bindings():
+        assert binding.ide_command is not None
+        if binding.ide_command.vscode_default:
+            continue
+        produced = (
+            binding.produced
+            if isinstance(binding.produced, list)
+            else [binding.produced]
+        )
+        bindings.append(
+            {
+                "key": " ".join(
+                    _vscode_key(e, binding.path)
+                    for e in produced
+                ),
+                "command": binding.ide_command.vscode,
+            }
+        )
+    out.write(VSCODE_HEADER)
+    out.write(
+        json.dumps(bindings + VSCODE_EXTRAS, indent=4)
+    )
+    out.write("\n")
+
+
+def _intellij_keystroke(
+    event: Dict[str, Any], binding: str
+) -> str:
+    parts = [
+        _ide_modifier(
+            INTELLIJ_MODIFIERS, "IntelliJ", m, binding
+        )
+        for m in event.get("modifiers", [])
+    ]
+    key_code = event["key_code"]
+    parts.append(
+        INTELLIJ_KEYS.get(key_code, key_code.upper())
+    )
+    return " ".join(parts)
+
+
+def intellij(ir: KeymapIR, out: TextIO) -> None:
+    out.write(
+        '<keymap version="1" name="%s" parent="%s">\n'
+        % (INTELLIJ_KEYMAP_NAME, INTELLIJ_PARENT_KEYMAP)
+    )
+    for binding in ir.ide_bindings():
+        assert binding.ide_command is not None
+        produced = (
+            binding.produced
+            if isinstance(binding.produced, list)
+            else [binding.produced]
+        )
+        # IntelliJ shortcuts have at most two keystrokes
+        assert len(produced) <= 2, binding.path
+        shortcut = 'first-keystroke="%s"' % (
+            _intellij_keystroke(produced[0], binding.path)
+        )
+        if len(produced) == 2:
+            shortcut += ' second-keystroke="%s"' % (
+                _intellij_keystroke(
+                    produced[1], binding.path
+                )
+            )
+        out.write(
+            '  <action id="%s">\n'
+            "    <keyboard-shortcut %s />\n"
+            "  </action>\n"
+            % (binding.ide_command.intellij, shortcut)
+        )
+    out.write("</keymap>\n")
+
+
+BACKENDS: Dict[str, Callable[[KeymapIR, TextIO], None]] = {
+    "karabiner": karabiner,
+    "vscode": vscode,
+    "intellij": intellij,
+}
+
+
+def compile_all(
+    ir: KeymapIR, outputs: Dict[str, str]
+) -> None:
+    """Run the backends concurrently and write each to its output path.
+
+    The backends only read the IR, so threads can share it as is. Outputs are
+    rendered in memory first so a failing backend leaves no partial files.
+    """
+
+    def render(name: str) -> str:
+        out = io.StringIO()
+        BACKENDS[name](ir, out)
+        return out.getvalue()
+
+    with ThreadPoolExecutor() as pool:
+        rendered = dict(
+            zip(outputs, pool.map(render, outputs))
+        )
+    for name, path in outputs.items():
+        with open(path, "w") as file:
+            file.write(rendered[name])
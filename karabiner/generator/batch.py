@@ -0,0 +1,393 @@
+"""Vectorised batch replay of key presses with NumPy.
+
+Key presses are encoded as a key_code id and a bitmask of the held modifiers,
+and every manipulator's `from` as a set of bitmask tests:
+* mods & required == required, the side specific mandatory modifiers
+* mods & group != 0 for each either side mandatory modifier
+* mods & forbidden == 0, everything neither mandatory nor optional
+
+That gives a (key presses x manipulators) match matrix for a whole chunk of a
+trace at once. The variables only change when a manipulator sets one (or has a
+delayed action), so between two such manipulators every key press is matched
+against the same eligible manipulators and is resolved in bulk. Only the key
+presses around a state change go through the scalar Engine.
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+import argparse
+import random
+import time
+
+import numpy as np
+
+from .modifiers import ALL, held_mask
+from .replay import (
+    Engine,
+    KeyPress,
+    State,
+    Step,
+    Wait,
+    _apply,
+    parse_state,
+)
+from .trace import read_trace, steps
+
+# Encoded key of a Wait step, and of a key no manipulator names
+WAIT_KEY = -2
+UNKNOWN_KEY = -1
+# Matched manipulator of a Wait step, and of a key press that passes through
+WAITED = -2
+PASSED = -1
+
+# Upper bound on the bytes of one chunk's match matrix
+CHUNK_BYTES = 1 << 22
+FIRST_WINDOW = 64
+
+
+@dataclass
+class BatchResult:
+    # Position of the manipulator each step matched, or PASSED or WAITED
+    matched: np.ndarray
+    state: State
+
+
+class BatchEngine:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        manipulators = engine.manipulators
+
+        self.key_ids: Dict[str, int] = {
+            key_code: i
+            for i, key_code in enumerate(engine.key_codes())
+        }
+        count = len(manipulators)
+        self.key = np.full(count, UNKNOWN_KEY, np.int32)
+        self.required = np.zeros(count, np.uint32)
+        self.forbidden = np.zeros(count, np.uint32)
+        groups = max(
+            [
+                sum(
+                    m & (m - 1) != 0
+                    for m in manipulator.modifiers.mandatory
+                )
+                for manipulator in manipulators
+            ]
+            + [0]
+        )
+        self.groups = np.zeros((count, groups), np.uint32)
+        self.never = np.zeros(count, bool)
+        self.changes_state = np.zeros(count, bool)
+
+        for i, manipulator in enumerate(manipulators):
+            if manipulator.key_code is not None:
+                self.key[i] = self.key_ids[
+                    manipulator.key_code
+                ]
+            # Mandatory modifiers consume the held ones in order, as in
+            # ModifierMask.consume, so one already consumed can never match
+            # again
+            modifiers = manipulator.modifiers
+            required = 0
+            taken = 0
+            group_count = 0
+            for m in modifiers.mandatory:
+                if m & (m - 1) == 0:
+                    if taken & m:
+                        self.never[i] = True
+                    required |= m
+                    taken |= m
+                    continue
+                # Sides an earlier mandatory took do not count
+                group = m & ~taken
+                if group == 0:
+                    self.never[i] = True
+                self.groups[i, group_count] = group
+                group_count += 1
+                taken |= group
+            self.required[i] = required
+            self.forbidden[i] = ALL & ~(
+                taken | modifiers.optional
+            )
+            self.changes_state[i] = (
+                manipulator.delayed is not None
+                or any(
+                    "set_variable" in e
+                    for e in manipulator.to
+                )
+            )
+        self.catch_all = self.key == UNKNOWN_KEY
+
+        self._eligible: Dict[Tuple, np.ndarray] = {}
+
+    def encode(
+        self, steps: Sequence[Step]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Traces repeat the same few key presses, encode each once
+        codes: Dict[Step, int] = {}
+        encoded: List[int] = []
+        for step in steps:
+            code = codes.get(step)
+            if code is None:
+                code = codes[step] = len(codes)
+            encoded.append(code)
+        table = np.array(
+            [
+                (
+                    (WAIT_KEY, 0)
+                    if isinstance(step, Wait)
+                    else (
+                        self.key_ids.get(
+                            step.key_code, UNKNOWN_KEY
+                        ),
+                        held_mask(step.modifiers),
+                    )
+                )
+                for step in codes
+            ],
+            np.int64,
+        ).reshape(-1, 2)
+        rows = table[np.array(encoded, np.int64)]
+        return (
+            rows[:, 0].astype(np.int32),
+            rows[:, 1].astype(np.uint32),
+        )
+
+    def match_matrix(
+        self, keys: np.ndarray, mods: np.ndarray
+    ) -> np.ndarray:
+        """(steps x manipulators), whether the `from` matches, ignoring conditions."""
+        matrix = (keys[:, None] == self.key[None, :]) | (
+            self.catch_all[None, :]
+        )
+        matrix &= (keys != WAIT_KEY)[:, None]
+        held = mods[:, None]
+        matrix &= (held & self.required) == self.required
+        matrix &= (held & self.forbidden) == 0
+        for g in range(self.groups.shape[1]):
+            group = self.groups[:, g]
+            matrix &= (group == 0) | ((held & group) != 0)
+        matrix &= ~self.never
+        return matrix
+
+    def eligible(self, state: State) -> np.ndarray:
+        """Manipulators whose conditions hold in the state."""
+        cached = self._eligible.get(state.variables)
+        if cached is None:
+            cached = np.array(
+                [
+                    m.matches_conditions(state)
+                    for m in self.engine.manipulators
+                ],
+                bool,
+            )
+            self._eligible[state.variables] = cached
+        return cached
+
+    def run(
+        self, state: State, steps: Sequence[Step]
+    ) -> BatchResult:
+        keys, mods = self.encode(steps)
+        matched = np.full(len(steps), PASSED, np.int32)
+        chunk = max(
+            FIRST_WINDOW,
+            CHUNK_BYTES
+            // max(1, len(self.engine.manipulators)),
+        )
+        for start in range(0, len(steps), chunk):
+            stop = min(start + chunk, len(steps))
+            state = self._run_chunk(
+                state,
+                steps,
+                start,
+                self.match_matrix(
+                    keys[start:stop], mods[start:stop]
+                ),
+                keys[start:stop],
+                matched[start:stop],
+            )
+        return BatchResult(matched=matched, state=state)
+
+    def _run_chunk(
+        self,
+        state: State,
+        steps: Sequence[Step],
+        offset: int,
+        matrix: np.ndarray,
+        keys: np.ndarray,
+        matched: np.ndarray,
+    ) -> State:
+        p = 0
+        n = len(keys)
+        while p < n:
+            if state.pending is not None:
+                # The delayed action resolves on the next step, one at a time
+                manipulator, _, state = self.engine.resolve(
+                    state, steps[offset + p]
+                )
+                matched[p] = (
+                    WAITED
+                    if keys[p] == WAIT_KEY
+                    else (
+                        PASSED
+                        if manipulator is None
+                        else manipulator.position
+                    )
+                )
+                p += 1
+                continue
+
+            eligible = self.eligible(state)
+            window = FIRST_WINDOW
+            while p < n:
+                segment = matrix[p : p + window] & eligible
+                hit = segment.any(axis=1)
+                first = np.where(
+                    hit, segment.argmax(axis=1), PASSED
+                ).astype(np.int32)
+                first[keys[p : p + window] == WAIT_KEY] = (
+                    WAITED
+                )
+                change = (
+                    hit
+                    & self.changes_state[
+                        np.maximum(first, 0)
+                    ]
+                )
+                if not change.any():
+                    matched[p : p + len(first)] = first
+                    p += len(first)
+                    window *= 2
+                    continue
+                q = int(change.argmax())
+                matched[p : p + q + 1] = first[: q + 1]
+                manipulator = self.engine.manipulators[
+                    first[q]
+                ]
+                variables = _apply(
+                    manipulator.to,
+                    state.variables,
+                    frozenset(),
+                    [],
+                )
+                state = State(
+                    variables, manipulator.delayed
+                )
+                p += q + 1
+                break
+        return state
+
+
+def random_steps(
+    engine: Engine, count: int, seed: int = 0
+) -> List[Step]:
+    """Key presses over the keys and modifiers the config uses, plus plain typing."""
+    rng = random.Random(seed)
+    modifiers = engine.modifiers()
+    key_codes = engine.key_codes() + list("abcdefghij")
+    steps: List[Step] = []
+    for _ in range(count):
+        held = frozenset(
+            m for m in modifiers if rng.random() < 0.08
+        )
+        steps.append(KeyPress(rng.choice(key_codes), held))
+    return steps
+
+
+@dataclass
+class Benchmark:
+    steps: int
+    scalar_s: float
+    batch_s: float
+    # Both engines matched the same manipulators and ended in the same state
+    agree: bool
+    state_changes: int
+
+
+def benchmark(
+    engine: Engine,
+    steps: Sequence[Step],
+    initial: State = State(),
+) -> Benchmark:
+    started = time.perf_counter()
+    scalar: List[int] = []
+    state = initial
+    for step in steps:
+        manipulator, _, state = engine.resolve(state, step)
+        scalar.append(
+            WAITED
+            if isinstance(step, Wait)
+            else (
+                PASSED
+                if manipulator is None
+                else manipulator.position
+            )
+        )
+    scalar_s = time.perf_counter() - started
+
+    batch_engine = BatchEngine(engine)
+    started = time.perf_counter()
+    result = batch_engine.run(initial, steps)
+    batch_s = time.perf_counter() - started
+
+    matched = result.matched
+    return Benchmark(
+        steps=len(steps),
+        scalar_s=scalar_s,
+        batch_s=batch_s,
+        agree=(
+            np.array_equal(
+                matched, np.array(scalar, np.int32)
+            )
+            and result.state == state
+        ),
+        state_changes=int(
+            batch_engine.changes_state[
+                matched[matched >= 0]
+            ].sum()
+        ),
+    )
+
+
+def format_benchmark(result: Benchmark) -> str:
+    return "\n".join(
+        [
+            "%d steps, %d state changes"
+            % (result.steps, result.state_changes),
+            "scalar %8.3fs  %10.0f steps/s"
+            % (
+                result.scalar_s,
+                result.steps / result.scalar_s,
+            ),
+            "batch  %8.3fs  %10.0f steps/s  (%.1fx)"
+            % (
+                result.batch_s,
+                result.steps / max(result.batch_s, 1e-9),
+                result.scalar_s / max(result.batch_s, 1e-9),
+            ),
+            "results %s"
+            % ("agree" if result.agree else "DIFFER"),
+        ]
+    )
+
+
+def run_command(args: argparse.Namespace) -> int:
+    """Replay the traces, or random presses without any, both ways."""
+    engine = Engine.load(args.config)
+    replayed = (
+        [
+            step
+            for trace in args.traces
+            for step in steps(
+                read_trace(trace, args.format),
+                engine.delayed_action_delay_ms,
+            )
+        ]
+        if args.traces
+        else random_steps(engine, args.presses, args.seed)
+    )
+    result = benchmark(
+        engine, replayed, parse_state(args.initial)
+    )
+    print(format_benchmark(result))
+    return 0 if result.agree else 1
@@ -0,0 +1,368 @@
+"""Binary keystroke traces, read through mmap as NumPy structured arrays.
+
+Text traces are parsed again by every experiment. A binary trace stores one
+fixed width RECORD per key event instead:
+* delta: milliseconds since the previous event
+* key_code: id into the key_code dictionary of the header
+* modifiers: mask of the modifiers held at the time, see generator.modifiers
+* down: 1 for key down, 0 for key up
+
+Key codes of the catalog keep their KEY_CODE_IDS, others are appended after
+them, so the same key has the same id in every trace. The header still holds
+the whole dictionary, so reading never depends on the catalog.
+
+Layout: MAGIC, VERSION and the header size, the JSON header, the records, then
+the absolute timestamp of every INDEX_STRIDE-th record. Both arrays are views
+of the mapped file, nothing is copied when opening. A time range is found
+through the index, only one stride of deltas is summed to find its ends.
+"""
+
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from .catalog import KEY_CODE_IDS
+from .modifiers import BITS
+from .trace import (
+    BINARY_MAGIC,
+    MODIFIER_KEY_CODES,
+    TraceEvent,
+    read_trace,
+)
+
+MAGIC = BINARY_MAGIC
+VERSION = 1
+INDEX_STRIDE = 4096
+
+RECORD = np.dtype(
+    [
+        ("delta", "<u4"),
+        ("key_code", "<u2"),
+        ("modifiers", "<u2"),
+        ("down", "u1"),
+    ]
+)
+
+_PREAMBLE = struct.Struct("<4sII")
+_DELTA_MAX = np.iinfo(np.uint32).max
+# Records are converted in blocks of this many events
+_BLOCK = 1 << 16
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class _Encoder:
+    def __init__(self) -> None:
+        self.key_codes: List[str] = sorted(KEY_CODE_IDS)
+        self.ids: Dict[str, int] = dict(KEY_CODE_IDS)
+        self.held = 0
+        self.last: Optional[int] = None
+        self.start: Optional[int] = None
+        self.timestamps = True
+        self.records = 0
+        self.index: List[int] = []
+
+    def key_code(self, key_code: str) -> int:
+        id = self.ids.get(key_code)
+        if id is None:
+            id = self.ids[key_code] = len(self.key_codes)
+            self.key_codes.append(key_code)
+        return id
+
+    def encode(
+        self, events: List[TraceEvent]
+    ) -> np.ndarray:
+        block = np.zeros(len(events), dtype=RECORD)
+        for i, event in enumerate(events):
+            if event.timestamp is None:
+                self.timestamps = False
+                delta = 0
+            elif self.last is None:
+                self.start = self.last = event.timestamp
+                delta = 0
+            else:
+                delta = event.timestamp - self.last
+                if delta < 0 or delta > _DELTA_MAX:
+                    raise Exception(
+                        "Timestamp %d after %d cannot be stored as a delta"
+                        % (event.timestamp, self.last)
+                    )
+                self.last = event.timestamp
+            if self.records % INDEX_STRIDE == 0:
+                self.index.append(self.last or 0)
+            self.records += 1
+            block[i] = (
+                delta,
+                self.key_code(event.key_code),
+                self.held,
+                event.down,
+            )
+            if event.key_code in MODIFIER_KEY_CODES:
+                if event.down:
+                    self.held |= BITS[event.key_code]
+                else:
+                    self.held &= ~BITS[event.key_code]
+        return block
+
+
+def _blocks(
+    events: Iterable[TraceEvent],
+) -> Iterator[List[TraceEvent]]:
+    block: List[TraceEvent] = []
+    for event in events:
+        block.append(event)
+        if len(block) == _BLOCK:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def write_binary_trace(
+    events: Iterable[TraceEvent], path: str
+) -> int:
+    """Convert a stream of trace events, returns the number of records.
+
+    The header is only complete once every event was seen, so the records go
+    to a temporary file first and are copied behind the header.
+    """
+    encoder = _Encoder()
+    with open(path + ".records", "w+b") as records:
+        for block in _blocks(events):
+            encoder.encode(block).tofile(records)
+        header = json.dumps(
+            {
+                "records": encoder.records,
+                "key_codes": encoder.key_codes,
+                "start": encoder.start,
+                "timestamps": encoder.timestamps,
+                "index_stride": INDEX_STRIDE,
+            }
+        ).encode()
+        records.seek(0)
+        with open(path + ".tmp", "wb") as file:
+            file.write(
+                _PREAMBLE.pack(MAGIC, VERSION, len(header))
+            )
+            file.write(header)
+            file.write(
+                b"\0" * (_align(file.tell()) - file.tell())
+            )
+            _copy(records, file)
+            file.write(
+                b"\0" * (_align(file.tell()) - file.tell())
+            )
+            np.array(encoder.index, dtype="<u8").tofile(
+                file
+            )
+    os.remove(path + ".records")
+    os.replace(path + ".tmp", path)
+    return encoder.records
+
+
+def _copy(source: BinaryIO, target: BinaryIO) -> None:
+    while chunk := source.read(1 << 20):
+        target.write(chunk)
+
+
+class BinaryTrace:
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        magic, version, header_size = _PREAMBLE.unpack_from(
+            self._map
+        )
+        if magic != MAGIC:
+            raise Exception("Not a binary trace: " + path)
+        if version != VERSION:
+            raise Exception(
+                "Unsupported binary trace version %d"
+                % version
+            )
+        offset = _PREAMBLE.size
+        self.header: Dict[str, Any] = json.loads(
+            self._map[offset : offset + header_size]
+        )
+        self.key_codes: List[str] = self.header["key_codes"]
+        self.stride: int = self.header["index_stride"]
+        count = self.header["records"]
+        offset = _align(offset + header_size)
+        self.records = np.frombuffer(
+            self._map,
+            dtype=RECORD,
+            count=count,
+            offset=offset,
+        )
+        offset = _align(offset + count * RECORD.itemsize)
+        self.index = np.frombuffer(
+            self._map,
+            dtype="<u8",
+            count=-(-count // self.stride),
+            offset=offset,
+        )
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __enter__(self) -> "BinaryTrace":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Unmap the file, unless views handed out by between() and the like are still alive.
+
+        Such a view keeps the map open, and readable, until it is collected.
+        """
+        # The arrays must go first, they hold exports of the map
+        del self.records, self.index
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+    def _require_timestamps(self) -> None:
+        if not self.header["timestamps"]:
+            raise Exception("The trace has no timestamps")
+
+    def timestamps(
+        self, start: int = 0, stop: Optional[int] = None
+    ) -> np.ndarray:
+        """Absolute timestamps of records[start:stop], summed from the nearest index entry."""
+        self._require_timestamps()
+        stop = len(self.records) if stop is None else stop
+        if start >= stop:
+            return np.zeros(0, dtype=np.int64)
+        base = start // self.stride * self.stride
+        deltas = self.records["delta"][
+            base + 1 : stop
+        ].astype(np.int64)
+        summed = np.concatenate(
+            ([0], np.cumsum(deltas))
+        ) + int(self.index[base // self.stride])
+        return summed[start - base :]
+
+    def find(self, timestamp: int) -> int:
+        """Position of the first record at or after the timestamp."""
+        self._require_timestamps()
+        if not len(self.records):
+            return 0
+        stride = max(
+            0,
+            int(
+                np.searchsorted(
+                    self.index, timestamp, side="left"
+                )
+            )
+            - 1,
+        )
+        start = stride * self.stride
+        stop = min(len(self.records), start + self.stride)
+        return start + int(
+            np.searchsorted(
+                self.timestamps(start, stop),
+                timestamp,
+                side="left",
+            )
+        )
+
+    def between(
+        self, start_ms: int, end_ms: int
+    ) -> np.ndarray:
+        """The records from start_ms up to, not including, end_ms, a view of the file."""
+        return self.records[
+            self.find(start_ms) : self.find(end_ms)
+        ]
+
+    def events(
+        self, start: int = 0, stop: Optional[int] = None
+    ) -> Iterator[TraceEvent]:
+        stop = len(self.records) if stop is None else stop
+        timestamps = (
+            self.timestamps(start, stop).tolist()
+            if self.header["timestamps"]
+            else [None] * (stop - start)
+        )
+        records = self.records[start:stop]
+        for timestamp, key_code, down in zip(
+            timestamps,
+            records["key_code"].tolist(),
+            records["down"].tolist(),
+        ):
+            yield TraceEvent(
+                timestamp=timestamp,
+                key_code=self.key_codes[key_code],
+                down=bool(down),
+            )
+
+
+def check_binary_trace(path: str, records: int) -> None:
+    """Read a written trace back: its records, and the whole time range through the index."""
+    with BinaryTrace(path) as trace:
+        if len(trace) != records:
+            raise Exception(
+                "%s holds %d records, expected %d"
+                % (path, len(trace), records)
+            )
+        if not records or not trace.header["timestamps"]:
+            return
+        start = int(trace.timestamps(0, 1)[0])
+        end = int(trace.timestamps(records - 1)[0])
+        found = trace.between(start, end + 1)
+        expected = found.copy()
+    # The view outlives the trace, closing must leave it readable
+    if len(found) != records or not np.array_equal(
+        found, expected
+    ):
+        raise Exception(
+            "%s: the index finds %d of %d records"
+            % (path, len(found), records)
+        )
+
+
+def read_binary_trace(path: str) -> Iterator[TraceEvent]:
+    with BinaryTrace(path) as trace:
+        for start in range(0, len(trace), _BLOCK):
+            yield from trace.events(
+                start, min(len(trace), start + _BLOCK)
+            )
+
+
+def run_command(args: argparse.Namespace) -> int:
+    out = args.out or (
+        os.path.splitext(args.trace)[0] + ".kct"
+    )
+    start = time.perf_counter()
+    records = write_binary_trace(
+        read_trace(args.trace, args.format), out
+    )
+    check_binary_trace(out, records)
+    print(
+        "%d events, %d bytes -> %d bytes in %.2fs"
+        % (
+            records,
+            os.path.getsize(args.trace),
+            os.path.getsize(out),
+            time.perf_counter() - start,
+        )
+    )
+    return 0
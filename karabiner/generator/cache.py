@@ -0,0 +1,78 @@
+"""Structures compiled from a source file, pickled to __pycache__ next to it.
+
+A cache is keyed on a hash of the source and of the code that compiles it, the
+source files of the given modules, so changing the compiler invalidates every
+cache it wrote without anyone remembering to bump a version.
+"""
+
+from functools import lru_cache
+from types import ModuleType
+from typing import Callable, Sequence, Tuple, TypeVar
+import hashlib
+import os
+import pickle
+import sys
+
+T = TypeVar("T")
+
+DIGEST_SIZE = 16
+
+
+@lru_cache(maxsize=None)
+def _code_digest(names: Tuple[str, ...]) -> bytes:
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for name in names:
+        path = sys.modules[name].__file__
+        if path is None:
+            raise Exception("No source for module " + name)
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    return digest.digest()
+
+
+def code_digest(modules: Sequence[ModuleType]) -> bytes:
+    """Hash of the modules' source, read once per process."""
+    return _code_digest(tuple(m.__name__ for m in modules))
+
+
+def cache_path(path: str, extension: str) -> str:
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(
+        directory, "__pycache__", name + extension
+    )
+
+
+def load_cached(
+    path: str,
+    extension: str,
+    magic: bytes,
+    modules: Sequence[ModuleType],
+    build: Callable[[bytes], T],
+) -> T:
+    """Build from the file's content, or load what was built from the same content by the same code."""
+    with open(path, "rb") as file:
+        source = file.read()
+    digest = hashlib.blake2b(
+        code_digest(modules) + source,
+        digest_size=DIGEST_SIZE,
+    ).digest()
+    cached = cache_path(path, extension)
+    try:
+        with open(cached, "rb") as file:
+            if file.read(len(magic) + DIGEST_SIZE) == (
+                magic + digest
+            ):
+                return pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+
+    built = build(source)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    # Written aside and moved in place so readers never see half a cache
+    with open(cached + ".tmp", "wb") as file:
+        file.write(magic + digest)
+        pickle.dump(
+            built, file, protocol=pickle.HIGHEST_PROTOCOL
+        )
+    os.replace(cached + ".tmp", cached)
+    return built
@@ -0,0 +1,186 @@
+"""The key codes, pointing buttons and modifiers Karabiner knows.
+
+Karabiner skips a rule naming a key it does not know when it loads the
+config, without telling anyone. Every key event is checked against this
+catalog when it is constructed instead, so a typo or a symbol
+translate_symbols passes through fails the build, with the closest known
+names as suggestions.
+
+A check is one frozenset lookup. The close matches are only searched for once
+a check failed.
+"""
+
+from typing import Any, Dict, FrozenSet, Iterable
+import difflib
+
+from .keys import KeyCode, Modifier
+from .modifiers import BITS
+
+_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+# From Karabiner-Elements' key_code list
+KEY_CODES: FrozenSet[KeyCode] = frozenset(
+    list(_LETTERS)
+    + [str(digit) for digit in range(10)]
+    + ["f%d" % n for n in range(1, 25)]
+    + ["keypad_%d" % digit for digit in range(10)]
+    + ["international%d" % n for n in range(1, 10)]
+    + ["lang%d" % n for n in range(1, 10)]
+    + [
+        "return_or_enter",
+        "escape",
+        "delete_or_backspace",
+        "delete_forward",
+        "tab",
+        "spacebar",
+        "hyphen",
+        "equal_sign",
+        "open_bracket",
+        "close_bracket",
+        "backslash",
+        "non_us_pound",
+        "semicolon",
+        "quote",
+        "grave_accent_and_tilde",
+        "comma",
+        "period",
+        "slash",
+        "non_us_backslash",
+        "up_arrow",
+        "down_arrow",
+        "left_arrow",
+        "right_arrow",
+        "page_up",
+        "page_down",
+        "home",
+        "end",
+        "caps_lock",
+        "left_control",
+        "left_shift",
+        "left_option",
+        "left_command",
+        "right_control",
+        "right_shift",
+        "right_option",
+        "right_command",
+        "left_alt",
+        "left_gui",
+        "right_alt",
+        "right_gui",
+        "fn",
+        "display_brightness_decrement",
+        "display_brightness_increment",
+        "mission_control",
+        "launchpad",
+        "dashboard",
+        "illumination_decrement",
+        "illumination_increment",
+        "rewind",
+        "play_or_pause",
+        "fastforward",
+        "mute",
+        "volume_decrement",
+        "volume_increment",
+        "eject",
+        "apple_display_brightness_decrement",
+        "apple_display_brightness_increment",
+        "apple_top_case_display_brightness_decrement",
+        "apple_top_case_display_brightness_increment",
+        "print_screen",
+        "scroll_lock",
+        "pause",
+        "insert",
+        "application",
+        "help",
+        "power",
+        "execute",
+        "menu",
+        "select",
+        "stop",
+        "again",
+        "undo",
+        "cut",
+        "copy",
+        "paste",
+        "find",
+        "keypad_num_lock",
+        "keypad_slash",
+        "keypad_asterisk",
+        "keypad_hyphen",
+        "keypad_plus",
+        "keypad_enter",
+        "keypad_period",
+        "keypad_equal_sign",
+        "keypad_comma",
+        "japanese_eisuu",
+        "japanese_kana",
+        "japanese_pc_nfer",
+        "japanese_pc_xfer",
+        "japanese_pc_katakana",
+        "vk_none",
+    ]
+)
+
+POINTING_BUTTONS: FrozenSet[str] = frozenset(
+    "button%d" % n for n in range(1, 33)
+)
+
+MODIFIERS: FrozenSet[Modifier] = frozenset(BITS) | {"any"}
+
+# Dense ids in sorted order, stable for as long as the catalog is
+KEY_CODE_IDS: Dict[KeyCode, int] = {
+    key_code: i
+    for i, key_code in enumerate(sorted(KEY_CODES))
+}
+
+
+def _unknown(
+    kind: str, name: str, known: Iterable[str]
+) -> Exception:
+    message = "Unknown %s: %r" % (kind, name)
+    suggestions = difflib.get_close_matches(
+        name, list(known), n=3
+    )
+    if suggestions:
+        message += ", did you mean %s?" % " or ".join(
+            suggestions
+        )
+    elif len(name) == 1 and not name.isalnum():
+        message += (
+            ", translate_symbols has no key code for it"
+        )
+    return Exception(message)
+
+
+def check_key_code(key_code: KeyCode) -> None:
+    if key_code not in KEY_CODES:
+        raise _unknown("key_code", key_code, KEY_CODES)
+
+
+def check_pointing_button(button: str) -> None:
+    if button not in POINTING_BUTTONS:
+        raise _unknown(
+            "pointing_button", button, POINTING_BUTTONS
+        )
+
+
+def check_modifiers(modifiers: Iterable[Modifier]) -> None:
+    for modifier in modifiers:
+        if modifier not in MODIFIERS:
+            raise _unknown("modifier", modifier, MODIFIERS)
+
+
+def check_event(event: Dict[str, Any]) -> None:
+    """Check the key codes, pointing button and modifiers of a key event."""
+    if "key_code" in event:
+        check_key_code(event["key_code"])
+    if "pointing_button" in event:
+        check_pointing_button(event["pointing_button"])
+    for key in event.get("simultaneous", []):
+        check_key_code(key["key_code"])
+    modifiers = event.get("modifiers")
+    if isinstance(modifiers, dict):
+        for kind in modifiers.values():
+            check_modifiers(kind)
+    elif modifiers is not None:
+        check_modifiers(modifiers)
@@ -0,0 +1,252 @@
+"""False triggers of simultaneous chords in ordinary typing.
+
+Karabiner fires a chord when all of its keys go down within
+basic.simultaneous_threshold_milliseconds of the first one, in any order,
+without another key going down and without one of them coming up in between.
+Replaying typing traces through that rule counts how often plain text would
+have fired each chord instead of typing its keys, e.g. "jk" typed as a fast
+roll.
+"""
+
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+)
+
+import argparse
+import json
+import sys
+
+from .report import (
+    chord_key,
+    iter_manipulators,
+    selected_profile,
+)
+from .trace import TraceEvent, read_trace
+
+# Karabiner's default when the parameter is not set
+SIMULTANEOUS_THRESHOLD_MS = 50
+
+
+@dataclass(frozen=True)
+class Chord:
+    keys: FrozenSet[str]
+    threshold_ms: int = SIMULTANEOUS_THRESHOLD_MS
+
+    @property
+    def name(self) -> str:
+        return chord_key(self.keys)
+
+
+def configured_threshold(config: Dict[str, Any]) -> int:
+    return (
+        selected_profile(config)
+        .get("complex_modifications", {})
+        .get("parameters", {})
+        .get(
+            "basic.simultaneous_threshold_milliseconds",
+            SIMULTANEOUS_THRESHOLD_MS,
+        )
+    )
+
+
+def chords(config: Dict[str, Any]) -> List[Chord]:
+    """The simultaneous chords of a config, with their effective threshold."""
+    threshold_ms = configured_threshold(config)
+    found: List[Chord] = []
+    for _, manipulator in iter_manipulators(config):
+        event = manipulator.get("from", {})
+        if "simultaneous" not in event:
+            continue
+        found.append(
+            Chord(
+                keys=frozenset(
+                    key["key_code"]
+                    for key in event["simultaneous"]
+                ),
+                threshold_ms=manipulator.get(
+                    "parameters", {}
+                ).get(
+                    "basic.simultaneous_threshold_milliseconds",
+                    threshold_ms,
+                ),
+            )
+        )
+    return found
+
+
+def parse_chord(
+    text: str, threshold_ms: int = SIMULTANEOUS_THRESHOLD_MS
+) -> Chord:
+    """Parse "j,k" or "j&k" into a Chord."""
+    keys = frozenset(
+        filter(None, text.replace("&", ",").split(","))
+    )
+    if len(keys) < 2:
+        raise Exception(
+            "A chord needs at least two keys, got " + text
+        )
+    return Chord(keys, threshold_ms)
+
+
+@dataclass
+class Collisions:
+    chord: Chord
+    triggers: int = 0
+    # Time from the first to the last key down of every trigger
+    spans: List[int] = field(default_factory=list)
+
+
+@dataclass
+class Analysis:
+    key_presses: int
+    collisions: List[Collisions]
+
+
+def analyse(
+    events: Iterable[TraceEvent],
+    proposed: Sequence[Chord],
+) -> Analysis:
+    results = [Collisions(chord) for chord in proposed]
+    # Per chord: the first key down timestamp and the chord keys down since
+    first: List[Optional[int]] = [None] * len(proposed)
+    pressed: List[List[str]] = [[] for _ in proposed]
+    key_presses = 0
+    held: Set[str] = set()
+
+    for event in events:
+        if event.timestamp is None:
+            raise Exception(
+                "Chord timing needs a trace with timestamps"
+            )
+        if not event.down:
+            held.discard(event.key_code)
+            for i in range(len(proposed)):
+                if event.key_code in pressed[i]:
+                    first[i] = None
+                    pressed[i] = []
+            continue
+        if event.key_code in held:
+            # Auto repeat
+            continue
+        held.add(event.key_code)
+        key_presses += 1
+        for i, chord in enumerate(proposed):
+            if event.key_code not in chord.keys:
+                first[i] = None
+                pressed[i] = []
+                continue
+            start = first[i]
+            if (
+                start is None
+                or event.timestamp - start
+                > chord.threshold_ms
+                or event.key_code in pressed[i]
+            ):
+                first[i] = start = event.timestamp
+                pressed[i] = []
+            pressed[i].append(event.key_code)
+            if len(pressed[i]) == len(chord.keys):
+                results[i].triggers += 1
+                results[i].spans.append(
+                    event.timestamp - start
+                )
+                first[i] = None
+                pressed[i] = []
+
+    return Analysis(
+        key_presses=key_presses, collisions=results
+    )
+
+
+def combine(analyses: List[Analysis]) -> Analysis:
+    """Fold the analyses of several traces over the same chords."""
+    combined = Analysis(
+        key_presses=sum(a.key_presses for a in analyses),
+        collisions=[
+            Collisions(c.chord)
+            for c in analyses[0].collisions
+        ],
+    )
+    for analysis in analyses:
+        for total, collisions in zip(
+            combined.collisions, analysis.collisions
+        ):
+            total.triggers += collisions.triggers
+            total.spans += collisions.spans
+    return combined
+
+
+def format_analysis(analysis: Analysis) -> str:
+    lines = [
+        "%d key presses" % analysis.key_presses,
+        "%-12s %9s %9s %12s %10s"
+        % (
+            "chord",
+            "threshold",
+            "triggers",
+            "per 1000",
+            "max span",
+        ),
+    ]
+    for collisions in sorted(
+        analysis.collisions, key=lambda c: -c.triggers
+    ):
+        lines.append(
+            "%-12s %7dms %9d %12.2f %10s"
+            % (
+                collisions.chord.name,
+                collisions.chord.threshold_ms,
+                collisions.triggers,
+                1000.0
+                * collisions.triggers
+                / max(1, analysis.key_presses),
+                (
+                    "%dms" % max(collisions.spans)
+                    if collisions.spans
+                    else "-"
+                ),
+            )
+        )
+    return "\n".join(lines)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    """Count the false chords of the configured and proposed chords."""
+    with open(args.config) as file:
+        config = json.load(file)
+    threshold_ms = args.threshold
+    if threshold_ms is None:
+        threshold_ms = configured_threshold(config)
+    proposed = chords(config) + [
+        parse_chord(chord, threshold_ms)
+        for chord in args.chord
+    ]
+    if not proposed:
+        print(
+            "No simultaneous chords in %s, try --chord"
+            % args.config,
+            file=sys.stderr,
+        )
+        return 1
+    print(
+        format_analysis(
+            combine(
+                [
+                    analyse(
+                        read_trace(trace, args.format),
+                        proposed,
+                    )
+                    for trace in args.traces
+                ]
+            )
+        )
+    )
+    return 0
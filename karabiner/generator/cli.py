@@ -0,0 +1,207 @@
+"""The keyboard-conf command.
+
+Only argparse and the path constants are imported up front, every subcommand
+imports what it needs itself. `install` and `report` never import generate.py,
+which builds all the modifications when it is imported.
+"""
+
+from typing import List, Optional
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from . import paths
+
+WATCH_INTERVAL_S = 0.5
+
+
+def _build(extra: List[str]) -> int:
+    from generate import main
+
+    return main(["--output", paths.CONFIG] + extra)
+
+
+def _install(backup: bool) -> int:
+    from .schema import check_config_file
+
+    try:
+        check_config_file(paths.CONFIG)
+    except Exception as e:
+        print("not installing: %s" % e, file=sys.stderr)
+        return 1
+    if backup and os.path.exists(paths.INSTALLED):
+        with (
+            open(paths.INSTALLED) as src,
+            open(paths.BACKUP, "w") as dst,
+        ):
+            dst.write(src.read())
+    os.makedirs(
+        os.path.dirname(paths.INSTALLED), exist_ok=True
+    )
+    # Rewritten in place rather than replaced, like `cat >` in the makefile,
+    # so a symlinked config stays a symlink
+    with (
+        open(paths.CONFIG) as src,
+        open(paths.INSTALLED, "w") as dst,
+    ):
+        dst.write(src.read())
+    print("installed " + paths.INSTALLED, file=sys.stderr)
+    return 0
+
+
+def _sources() -> List[str]:
+    sources = [
+        os.path.join(paths.KARABINER_DIR, "generate.py"),
+        paths.TEMPLATE,
+        paths.KEYMAP,
+    ]
+    generator_dir = os.path.dirname(
+        os.path.abspath(__file__)
+    )
+    sources += [
+        os.path.join(generator_dir, name)
+        for name in sorted(os.listdir(generator_dir))
+        if name.endswith(".py")
+    ]
+    return sources
+
+
+def _snapshot() -> List[Optional[float]]:
+    return [
+        (
+            os.path.getmtime(path)
+            if os.path.exists(path)
+            else None
+        )
+        for path in _sources()
+    ]
+
+
+def _watch(
+    install: bool, snapshot: bool, extra: List[str]
+) -> int:
+    """Rebuild whenever a source changes.
+
+    Every build runs in a fresh interpreter, as events.py builds its
+    keymaps at import time.
+    """
+    command = [
+        sys.executable,
+        os.path.join(paths.KARABINER_DIR, "generate.py"),
+        "--output",
+        paths.CONFIG,
+    ] + extra
+    check = (
+        [
+            sys.executable,
+            os.path.join(
+                paths.KARABINER_DIR, "generate.py"
+            ),
+        ]
+        + extra
+        + ["snapshot"]
+    )
+    last: Optional[List[Optional[float]]] = None
+    try:
+        while True:
+            current = _snapshot()
+            if current != last:
+                last = current
+                started = time.perf_counter()
+                result = subprocess.run(command)
+                if result.returncode == 0:
+                    print(
+                        "built in %.2fs"
+                        % (time.perf_counter() - started),
+                        file=sys.stderr,
+                    )
+                    if snapshot:
+                        subprocess.run(check)
+                    if install:
+                        _install(backup=False)
+                else:
+                    print("build failed", file=sys.stderr)
+            time.sleep(WATCH_INTERVAL_S)
+    except KeyboardInterrupt:
+        return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="keyboard-conf",
+        description="Build and install the karabiner config.",
+    )
+    commands = parser.add_subparsers(
+        dest="command", required=True
+    )
+
+    build = commands.add_parser(
+        "build",
+        help="generate karabiner/karabiner.json",
+        description="Options after the command are passed to generate.py, e.g. --no-optimise or --source.",
+    )
+    build.add_argument(
+        "generate_args", nargs=argparse.REMAINDER
+    )
+
+    install = commands.add_parser(
+        "install",
+        help="copy karabiner/karabiner.json to the Karabiner config",
+    )
+    install.add_argument(
+        "--backup",
+        action="store_true",
+        help="save the installed config to karabiner/backup.json first",
+    )
+
+    watch = commands.add_parser(
+        "watch",
+        help="rebuild whenever a source file changes",
+    )
+    watch.add_argument(
+        "--install",
+        action="store_true",
+        help="install after every successful build",
+    )
+    watch.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="compare to the golden snapshots after every successful build",
+    )
+    watch.add_argument(
+        "generate_args", nargs=argparse.REMAINDER
+    )
+
+    report = commands.add_parser(
+        "report",
+        help="print per-keystroke cost metrics of a generated config",
+    )
+    report.add_argument(
+        "path", nargs="?", default=paths.CONFIG
+    )
+    report.add_argument(
+        "--json", action="store_true", help="output JSON"
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        return _build(args.generate_args)
+    if args.command == "install":
+        return _install(args.backup)
+    if args.command == "watch":
+        return _watch(
+            args.install, args.snapshot, args.generate_args
+        )
+
+    from .report import analyse, format_report, to_json
+
+    analysis = analyse(args.path)
+    print(
+        to_json(analysis)
+        if args.json
+        else format_report(analysis)
+    )
+    return 0
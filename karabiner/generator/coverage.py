@@ -0,0 +1,147 @@
+"""Replay coverage of the generated manipulators over keystroke traces.
+
+Karabiner checks manipulators in order until one matches, so every manipulator in
+front of the one that fires (or all of them, if none fires) is checked and
+rejected. Counting this per manipulator gives a heat map of which rules are
+used and which only cost evaluation time.
+"""
+
+from dataclasses import dataclass
+from typing import Iterable, List, TypedDict
+import argparse
+import json
+
+from .replay import Engine, KeyPress, State, parse_state
+from .trace import TraceEvent, read_trace, steps
+
+
+class RuleHeat(TypedDict):
+    description: str
+    position: int
+    fired: int
+    checked: int
+    rejected: int
+
+
+@dataclass
+class Coverage:
+    key_presses: int
+    rules: List[RuleHeat]
+
+    @property
+    def cold(self) -> List[RuleHeat]:
+        """Rules that never fired, the most often checked first."""
+        return sorted(
+            (r for r in self.rules if r["fired"] == 0),
+            key=lambda r: (-r["checked"], r["position"]),
+        )
+
+    @property
+    def heat_map(self) -> List[RuleHeat]:
+        return sorted(
+            self.rules,
+            key=lambda r: (-r["fired"], r["position"]),
+        )
+
+
+def trace_coverage(
+    engine: Engine,
+    traces: Iterable[Iterable[TraceEvent]],
+    initial: State = State(),
+) -> Coverage:
+    count = len(engine.manipulators)
+    fired = [0] * count
+    unmatched = 0
+    key_presses = 0
+
+    for events in traces:
+        state = initial
+        for step in steps(
+            events, engine.delayed_action_delay_ms
+        ):
+            manipulator, _, state = engine.resolve(
+                state, step
+            )
+            if not isinstance(step, KeyPress):
+                continue
+            key_presses += 1
+            if manipulator is None:
+                unmatched += 1
+            else:
+                fired[manipulator.position] += 1
+
+    # A manipulator is checked by every key press that matched at or after
+    # its position, plus every key press that matched nothing
+    rules: List[RuleHeat] = []
+    checked = unmatched
+    for position in reversed(range(count)):
+        checked += fired[position]
+        rules.append(
+            RuleHeat(
+                description=engine.manipulators[
+                    position
+                ].description,
+                position=position,
+                fired=fired[position],
+                checked=checked,
+                rejected=checked - fired[position],
+            )
+        )
+    rules.reverse()
+    return Coverage(key_presses=key_presses, rules=rules)
+
+
+def format_coverage(coverage: Coverage) -> str:
+    lines = [
+        "%d key presses replayed" % coverage.key_presses,
+        "",
+        "%8s %8s %8s  %s"
+        % ("fired", "checked", "rejected", "rule"),
+    ]
+    for rule in coverage.heat_map:
+        lines.append(
+            "%8d %8d %8d  %s"
+            % (
+                rule["fired"],
+                rule["checked"],
+                rule["rejected"],
+                rule["description"],
+            )
+        )
+    cold = coverage.cold
+    lines.append("")
+    lines.append(
+        "%d cold rules (pruning candidates, most checked first):"
+        % len(cold)
+    )
+    for rule in cold:
+        lines.append(
+            "%8d checks  %s"
+            % (rule["checked"], rule["description"])
+        )
+    return "\n".join(lines)
+
+
+def to_json(coverage: Coverage) -> str:
+    return json.dumps(
+        {
+            "key_presses": coverage.key_presses,
+            "heat_map": coverage.heat_map,
+            "cold": coverage.cold,
+        },
+        indent=4,
+    )
+
+
+def run_command(args: argparse.Namespace) -> int:
+    coverage = trace_coverage(
+        Engine.load(args.config),
+        (read_trace(t, args.format) for t in args.traces),
+        initial=parse_state(args.initial),
+    )
+    print(
+        to_json(coverage)
+        if args.json
+        else format_coverage(coverage)
+    )
+    return 0
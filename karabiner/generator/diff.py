@@ -0,0 +1,410 @@
+"""Semantic diff between two generated configs.
+
+Manipulators are canonicalised and matched by a structural hash of their `from`
+and conditions, so indentation, key order and rule moves do not show up as
+changes. Matching is a hash join, only manipulators that can see the same key
+event are compared with each other to find order changes.
+"""
+
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+)
+import argparse
+import hashlib
+import itertools
+import json
+
+from .modifiers import ModifierMask
+from .report import (
+    Manipulator,
+    from_key,
+    is_catch_all,
+    iter_manipulators,
+    selected_profile,
+)
+
+# Lists where the order carries no meaning for Karabiner
+_UNORDERED_LISTS = {"mandatory", "optional", "conditions"}
+
+
+class Entry(TypedDict):
+    position: int
+    description: str
+    key: str
+    manipulator: Manipulator
+
+
+class Change(TypedDict):
+    key: str
+    old_description: str
+    new_description: str
+    # field -> [old value, new value]
+    fields: Dict[str, List[Any]]
+
+
+class OrderChange(TypedDict):
+    # Description of the manipulator that matched first before the change
+    was_first: str
+    now_first: str
+
+
+class Diff(TypedDict):
+    added: List[str]
+    removed: List[str]
+    changed: List[Change]
+    order_changes: List[OrderChange]
+    settings_changed: List[str]
+
+
+def canonicalise(value: Any, field: str = "") -> Any:
+    """Sort dict keys and the lists whose order Karabiner ignores."""
+    if isinstance(value, dict):
+        return {
+            k: canonicalise(v, k)
+            for k, v in sorted(value.items())  # type: ignore
+        }
+    if isinstance(value, list):
+        if field in _UNORDERED_LISTS:
+            if all(isinstance(v, str) for v in value):  # type: ignore
+                return sorted(value)  # type: ignore
+            return sorted(
+                (canonicalise(v) for v in value),  # type: ignore
+                key=_dumps,
+            )
+        return [canonicalise(v) for v in value]  # type: ignore
+    return value
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(
+        value, sort_keys=True, separators=(",", ":")
+    )
+
+
+def structural_key(manipulator: Manipulator) -> str:
+    """Hash of what decides whether a canonical manipulator matches an event."""
+    identity = _dumps(
+        [
+            manipulator.get("from", {}),
+            manipulator.get("conditions", []),
+        ]
+    )
+    return hashlib.blake2b(
+        identity.encode(), digest_size=12
+    ).hexdigest()
+
+
+def index(config: Dict[str, Any]) -> Dict[str, List[Entry]]:
+    entries: Dict[str, List[Entry]] = {}
+    for position, (description, manipulator) in enumerate(
+        iter_manipulators(config)
+    ):
+        manipulator = canonicalise(manipulator)
+        key = structural_key(manipulator)
+        entries.setdefault(key, []).append(
+            Entry(
+                position=position,
+                description=description,
+                key=key,
+                manipulator=manipulator,
+            )
+        )
+    return entries
+
+
+def _modifiers(manipulator: Manipulator) -> ModifierMask:
+    return ModifierMask.from_event(
+        manipulator.get("from", {})
+    )
+
+
+def modifiers_overlap(
+    a: Manipulator, b: Manipulator
+) -> bool:
+    return _modifiers(a).overlaps(_modifiers(b))
+
+
+def variables_overlap(
+    a: Manipulator, b: Manipulator
+) -> bool:
+    required: Dict[str, Any] = {}
+    excluded: Set[Tuple[str, str]] = set()
+    for condition in a.get("conditions", []) + b.get(
+        "conditions", []
+    ):
+        name = condition.get("name")
+        value = _dumps(condition.get("value"))
+        if condition.get("type") == "variable_if":
+            if required.setdefault(name, value) != value:
+                return False
+        elif condition.get("type") == "variable_unless":
+            excluded.add((name, value))
+    return not any(
+        (name, value) in excluded
+        for name, value in required.items()
+    )
+
+
+def overlaps(a: Manipulator, b: Manipulator) -> bool:
+    """Whether some key event in some state can match both manipulators."""
+    if not (is_catch_all(a) or is_catch_all(b)):
+        if from_key(a) != from_key(b):
+            return False
+    return modifiers_overlap(a, b) and variables_overlap(
+        a, b
+    )
+
+
+Pair = Tuple[Entry, Entry]
+
+
+def _flipped(a: Pair, b: Pair) -> Optional[OrderChange]:
+    (old_a, new_a), (old_b, new_b) = sorted(
+        (a, b), key=lambda pair: pair[1]["position"]
+    )
+    if old_a["position"] < old_b["position"]:
+        return None
+    if not overlaps(
+        new_a["manipulator"], new_b["manipulator"]
+    ):
+        return None
+    return OrderChange(
+        was_first=old_b["description"],
+        now_first=new_a["description"],
+    )
+
+
+def _order_changes(
+    old: Dict[str, List[Entry]],
+    new: Dict[str, List[Entry]],
+) -> List[OrderChange]:
+    """Overlapping manipulator pairs present in both configs whose order flipped.
+
+    Candidates for overlap are found through a second level of hashing. Exact
+    manipulators only overlap others with the same key_code and modifier set,
+    loose ones are checked against their whole key_code and catch-alls against
+    everything.
+    """
+    exact: Dict[Tuple[Any, int], List[Pair]] = {}
+    loose: Dict[Any, List[Pair]] = {}
+    catch_alls: List[Pair] = []
+    for key in old.keys() & new.keys():
+        pair = (old[key][0], new[key][0])
+        manipulator = pair[1]["manipulator"]
+        key_code = from_key(manipulator)
+        if is_catch_all(manipulator):
+            catch_alls.append(pair)
+        elif _modifiers(manipulator).is_exact:
+            bucket = (
+                key_code,
+                _modifiers(manipulator).required,
+            )
+            exact.setdefault(bucket, []).append(pair)
+        else:
+            loose.setdefault(key_code, []).append(pair)
+
+    candidates: List[Tuple[Pair, Pair]] = []
+    for pairs in list(exact.values()) + list(
+        loose.values()
+    ):
+        candidates.extend(itertools.combinations(pairs, 2))
+    for (key_code, _), pairs in exact.items():
+        candidates.extend(
+            itertools.product(
+                loose.get(key_code, []), pairs
+            )
+        )
+    candidates.extend(itertools.combinations(catch_alls, 2))
+    for pairs in list(exact.values()) + list(
+        loose.values()
+    ):
+        candidates.extend(
+            itertools.product(catch_alls, pairs)
+        )
+
+    changes: List[OrderChange] = []
+    for a, b in candidates:
+        change = _flipped(a, b)
+        if change is not None:
+            changes.append(change)
+    return changes
+
+
+def _flatten(
+    value: Dict[str, Any], prefix: str = ""
+) -> Dict[str, Any]:
+    flat: Dict[str, Any] = {}
+    for k, v in value.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + "."))  # type: ignore
+        else:
+            flat[prefix + k] = canonicalise(v)
+    return flat
+
+
+def _settings(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Everything in the selected profile except the rules, by dotted path."""
+    profile = dict(selected_profile(config))
+    complex_modifications = dict(
+        profile.pop("complex_modifications", {})
+    )
+    complex_modifications.pop("rules", None)
+    profile["complex_modifications"] = complex_modifications
+    return _flatten(
+        {
+            "global": config.get("global", {}),
+            "profile": profile,
+        }
+    )
+
+
+def diff(
+    old_config: Dict[str, Any], new_config: Dict[str, Any]
+) -> Diff:
+    old = index(old_config)
+    new = index(new_config)
+
+    added: List[str] = []
+    removed: List[str] = []
+    changed: List[Change] = []
+    for key in new.keys() - old.keys():
+        added.extend(e["description"] for e in new[key])
+    for key in old.keys() - new.keys():
+        removed.extend(e["description"] for e in old[key])
+    for key in new.keys() & old.keys():
+        old_entries, new_entries = old[key], new[key]
+        for old_entry, new_entry in zip(
+            old_entries, new_entries
+        ):
+            fields: Dict[str, List[Any]] = {}
+            old_m = old_entry["manipulator"]
+            new_m = new_entry["manipulator"]
+            for field in sorted(
+                old_m.keys() | new_m.keys()
+            ):
+                if old_m.get(field) != new_m.get(field):
+                    fields[field] = [
+                        old_m.get(field),
+                        new_m.get(field),
+                    ]
+            if (
+                fields
+                or old_entry["description"]
+                != new_entry["description"]
+            ):
+                changed.append(
+                    Change(
+                        key=key,
+                        old_description=old_entry[
+                            "description"
+                        ],
+                        new_description=new_entry[
+                            "description"
+                        ],
+                        fields=fields,
+                    )
+                )
+        added.extend(
+            e["description"]
+            for e in new_entries[len(old_entries) :]
+        )
+        removed.extend(
+            e["description"]
+            for e in old_entries[len(new_entries) :]
+        )
+
+    old_settings = _settings(old_config)
+    new_settings = _settings(new_config)
+    settings_changed = sorted(
+        name
+        for name in old_settings.keys()
+        | new_settings.keys()
+        if old_settings.get(name) != new_settings.get(name)
+    )
+
+    return Diff(
+        added=sorted(added),
+        removed=sorted(removed),
+        changed=sorted(
+            changed, key=lambda c: c["new_description"]
+        ),
+        order_changes=_order_changes(old, new),
+        settings_changed=settings_changed,
+    )
+
+
+def diff_files(old_path: str, new_path: str) -> Diff:
+    with open(old_path) as old_file, open(
+        new_path
+    ) as new_file:
+        return diff(
+            json.load(old_file), json.load(new_file)
+        )
+
+
+def is_empty(result: Diff) -> bool:
+    return not any(result.values())
+
+
+def format_diff(result: Diff) -> str:
+    lines: List[str] = []
+    for description in result["added"]:
+        lines.append("+ " + description)
+    for description in result["removed"]:
+        lines.append("- " + description)
+    for change in result["changed"]:
+        if (
+            change["old_description"]
+            != change["new_description"]
+        ):
+            lines.append(
+                "~ %s (was: %s)"
+                % (
+                    change["new_description"],
+                    change["old_description"],
+                )
+            )
+        else:
+            lines.append("~ " + change["new_description"])
+        for field, (old_value, new_value) in change[
+            "fields"
+        ].items():
+            lines.append(
+                "    %s: %s -> %s"
+                % (
+                    field,
+                    _dumps(old_value),
+                    _dumps(new_value),
+                )
+            )
+    for order_change in result["order_changes"]:
+        lines.append(
+            "^ %s now matches before %s"
+            % (
+                order_change["now_first"],
+                order_change["was_first"],
+            )
+        )
+    for name in result["settings_changed"]:
+        lines.append("* profile setting changed: " + name)
+    return "\n".join(lines)
+
+
+def to_json(result: Diff) -> str:
+    return json.dumps(result, indent=4)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    result = diff_files(args.old, args.new)
+    print(
+        to_json(result)
+        if args.json
+        else format_diff(result)
+    )
+    return 0 if is_empty(result) else 1
@@ -0,0 +1,348 @@
+"""Check that two generated configs behave the same under the replay model.
+
+Every (state, step) pair over the variables' domains is replayed on both configs,
+which covers every reachable emacs_mode/select_mode state. Random key sequences
+from the initial state are replayed on top of that. Both sweeps are spread over a
+process pool, each worker parses the two configs once.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+import argparse
+import collections
+import itertools
+import random
+
+from .replay import (
+    WAIT,
+    Engine,
+    KeyPress,
+    ProducedEvent,
+    State,
+    Step,
+)
+
+# Keys no manipulator consumes, to check that they still pass through.
+ORDINARY_KEYS = [
+    "a",
+    "j",
+    "1",
+    "spacebar",
+    "return_or_enter",
+]
+
+
+@dataclass(frozen=True)
+class Mismatch:
+    start: State
+    steps: Tuple[Step, ...]
+    old: Tuple[Tuple[ProducedEvent, ...], State]
+    new: Tuple[Tuple[ProducedEvent, ...], State]
+
+    def __str__(self) -> str:
+        return "\n".join(
+            [
+                "from %s: %s"
+                % (
+                    self.start,
+                    " ".join(str(s) for s in self.steps),
+                ),
+                "    old: %s -> %s"
+                % (_events(self.old[0]), self.old[1]),
+                "    new: %s -> %s"
+                % (_events(self.new[0]), self.new[1]),
+            ]
+        )
+
+
+def _events(events: Sequence[ProducedEvent]) -> str:
+    return (
+        "["
+        + ", ".join(
+            "+".join(e[2:] + e[1:2]) for e in events
+        )
+        + "]"
+    )
+
+
+def _run(
+    engine: Engine, start: State, steps: Sequence[Step]
+) -> Tuple[Tuple[ProducedEvent, ...], State]:
+    trace, state = engine.run(start, steps)
+    return (
+        tuple(itertools.chain.from_iterable(trace)),
+        state,
+    )
+
+
+def states(engines: Sequence[Engine]) -> List[State]:
+    """Every combination of variable values (unset included) and pending delayed action."""
+    domains: Dict[str, List[Any]] = {}
+    pending: List[Optional[str]] = [None]
+    for engine in engines:
+        for (
+            name,
+            values,
+        ) in engine.variable_domains().items():
+            domain = domains.setdefault(name, [None])
+            domain.extend(
+                v for v in values if v not in domain
+            )
+        for manipulator in engine.manipulators:
+            if manipulator.delayed not in pending:
+                pending.append(manipulator.delayed)
+    names = sorted(domains)
+    result: List[State] = []
+    for values in itertools.product(
+        *(domains[name] for name in names)
+    ):
+        variables = tuple(
+            (name, value)
+            for name, value in zip(names, values)
+            if value is not None
+        )
+        for delayed in pending:
+            result.append(State(variables, delayed))
+    return result
+
+
+def alphabet(engines: Sequence[Engine]) -> List[Step]:
+    """Every consumed key_code plus a few ordinary keys, under every modifier combination."""
+    key_codes: List[str] = []
+    modifiers: List[str] = []
+    for engine in engines:
+        key_codes.extend(
+            k
+            for k in engine.key_codes()
+            if k not in key_codes
+        )
+        modifiers.extend(
+            m
+            for m in engine.modifiers()
+            if m not in modifiers
+        )
+    key_codes.extend(
+        k for k in ORDINARY_KEYS if k not in key_codes
+    )
+    steps: List[Step] = [WAIT]
+    for n in range(len(modifiers) + 1):
+        for combination in itertools.combinations(
+            sorted(modifiers), n
+        ):
+            for key_code in key_codes:
+                steps.append(
+                    KeyPress(
+                        key_code, frozenset(combination)
+                    )
+                )
+    return steps
+
+
+_engines: Tuple[Engine, Engine]
+_alphabet: List[Step]
+
+
+def _init_worker(old_path: str, new_path: str) -> None:
+    global _engines, _alphabet
+    _engines = (
+        Engine.load(old_path),
+        Engine.load(new_path),
+    )
+    _alphabet = alphabet(_engines)
+
+
+def _sweep_state(state: State) -> List[Mismatch]:
+    old, new = _engines
+    mismatches: List[Mismatch] = []
+    for step in _alphabet:
+        old_result = _run(old, state, [step])
+        new_result = _run(new, state, [step])
+        if old_result != new_result:
+            mismatches.append(
+                Mismatch(
+                    state, (step,), old_result, new_result
+                )
+            )
+    return mismatches
+
+
+def _random_walks(
+    args: Tuple[int, int, int],
+) -> List[Mismatch]:
+    seed, count, length = args
+    old, new = _engines
+    rng = random.Random(seed)
+    mismatches: List[Mismatch] = []
+    for _ in range(count):
+        steps = [
+            rng.choice(_alphabet) for _ in range(length)
+        ]
+        old_result = _run(old, State(), steps)
+        new_result = _run(new, State(), steps)
+        if old_result != new_result:
+            mismatches.append(
+                _shrink(old, new, State(), steps)
+            )
+    return mismatches
+
+
+def _shrink(
+    old: Engine,
+    new: Engine,
+    start: State,
+    steps: List[Step],
+) -> Mismatch:
+    """Drop steps one at a time while the configs still disagree."""
+    i = 0
+    while i < len(steps):
+        candidate = steps[:i] + steps[i + 1 :]
+        if _run(old, start, candidate) != _run(
+            new, start, candidate
+        ):
+            steps = candidate
+        else:
+            i += 1
+    return Mismatch(
+        start,
+        tuple(steps),
+        _run(old, start, steps),
+        _run(new, start, steps),
+    )
+
+
+def shortest_paths(
+    engine: Engine, steps: Sequence[Step], start: State
+) -> Dict[State, Tuple[Step, ...]]:
+    """Breadth first search for the shortest step sequence reaching each state."""
+    paths: Dict[State, Tuple[Step, ...]] = {start: ()}
+    queue = collections.deque([start])
+    while queue:
+        state = queue.popleft()
+        for step in steps:
+            _, next_state = engine.step(state, step)
+            if next_state not in paths:
+                paths[next_state] = paths[state] + (step,)
+                queue.append(next_state)
+    return paths
+
+
+def _minimise(
+    mismatch: Mismatch,
+    old: Engine,
+    new: Engine,
+    paths: Dict[State, Tuple[Step, ...]],
+) -> Mismatch:
+    """Prefix the mismatch with the shortest path from the initial state, if any."""
+    prefix = paths.get(mismatch.start)
+    if prefix is None:
+        return mismatch
+    steps = prefix + mismatch.steps
+    return Mismatch(
+        State(),
+        steps,
+        _run(old, State(), steps),
+        _run(new, State(), steps),
+    )
+
+
+@dataclass
+class Result:
+    states: int
+    steps: int
+    walks: int
+    mismatches: List[Mismatch]
+
+
+def check(
+    old_path: str,
+    new_path: str,
+    walks: int = 1000,
+    length: int = 8,
+    seed: int = 0,
+    jobs: Optional[int] = None,
+) -> Result:
+    old = Engine.load(old_path)
+    new = Engine.load(new_path)
+    all_states = states([old, new])
+    steps = alphabet([old, new])
+
+    found: List[Mismatch] = []
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(old_path, new_path),
+    ) as pool:
+        sweeps = pool.map(_sweep_state, all_states)
+        chunks = [
+            (seed + i, min(100, walks - i * 100), length)
+            for i in range((walks + 99) // 100)
+        ]
+        randoms = pool.map(_random_walks, chunks)
+        for mismatches in itertools.chain(sweeps, randoms):
+            found.extend(mismatches)
+
+    # The random walks usually rediscover what the sweep found.
+    paths = shortest_paths(old, steps, State())
+    unique: Dict[
+        Tuple[State, Tuple[Step, ...]], Mismatch
+    ] = {}
+    for mismatch in found:
+        mismatch = _minimise(mismatch, old, new, paths)
+        unique.setdefault(
+            (mismatch.start, mismatch.steps), mismatch
+        )
+    minimal = sorted(
+        unique.values(),
+        # Counterexamples reachable from the initial state first
+        key=lambda m: (
+            m.start != State(),
+            len(m.steps),
+            str(m),
+        ),
+    )
+    return Result(
+        states=len(all_states),
+        steps=len(steps),
+        walks=walks,
+        mismatches=minimal,
+    )
+
+
+def format_result(result: Result, limit: int = 10) -> str:
+    lines = [
+        "%d states x %d steps swept, %d random walks: %d mismatches"
+        % (
+            result.states,
+            result.steps,
+            result.walks,
+            len(result.mismatches),
+        )
+    ]
+    for mismatch in result.mismatches[:limit]:
+        lines.append(str(mismatch))
+    if len(result.mismatches) > limit:
+        lines.append(
+            "... %d more" % (len(result.mismatches) - limit)
+        )
+    return "\n".join(lines)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    result = check(
+        args.old,
+        args.new,
+        walks=args.walks,
+        length=args.length,
+        seed=args.seed,
+        jobs=args.jobs,
+    )
+    print(format_result(result))
+    return 1 if result.mismatches else 0
@@ -8,6 +8,7 @@ from typing import (
     Union,
     NotRequired,
 )
+from .catalog import check_event
 from .keys import MODIFIER_KEYS, KeyCode, Modifier
 
 
@@ -28,11 +29,30 @@ class ProducibleKeyEvent(KeyEvent):
     """
 
     modifiers: NotRequired[List[Modifier]]
+    # A lazy modifier is only sent together with another key.
+    # Used for the hold side of tap/hold keys, so holding the key alone sends nothing.
+    lazy: NotRequired[bool]
 
 
-class ConsumableKeyEvent(KeyEvent):
-    """This is a key event that karabiner consumes."""
+class SimultaneousOptions(TypedDict, total=False):
+    """Karabiner's defaults are insensitive orders and key_up_when "any"."""
 
+    detect_key_down_uninterruptedly: bool
+    key_down_order: Literal["insensitive", "strict", "strict_inverse"]
+    key_up_order: Literal["insensitive", "strict", "strict_inverse"]
+    key_up_when: Literal["any", "all"]
+
+
+class ConsumableKeyEvent(TypedDict):
+    """This is a key event that karabiner consumes.
+
+    Either a single key_code, or a chord of keys pressed together within
+    basic.simultaneous_threshold_milliseconds.
+    """
+
+    key_code: NotRequired[KeyCode]
+    simultaneous: NotRequired[List[KeyEvent]]
+    simultaneous_options: NotRequired[SimultaneousOptions]
     # A consumable key even has the concept of mandatory and optional modifiers.
     # The optional modifier just allows more lenient detection of the key event.
     modifiers: NotRequired[
@@ -49,6 +69,18 @@ def __init__key_event(
 
     This logic is just a helper function to reduce boilerplate for handling symbols.
     """
+    if "key_code" not in raw_dict:
+        # A chord, only plain symbols can be part of one
+        for key in raw_dict["simultaneous"]:  # type: ignore
+            symbol = key["key_code"]
+            key["key_code"], modifier = translate_symbols(symbol)
+            if modifier:
+                raise Exception(
+                    "Shifted symbols cannot be part of a chord: "
+                    + symbol
+                )
+        check_event(raw_dict)  # type: ignore
+        return raw_dict
     raw_dict["key_code"], modifier = translate_symbols(
         raw_dict["key_code"]
     )
@@ -62,6 +94,8 @@ def __init__key_event(
             )
         else:
             raise Exception("Unknown type for modifiers")
+    # Karabiner silently skips rules with names it does not know
+    check_event(raw_dict)  # type: ignore
     return raw_dict
 
 
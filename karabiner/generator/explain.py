@@ -0,0 +1,251 @@
+"""Explain which manipulator handles a key press, and why.
+
+An index from (key_code, variable state) to the manipulators whose conditions
+hold there, in evaluation order, is built for every combination of the values
+the config compares its variables against. A query then only tests the
+modifier masks of those candidates: the first one whose modifiers match wins,
+the others that match too are shadowed by it.
+
+The index and the compiled Engine are pickled to __pycache__ next to the
+config, keyed on a hash of its content and of the code building them, so only
+the first query after a change pays for building them.
+"""
+
+from dataclasses import dataclass
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+import argparse
+import itertools
+import json
+import sys
+
+from . import modifiers, replay, report
+from .cache import load_cached
+from .modifiers import held_mask
+from .replay import (
+    WAIT,
+    CompiledManipulator,
+    Engine,
+    KeyPress,
+    ProducedEvent,
+    State,
+    Step,
+    Variables,
+    Wait,
+    _apply,
+    _set,
+    parse_key_press,
+    parse_state,
+)
+
+CACHE_MAGIC = b"KCEX"
+# Variable states beyond this are looked up on demand instead
+MAX_STATES = 4096
+
+# (key_code, variables), None standing for key codes no manipulator names
+IndexKey = Tuple[Optional[str], Variables]
+
+
+def _states(engine: Engine) -> Iterator[Variables]:
+    domains = engine.variable_domains()
+    for values in itertools.product(*domains.values()):
+        variables: Variables = ()
+        for name, value in zip(domains, values):
+            variables = _set(variables, name, value)
+        yield variables
+
+
+class ExplainIndex:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.key_codes = frozenset(engine.key_codes())
+        self.index: Dict[IndexKey, Tuple[int, ...]] = {}
+        for variables in itertools.islice(
+            _states(engine), MAX_STATES
+        ):
+            for key_code in list(self.key_codes) + [None]:
+                self.index[(key_code, variables)] = (
+                    self._candidates(key_code, variables)
+                )
+
+    def _candidates(
+        self, key_code: Optional[str], variables: Variables
+    ) -> Tuple[int, ...]:
+        state = State(variables)
+        return tuple(
+            m.position
+            for m in self.engine.candidates(key_code)
+            if m.matches_conditions(state)
+        )
+
+    def candidates(
+        self, key_code: str, variables: Variables
+    ) -> List[CompiledManipulator]:
+        """Manipulators whose key and conditions match, in evaluation order."""
+        key: IndexKey = (
+            (
+                key_code
+                if key_code in self.key_codes
+                else None
+            ),
+            variables,
+        )
+        positions = self.index.get(key)
+        if positions is None:
+            positions = self.index[key] = self._candidates(
+                *key
+            )
+        return [
+            self.engine.manipulators[p] for p in positions
+        ]
+
+    def explain(
+        self, state: State, step: Step
+    ) -> "Explanation":
+        matching: List[CompiledManipulator] = []
+        if isinstance(step, KeyPress):
+            variables = state.variables
+            if state.pending is not None:
+                # The pending delayed action is canceled before matching
+                variables = _apply(
+                    json.loads(state.pending).get(
+                        "to_if_canceled", []
+                    ),
+                    variables,
+                    frozenset(),
+                    [],
+                )
+            held = held_mask(step.modifiers)
+            matching = [
+                m
+                for m in self.candidates(
+                    step.key_code, variables
+                )
+                if m.modifiers.consume(held) is not None
+            ]
+        winner, produced, after = self.engine.resolve(
+            state, step
+        )
+        if winner is not (
+            matching[0] if matching else None
+        ):
+            raise Exception(
+                "The explain index disagrees with the engine on %s in %s"
+                % (step, state)
+            )
+        return Explanation(
+            step=step,
+            before=state,
+            winner=winner,
+            shadowed=matching[1:],
+            produced=produced,
+            after=after,
+        )
+
+
+@dataclass
+class Explanation:
+    step: Step
+    before: State
+    winner: Optional[CompiledManipulator]
+    # Manipulators that match too but come after the winner
+    shadowed: List[CompiledManipulator]
+    produced: List[ProducedEvent]
+    after: State
+
+
+def load_index(path: str) -> ExplainIndex:
+    """Build the index of the config, or load it if neither the config nor this code changed."""
+    return load_cached(
+        path,
+        ".explain",
+        CACHE_MAGIC,
+        [sys.modules[__name__], modifiers, replay, report],
+        lambda source: ExplainIndex(
+            Engine(json.loads(source))
+        ),
+    )
+
+
+def parse_steps(keys: Sequence[str]) -> List[Step]:
+    """Parse "right_control+x", or "wait" for the delayed action timeout."""
+    return [
+        WAIT if key == "wait" else parse_key_press(key)
+        for key in keys
+    ]
+
+
+def explain(
+    index: ExplainIndex, state: State, steps: Sequence[Step]
+) -> List[Explanation]:
+    explanations: List[Explanation] = []
+    for step in steps:
+        explanation = index.explain(state, step)
+        explanations.append(explanation)
+        state = explanation.after
+    return explanations
+
+
+def _manipulator(manipulator: CompiledManipulator) -> str:
+    return "#%d %s" % (
+        manipulator.position,
+        manipulator.description,
+    )
+
+
+def format_explanations(
+    explanations: List[Explanation],
+) -> str:
+    lines: List[str] = []
+    for explanation in explanations:
+        lines.append(
+            "%s in %s"
+            % (explanation.step, explanation.before)
+        )
+        if isinstance(explanation.step, Wait):
+            # The pending delayed action, if any, was invoked
+            pass
+        elif explanation.winner is None:
+            lines.append(
+                "  no manipulator matches, passed through"
+            )
+        else:
+            lines.append(
+                "  wins      "
+                + _manipulator(explanation.winner)
+            )
+            for shadowed in explanation.shadowed:
+                lines.append(
+                    "  shadowed  " + _manipulator(shadowed)
+                )
+        lines.append(
+            "  produces  "
+            + (
+                ", ".join(
+                    "+".join(e[2:] + e[1:2])
+                    for e in explanation.produced
+                )
+                or "nothing"
+            )
+        )
+        lines.append("  state     %s" % explanation.after)
+    return "\n".join(lines)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    print(
+        format_explanations(
+            explain(
+                load_index(args.config),
+                parse_state(args.state),
+                parse_steps(args.keys),
+            )
+        )
+    )
+    return 0
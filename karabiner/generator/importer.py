@@ -0,0 +1,433 @@
+"""Import existing karabiner.json and rule-set files into Modifications.
+
+Both a full karabiner.json and a complex modification rule-set file
+({"title": ..., "rules": [...]}) are read as a stream: the input is scanned
+chunk by chunk for `"rules": [` and the rules of that array are decoded one at a
+time, so only a single rule is ever held as text.
+
+Identical events, conditions and condition lists are interned while importing,
+every occurrence shares one object. The imported structures must therefore be
+copied before they are mutated, as Utils.select_mode_variant and
+optimise already do.
+"""
+
+from dataclasses import dataclass, field
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import argparse
+import json
+import pprint
+import re
+import sys
+
+from .modification_utils import Manipulation, Modification
+from .optimise import optimise
+
+CHUNK_SIZE = 1 << 16
+
+_RULES_ARRAY = re.compile(r'(?<!\\)"rules"\s*:\s*\[')
+_SEPARATORS = " \t\r\n,"
+
+
+def iter_rules(
+    file: IO[str], profile: int = 0
+) -> Iterator[Dict[str, Any]]:
+    """Yield the rules of the `profile`th "rules" array of the file.
+
+    karabiner.json has one such array per profile, rule-set files only one.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    # Everything in front of pos has been consumed
+    pos = 0
+    eof = False
+    arrays_seen = 0
+    in_array = False
+
+    def read() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = file.read(CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return not eof
+
+    while True:
+        if not in_array:
+            match = _RULES_ARRAY.search(buffer, pos)
+            if match is None:
+                if eof:
+                    return
+                # Keep enough of the tail for a marker split across chunks
+                pos = max(pos, len(buffer) - 32)
+                read()
+                continue
+            pos = match.end()
+            in_array = True
+            arrays_seen += 1
+            continue
+
+        while (
+            pos < len(buffer) and buffer[pos] in _SEPARATORS
+        ):
+            pos += 1
+        if pos == len(buffer):
+            if not read():
+                raise Exception("Unterminated rules array")
+            continue
+        if buffer[pos] == "]":
+            pos += 1
+            in_array = False
+            if arrays_seen - 1 == profile:
+                return
+            continue
+        try:
+            rule, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read()
+            continue
+        if arrays_seen - 1 == profile:
+            yield rule
+
+
+class Interner:
+    """Hands out one shared object per distinct JSON value."""
+
+    def __init__(self) -> None:
+        self._table: Dict[str, Any] = {}
+        self.lookups = 0
+
+    def __call__(self, value: Any) -> Any:
+        self.lookups += 1
+        key = json.dumps(value, sort_keys=True)
+        return self._table.setdefault(key, value)
+
+    @property
+    def unique(self) -> int:
+        return len(self._table)
+
+
+def _import_manipulation(
+    manipulator: Dict[str, Any], intern: Interner
+) -> Manipulation:
+    manipulation: Dict[str, Any] = {}
+    for name, value in manipulator.items():
+        if name == "from":
+            value = intern(value)
+        elif name == "conditions":
+            value = intern([intern(c) for c in value])
+        elif name in (
+            "to",
+            "to_after_key_up",
+            "to_if_alone",
+            "to_if_held_down",
+        ):
+            value = [intern(event) for event in value]
+        elif name == "to_delayed_action":
+            value = {
+                kind: [intern(event) for event in events]
+                for kind, events in value.items()
+            }
+        manipulation[name] = value
+    return Manipulation(**manipulation)  # type: ignore
+
+
+@dataclass
+class Imported:
+    title: Optional[str]
+    modifications: List[Modification] = field(
+        default_factory=list
+    )
+    manipulators: int = 0
+    # Events and conditions looked up, and how many distinct ones were kept
+    interned_lookups: int = 0
+    interned_unique: int = 0
+
+
+def import_rules(path: str, profile: int = 0) -> Imported:
+    intern = Interner()
+    title = None
+    with open(path) as file:
+        head = file.read(CHUNK_SIZE)
+        match = re.search(
+            r'^\s*\{\s*"title"\s*:\s*("(?:[^"\\]|\\.)*")',
+            head,
+        )
+        if match:
+            title = json.loads(match.group(1))
+        file.seek(0)
+        imported = Imported(title=title)
+        for rule in iter_rules(file, profile):
+            manipulators = [
+                _import_manipulation(m, intern)
+                for m in rule.get("manipulators", [])
+            ]
+            imported.manipulators += len(manipulators)
+            imported.modifications.append(
+                Modification(
+                    description=rule.get("description", ""),
+                    manipulators=manipulators,
+                )
+            )
+    imported.interned_lookups = intern.lookups
+    imported.interned_unique = intern.unique
+    return imported
+
+
+def to_rule_set(
+    modifications: List[Modification], title: str
+) -> str:
+    """The community complex modification file format."""
+    return json.dumps(
+        {"title": title, "rules": modifications}, indent=4
+    )
+
+
+def _constructor(role: str, value: Any) -> Optional[str]:
+    """The generator helper an imported value is written with, if any."""
+    if role == "from":
+        # Catch-alls like {"any": "key_code"} stay plain dicts
+        if "key_code" in value or "simultaneous" in value:
+            return "ConsumableKeyEvent"
+        return None
+    if role == "condition":
+        if value.get("type") == "variable_if":
+            return "Condition"
+        return None
+    if "set_variable" in value:
+        return "SetVariable"
+    if "key_code" in value:
+        return "ProducibleKeyEvent"
+    return None
+
+
+class _PythonWriter:
+    def __init__(self, modifications: List[Modification]):
+        self.modifications = modifications
+        self.counts: Dict[int, int] = {}
+        self.names: Dict[int, str] = {}
+        self.hoisted: List[Tuple[str, str]] = []
+        for _, value in self._shared_values():
+            self.counts[id(value)] = (
+                self.counts.get(id(value), 0) + 1
+            )
+
+    def _shared_values(self) -> Iterator[Tuple[str, Any]]:
+        for modification in self.modifications:
+            for manipulation in modification[
+                "manipulators"
+            ]:
+                for name, value in manipulation.items():
+                    if name == "from":
+                        yield "from", value
+                    elif name == "conditions":
+                        yield "conditions", value
+                        for condition in value:  # type: ignore
+                            yield "condition", condition
+                    elif isinstance(value, list):
+                        for event in value:
+                            yield "to", event
+                    elif name == "to_delayed_action":
+                        for events in value.values():  # type: ignore
+                            for event in events:
+                                yield "to", event
+
+    def _literal(self, value: Any, indent: int) -> str:
+        text = pprint.pformat(
+            value, width=60 - indent, sort_dicts=False
+        )
+        return text.replace("\n", "\n" + " " * indent)
+
+    def _render(
+        self, role: str, value: Any, indent: int
+    ) -> str:
+        if role == "conditions":
+            return (
+                "[\n"
+                + "".join(
+                    " " * (indent + 4)
+                    + self.expression(
+                        "condition", condition, indent + 4
+                    )
+                    + ",\n"
+                    for condition in value
+                )
+                + " " * indent
+                + "]"
+            )
+        constructor = _constructor(role, value)
+        if constructor is None:
+            return self._literal(value, indent)
+        return "%s(\n%s%s\n%s)" % (
+            constructor,
+            " " * (indent + 4),
+            self._literal(value, indent + 4),
+            " " * indent,
+        )
+
+    def expression(
+        self, role: str, value: Any, indent: int
+    ) -> str:
+        """Source for the value, hoisted to a module level name if it is shared."""
+        if id(value) in self.names:
+            return self.names[id(value)]
+        if self.counts.get(id(value), 0) <= 1:
+            return self._render(role, value, indent)
+        # Anything shared inside is hoisted first, so it is defined before use
+        text = self._render(role, value, 0)
+        name = "%s_%d" % (role, len(self.hoisted))
+        self.names[id(value)] = name
+        self.hoisted.append((name, text))
+        return name
+
+    def manipulation(
+        self, manipulation: Manipulation, indent: int
+    ) -> str:
+        pad = " " * (indent + 4)
+        lines = ["Manipulation("]
+        lines.append(pad + "{")
+        for name, value in manipulation.items():
+            if name == "from":
+                text = self.expression(
+                    "from", value, indent + 8
+                )
+            elif name == "conditions":
+                text = self.expression(
+                    "conditions", value, indent + 8
+                )
+            elif name == "to_delayed_action":
+                text = (
+                    "{\n"
+                    + "".join(
+                        " " * (indent + 12)
+                        + repr(kind)
+                        + ": "
+                        + self._events(events, indent + 12)
+                        + ",\n"
+                        for kind, events in value.items()  # type: ignore
+                    )
+                    + " " * (indent + 8)
+                    + "}"
+                )
+            elif isinstance(value, list):
+                text = self._events(value, indent + 8)
+            else:
+                text = repr(value)
+            lines.append(
+                " " * (indent + 8)
+                + "%r: %s," % (name, text)
+            )
+        lines.append(pad + "}")
+        lines.append(" " * indent + ")")
+        return "\n".join(lines)
+
+    def _events(
+        self, events: List[Any], indent: int
+    ) -> str:
+        return (
+            "[\n"
+            + "".join(
+                " " * (indent + 4)
+                + self.expression("to", event, indent + 4)
+                + ",\n"
+                for event in events
+            )
+            + " " * indent
+            + "]"
+        )
+
+    def write(self, source: str) -> str:
+        body: List[str] = []
+        for modification in self.modifications:
+            body.append("    Modification(")
+            body.append(
+                "        description=%r,"
+                % modification["description"]
+            )
+            body.append("        manipulators=[")
+            for manipulation in modification[
+                "manipulators"
+            ]:
+                body.append(
+                    " " * 12
+                    + self.manipulation(manipulation, 12)
+                    + ","
+                )
+            body.append("        ],")
+            body.append("    ),")
+
+        lines = [
+            '"""Imported from %s."""' % source,
+            "",
+            "from typing import List",
+            "",
+            "from generator.event_utils import (",
+            "    ConsumableKeyEvent,",
+            "    ProducibleKeyEvent,",
+            ")",
+            "from generator.modification_utils import (",
+            "    Condition,",
+            "    Manipulation,",
+            "    Modification,",
+            "    SetVariable,",
+            ")",
+            "",
+        ]
+        for name, text in self.hoisted:
+            lines.append("%s = %s" % (name, text))
+        if self.hoisted:
+            lines.append("")
+        lines.append(
+            "modifications: List[Modification] = ["
+        )
+        lines.extend(body)
+        lines.append("]")
+        return "\n".join(lines) + "\n"
+
+
+def to_python(
+    modifications: List[Modification], source: str
+) -> str:
+    """Python source building the same modifications with the generator helpers.
+
+    Events and conditions used more than once become module level names.
+    """
+    return _PythonWriter(modifications).write(source)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    """Print the lifted rules as python or as a rule-set file."""
+    imported = import_rules(args.path, args.profile)
+    lifted = (
+        imported.modifications
+        if args.no_optimise
+        else optimise(imported.modifications)
+    )
+    print(
+        "%d rules, %d manipulators, %d of %d events and conditions unique"
+        % (
+            len(lifted),
+            imported.manipulators,
+            imported.interned_unique,
+            imported.interned_lookups,
+        ),
+        file=sys.stderr,
+    )
+    print(
+        to_python(lifted, args.path)
+        if args.format == "python"
+        else to_rule_set(
+            lifted,
+            args.title or imported.title or args.path,
+        )
+    )
+    return 0
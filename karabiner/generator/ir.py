@@ -0,0 +1,190 @@
+"""Shared intermediate representation of the keymaps for every output target.
+
+The IR is built once from the keymaps in events.py and the modifications of
+generate.py. Each backend (Karabiner, VSCode, IntelliJ) only reads from it, so
+the layers cannot drift apart.
+"""
+
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import dataclasses
+
+from .events import (
+    EmacsKeymap,
+    OsLevelKeymap,
+    STDEmacsKeyEvents,
+    STDIdeKeyEvents,
+    STDMacOSKeyEvents,
+    StdIdeKeymap,
+)
+from .modification_utils import Modification
+
+
+@dataclass(frozen=True)
+class IdeCommand:
+    vscode: str
+    # Already bound to the produced key in VSCode's default keymap
+    vscode_default: bool
+    intellij: str
+
+
+# What each StdIdeKeymap action runs in the IDEs
+IDE_COMMANDS: Dict[str, IdeCommand] = {
+    "action_search": IdeCommand(
+        "workbench.action.showCommands", True, "GotoAction"
+    ),
+    "rerun": IdeCommand(
+        "workbench.action.tasks.reRunTask", False, "Rerun"
+    ),
+    "format_file": IdeCommand(
+        "editor.action.formatDocument", True, "ReformatCode"
+    ),
+    "find_references": IdeCommand(
+        "editor.action.revealDefinition",
+        True,
+        "GotoDeclaration",
+    ),
+    "go_back": IdeCommand(
+        "workbench.action.navigateBack", True, "Back"
+    ),
+    "find_file": IdeCommand(
+        "workbench.action.quickOpen", True, "GotoFile"
+    ),
+    "find_symbol": IdeCommand(
+        "workbench.action.showAllSymbols",
+        True,
+        "GotoSymbol",
+    ),
+    "focus_next_window": IdeCommand(
+        "workbench.action.focusNextGroup",
+        False,
+        "NextSplitter",
+    ),
+    "find_in_files": IdeCommand(
+        "search.action.openEditor", False, "FindInPath"
+    ),
+    "toggle_comment": IdeCommand(
+        "editor.action.commentLine",
+        True,
+        "CommentByLineComment",
+    ),
+    "peek_type_defn": IdeCommand(
+        "editor.action.peekTypeDefinition",
+        False,
+        "QuickTypeDefinition",
+    ),
+    "select_next_match": IdeCommand(
+        "editor.action.addSelectionToNextFindMatch",
+        True,
+        "SelectNextOccurrence",
+    ),
+    "close_window": IdeCommand(
+        "workbench.action.closeEditorsInGroup",
+        True,
+        "CloseAllEditors",
+    ),
+}
+
+
+def keymap_fields(
+    emacs: EmacsKeymap = STDEmacsKeyEvents,
+    macos: OsLevelKeymap = STDMacOSKeyEvents,
+    ide: StdIdeKeymap = STDIdeKeyEvents,
+) -> Iterator[Tuple[str, Any, Any]]:
+    """Yield (field path, consumed event, produced event or None) for every emacs keymap field.
+
+    Multi key sequences are yielded as lists of events.
+    """
+    producible = {
+        "os_level_keymap": macos,
+        "std_ide_keymap": ide,
+    }
+    for keymap_field in dataclasses.fields(emacs):
+        keymap = getattr(emacs, keymap_field.name)
+        assert dataclasses.is_dataclass(keymap)
+        produced_keymap = producible.get(keymap_field.name)
+        for event_field in dataclasses.fields(keymap):
+            consumed = getattr(keymap, event_field.name)
+            produced = (
+                None
+                if produced_keymap is None
+                else getattr(
+                    produced_keymap, event_field.name
+                )
+            )
+            yield (
+                keymap_field.name + "." + event_field.name,
+                consumed,
+                produced,
+            )
+
+
+@dataclass(frozen=True)
+class Binding:
+    # e.g. "std_ide_keymap.rerun"
+    path: str
+    # Emacs key event(s) Karabiner consumes
+    consumed: Any
+    # Key event(s) Karabiner produces for the OS or IDE, if any
+    produced: Any
+    ide_command: Optional[IdeCommand]
+
+    @property
+    def action(self) -> str:
+        return self.path.rsplit(".", 1)[1]
+
+
+@dataclass(frozen=True)
+class KeymapIR:
+    bindings: Tuple[Binding, ...]
+    modifications: Tuple[Modification, ...]
+
+    @staticmethod
+    def build(
+        modifications: List[Modification],
+        keymaps: Optional[
+            Tuple[EmacsKeymap, OsLevelKeymap, StdIdeKeymap]
+        ] = None,
+    ) -> "KeymapIR":
+        """The keymaps default to the ones of events.py."""
+        bindings: List[Binding] = []
+        for path, consumed, produced in keymap_fields(
+            *(keymaps or ())
+        ):
+            keymap, action = path.split(".")
+            bindings.append(
+                Binding(
+                    path=path,
+                    consumed=consumed,
+                    produced=produced,
+                    ide_command=(
+                        IDE_COMMANDS.get(action)
+                        if keymap == "std_ide_keymap"
+                        else None
+                    ),
+                )
+            )
+        for binding in bindings:
+            if (
+                binding.path.startswith("std_ide_keymap.")
+                and binding.ide_command is None
+            ):
+                raise Exception(
+                    "No IDE command for " + binding.path
+                )
+        return KeymapIR(
+            bindings=tuple(bindings),
+            modifications=tuple(modifications),
+        )
+
+    def ide_bindings(self) -> Iterator[Binding]:
+        for binding in self.bindings:
+            if binding.ide_command is not None:
+                yield binding
@@ -0,0 +1,759 @@
+"""Declarative TOML source for the keymaps and the modification list.
+
+Layout of the file:
+* [emacs.<keymap>], [macos] and [ide] tables hold the keymaps of events.py,
+  one key event per field written as a Karabiner JSON event, e.g.
+  up = { key_code = "p", modifiers = { mandatory = ["right_control"] } }
+* [[modifications]] with a description and [[modifications.manipulators]], or
+  select_mode_variant_of = "<description>" in place of the manipulators
+* in a manipulator `from` is a reference like "emacs.os_level_keymap.up" or an
+  inline event, conditions are "name=value" strings and `to` holds references
+  like "macos.up", inline events or "set name=value"
+* tap/hold keys add to_if_alone and to_if_held_down, written like `to`, and
+  optionally a parameters table overriding the template's timing parameters
+* an inline `from` can be a chord, simultaneous = [{ key_code = "j" }, ...]
+
+Compiling validates everything against the keymap dataclasses, errors name the
+source line. The compiled structures are pickled to __pycache__ next to the
+source, keyed by a hash of the source and of the compiling code, so an
+unchanged file is not recompiled.
+"""
+
+from copy import deepcopy
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+import dataclasses
+import json
+import re
+import sys
+import tomllib
+import typing
+
+from . import (
+    catalog,
+    event_utils,
+    events,
+    keys,
+    modification_utils,
+    modifiers,
+)
+from .cache import load_cached
+from .catalog import check_modifiers
+from .event_utils import (
+    ConsumableKeyEvent,
+    ProducibleKeyEvent,
+)
+from .events import (
+    EmacsKeymap,
+    EmacsUniquesKeymap,
+    EmacsUtilsKeymap,
+    OsLevelKeymap,
+    StdIdeKeymap,
+)
+from .keys import MODIFIER_KEYS
+from .modification_utils import Manipulation, Modification
+
+CACHE_MAGIC = b"KCKM"
+
+EMACS_KEYMAPS: Dict[str, Type[Any]] = {
+    "os_level_keymap": OsLevelKeymap,
+    "std_ide_keymap": StdIdeKeymap,
+    "emacs_utils_keymap": EmacsUtilsKeymap,
+    "emacs_uniques_keymap": EmacsUniquesKeymap,
+}
+
+_MANIPULATION_KEYS = {
+    "type",
+    "conditions",
+    "from",
+    "to",
+    "to_delayed_action",
+    "to_if_alone",
+    "to_if_held_down",
+    "parameters",
+}
+
+# Fields holding a list of `to` events
+_TO_LISTS = {"to", "to_if_alone", "to_if_held_down"}
+
+_PARAMETERS = {
+    "basic.to_if_alone_timeout_milliseconds",
+    "basic.to_if_held_down_threshold_milliseconds",
+    "basic.simultaneous_threshold_milliseconds",
+}
+
+
+@dataclass
+class KeymapSource:
+    emacs: EmacsKeymap
+    macos: OsLevelKeymap
+    ide: StdIdeKeymap
+    modifications: List[Modification]
+
+
+def _line_index(text: str) -> Dict[str, int]:
+    """Map dotted paths like "modifications[3].manipulators[0].to" to lines."""
+    lines: Dict[str, int] = {}
+    counters: Dict[str, int] = {}
+    current: Dict[str, str] = {}
+    table = ""
+    for number, line in enumerate(
+        text.splitlines(), start=1
+    ):
+        stripped = line.strip()
+        header = re.match(
+            r"^\[\[\s*([^\]]+?)\s*\]\]", stripped
+        )
+        if header:
+            # Make the parent arrays concrete, "a.b" -> "a[2].b"
+            parts = header.group(1).split(".")
+            concrete = ""
+            for i, part in enumerate(parts):
+                concrete += ("." if concrete else "") + part
+                if (
+                    i < len(parts) - 1
+                    and concrete in current
+                ):
+                    concrete = current[concrete]
+            index = counters.get(concrete, 0)
+            counters[concrete] = index + 1
+            table = "%s[%d]" % (concrete, index)
+            current[header.group(1)] = table
+            current[concrete] = table
+            lines[table] = number
+            continue
+        header = re.match(r"^\[\s*([^\]]+?)\s*\]", stripped)
+        if header:
+            table = header.group(1)
+            lines.setdefault(table, number)
+            continue
+        key = re.match(
+            r'^("[^"]*"|[A-Za-z0-9_-]+)\s*=', stripped
+        )
+        if key:
+            name = key.group(1).strip('"')
+            lines[table + "." + name if table else name] = (
+                number
+            )
+    return lines
+
+
+class _Compiler:
+    def __init__(self, text: str, path: str):
+        self.path = path
+        self.lines = _line_index(text)
+        try:
+            self.data = tomllib.loads(text)
+        except tomllib.TOMLDecodeError as e:
+            line = re.search(r"at line (\d+)", str(e))
+            raise Exception(
+                "%s:%s: %s"
+                % (path, line.group(1) if line else "?", e)
+            )
+        # reference -> event object, shared by every use
+        self.refs: Dict[str, Any] = {}
+
+    def error(self, where: str, message: str) -> Exception:
+        path = where
+        while path and path not in self.lines:
+            path = re.sub(r"(\.[^.\[]*|\[\d+\])$", "", path)
+        return Exception(
+            "%s:%s: %s: %s"
+            % (
+                self.path,
+                self.lines.get(path, "?"),
+                where,
+                message,
+            )
+        )
+
+    def modifiers(
+        self, where: str, modifiers: Any
+    ) -> List[str]:
+        if not isinstance(modifiers, list) or not all(
+            isinstance(m, str) for m in modifiers
+        ):
+            raise self.error(
+                where, "expected a list of modifier names"
+            )
+        try:
+            check_modifiers(modifiers)
+        except Exception as e:
+            raise self.error(where, str(e))
+        return list(modifiers)
+
+    def event(
+        self, where: str, value: Any, consumable: bool
+    ) -> Dict[str, Any]:
+        if not isinstance(value, dict):
+            raise self.error(
+                where, "expected a key event table"
+            )
+        unknown = (
+            set(value)
+            - {
+                "key_code",
+                "any",
+                "modifiers",
+            }
+            - (
+                {"simultaneous", "simultaneous_options"}
+                if consumable
+                else {"lazy"}
+            )
+        )
+        if unknown:
+            raise self.error(
+                where,
+                "unknown event fields %s" % sorted(unknown),
+            )
+        if "simultaneous" in value:
+            if "key_code" in value or not all(
+                isinstance(key, dict)
+                and set(key) == {"key_code"}
+                and isinstance(key["key_code"], str)
+                for key in value["simultaneous"]
+            ):
+                raise self.error(
+                    where,
+                    'simultaneous must be [{ key_code = "..." }, ...] in place of key_code',
+                )
+        elif not isinstance(
+            value.get("key_code", value.get("any")), str
+        ):
+            raise self.error(
+                where, "key_code must be a string"
+            )
+        event = dict(value)
+        if "modifiers" in value:
+            if consumable:
+                if not isinstance(
+                    value["modifiers"], dict
+                ) or set(value["modifiers"]) - {
+                    "mandatory",
+                    "optional",
+                }:
+                    raise self.error(
+                        where,
+                        "modifiers must be { mandatory = [...], optional = [...] }",
+                    )
+                event["modifiers"] = {
+                    kind: self.modifiers(where, modifiers)
+                    for kind, modifiers in value[
+                        "modifiers"
+                    ].items()
+                }
+            else:
+                event["modifiers"] = self.modifiers(
+                    where, value["modifiers"]
+                )
+        if (
+            "key_code" not in event
+            and "simultaneous" not in event
+        ):
+            return event
+        try:
+            if consumable:
+                return ConsumableKeyEvent(event)  # type: ignore
+            return ProducibleKeyEvent(event)  # type: ignore
+        except Exception as e:
+            raise self.error(where, str(e))
+
+    def keymap(
+        self,
+        cls: Type[Any],
+        where: str,
+        table: Any,
+        consumable: bool,
+    ) -> Any:
+        if not isinstance(table, dict):
+            raise self.error(where, "missing keymap table")
+        fields = {
+            f.name: f for f in dataclasses.fields(cls)
+        }
+        unknown = set(table) - set(fields)
+        if unknown:
+            name = sorted(unknown)[0]
+            raise self.error(
+                where + "." + name,
+                "not a field of %s" % cls.__name__,
+            )
+        values: Dict[str, Any] = {}
+        for name, field in fields.items():
+            field_where = where + "." + name
+            if name not in table:
+                raise self.error(
+                    where, "missing field %r" % name
+                )
+            if typing.get_origin(field.type) is list:
+                if not isinstance(table[name], list):
+                    raise self.error(
+                        field_where,
+                        "expected a list of key events",
+                    )
+                values[name] = [
+                    self.event(field_where, e, consumable)
+                    for e in table[name]
+                ]
+                for i, event in enumerate(values[name]):
+                    self.refs[
+                        "%s[%d]" % (field_where, i)
+                    ] = event
+            else:
+                values[name] = self.event(
+                    field_where, table[name], consumable
+                )
+            self.refs[field_where] = values[name]
+        return cls(**values)
+
+    def condition(self, where: str, value: Any) -> Any:
+        if isinstance(value, dict):
+            return value
+        if not isinstance(value, str) or "=" not in value:
+            raise self.error(
+                where,
+                "expected 'name=value' or a condition table",
+            )
+        name, _, variable = value.partition("=")
+        return {
+            "type": "variable_if",
+            "name": name,
+            "value": variable,
+        }
+
+    def to_event(self, where: str, value: Any) -> Any:
+        if isinstance(value, dict):
+            return self.event(
+                where, value, consumable=False
+            )
+        if not isinstance(value, str):
+            raise self.error(
+                where, "expected a reference or a key event"
+            )
+        if value.startswith("set "):
+            name, _, variable = value[4:].partition("=")
+            if not name or not _:
+                raise self.error(
+                    where, "expected 'set name=value'"
+                )
+            return {
+                "set_variable": {
+                    "name": name,
+                    "value": variable,
+                }
+            }
+        if not value.startswith(("macos.", "ide.")):
+            raise self.error(
+                where,
+                "%r is not a macos. or ide. reference"
+                % value,
+            )
+        return self.reference(where, value)
+
+    def reference(self, where: str, value: str) -> Any:
+        if value not in self.refs:
+            raise self.error(
+                where, "unknown reference %r" % value
+            )
+        return self.refs[value]
+
+    def manipulation(
+        self, where: str, value: Any
+    ) -> Manipulation:
+        if not isinstance(value, dict):
+            raise self.error(where, "expected a table")
+        unknown = set(value) - _MANIPULATION_KEYS
+        if unknown:
+            raise self.error(
+                where,
+                "unknown manipulator fields %s"
+                % sorted(unknown),
+            )
+        for required in ("from", "to"):
+            if required not in value:
+                raise self.error(
+                    where, "missing %r" % required
+                )
+        manipulation: Dict[str, Any] = {}
+        for name, field in value.items():
+            field_where = where + "." + name
+            if name == "from":
+                if isinstance(
+                    field, str
+                ) and not field.startswith("emacs."):
+                    raise self.error(
+                        field_where,
+                        "%r is not an emacs. reference"
+                        % field,
+                    )
+                manipulation[name] = (
+                    self.reference(field_where, field)
+                    if isinstance(field, str)
+                    else self.event(
+                        field_where, field, consumable=True
+                    )
+                )
+            elif name == "conditions":
+                manipulation[name] = [
+                    self.condition(field_where, c)
+                    for c in field
+                ]
+            elif name in _TO_LISTS:
+                manipulation[name] = [
+                    self.to_event(field_where, e)
+                    for e in field
+                ]
+            elif name == "to_delayed_action":
+                manipulation[name] = {
+                    kind: [
+                        self.to_event(field_where, e)
+                        for e in events
+                    ]
+                    for kind, events in field.items()
+                }
+            elif name == "parameters":
+                if not isinstance(field, dict) or not all(
+                    isinstance(v, int)
+                    for v in field.values()
+                ):
+                    raise self.error(
+                        field_where,
+                        "expected a table of milliseconds",
+                    )
+                unknown = set(field) - _PARAMETERS
+                if unknown:
+                    raise self.error(
+                        field_where,
+                        "unknown parameters %s"
+                        % sorted(unknown),
+                    )
+                manipulation[name] = dict(field)
+            else:
+                manipulation[name] = field
+        return Manipulation(**manipulation)  # type: ignore
+
+    def select_mode_variant(
+        self,
+        where: str,
+        description: str,
+        modifications: List[Modification],
+    ) -> Modification:
+        """Same as Utils.select_mode_variant of generate.py."""
+        originals = [
+            m
+            for m in modifications
+            if m["description"] == description
+        ]
+        if len(originals) != 1:
+            raise self.error(
+                where,
+                "expected one modification %r before it, found %d"
+                % (description, len(originals)),
+            )
+        original = originals[0]
+        if (
+            len(original["manipulators"]) != 1
+            or len(
+                original["manipulators"][0].get(
+                    "conditions", []
+                )
+            )
+            != 1
+            or len(original["manipulators"][0]["to"]) != 1
+        ):
+            raise self.error(
+                where,
+                "%r needs one manipulator with one condition and one to event"
+                % description,
+            )
+        variant = deepcopy(original)
+        variant["description"] = (
+            "Select Mode: " + description
+        )
+        manipulation = variant["manipulators"][0]
+        manipulation["conditions"].append(  # type: ignore
+            self.condition(where, "select_mode=on")
+        )
+        to_event = manipulation["to"][0]
+        to_event["modifiers"] = to_event.get(  # type: ignore
+            "modifiers", []
+        ) + [
+            MODIFIER_KEYS.left_shift
+        ]
+        original["manipulators"][0]["conditions"].append(  # type: ignore
+            self.condition(where, "select_mode=off")
+        )
+        return variant
+
+    def compile(self) -> KeymapSource:
+        emacs_table = self.data.get("emacs")
+        if not isinstance(emacs_table, dict):
+            raise self.error(
+                "emacs", "missing [emacs.*] tables"
+            )
+        emacs = EmacsKeymap(
+            **{
+                name: self.keymap(
+                    cls,
+                    "emacs." + name,
+                    emacs_table.get(name),
+                    consumable=True,
+                )
+                for name, cls in EMACS_KEYMAPS.items()
+            }
+        )
+        macos = self.keymap(
+            OsLevelKeymap,
+            "macos",
+            self.data.get("macos"),
+            consumable=False,
+        )
+        ide = self.keymap(
+            StdIdeKeymap,
+            "ide",
+            self.data.get("ide"),
+            consumable=False,
+        )
+
+        modifications: List[Modification] = []
+        for i, entry in enumerate(
+            self.data.get("modifications", [])
+        ):
+            where = "modifications[%d]" % i
+            if not isinstance(
+                entry.get("description"), str
+            ):
+                raise self.error(
+                    where, "missing description"
+                )
+            if "select_mode_variant_of" in entry:
+                modifications.append(
+                    self.select_mode_variant(
+                        where + ".select_mode_variant_of",
+                        entry["select_mode_variant_of"],
+                        modifications,
+                    )
+                )
+                continue
+            modifications.append(
+                Modification(
+                    description=entry["description"],
+                    manipulators=[
+                        self.manipulation(
+                            "%s.manipulators[%d]"
+                            % (where, j),
+                            manipulation,
+                        )
+                        for j, manipulation in enumerate(
+                            entry.get("manipulators", [])
+                        )
+                    ],
+                )
+            )
+        return KeymapSource(
+            emacs=emacs,
+            macos=macos,
+            ide=ide,
+            modifications=modifications,
+        )
+
+
+def compile_keymap(text: str, path: str) -> KeymapSource:
+    return _Compiler(text, path).compile()
+
+
+def load_keymap(path: str) -> KeymapSource:
+    """Compile the file, or load the compiled structures if neither it nor the compiler changed."""
+    return load_cached(
+        path,
+        ".cache",
+        CACHE_MAGIC,
+        [
+            sys.modules[__name__],
+            catalog,
+            event_utils,
+            events,
+            keys,
+            modification_utils,
+            modifiers,
+        ],
+        lambda source: compile_keymap(
+            source.decode(), path
+        ),
+    )
+
+
+def _toml_key(key: str) -> str:
+    if re.fullmatch(r"[A-Za-z0-9_-]+", key):
+        return key
+    return json.dumps(key)
+
+
+def _toml_value(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, list):
+        return "[%s]" % ", ".join(
+            _toml_value(v) for v in value
+        )
+    if isinstance(value, dict):
+        if not value:
+            return "{}"
+        return "{ %s }" % ", ".join(
+            "%s = %s" % (_toml_key(k), _toml_value(v))
+            for k, v in value.items()
+        )
+    raise Exception("Cannot write %r as TOML" % (value,))
+
+
+def _keymap_table(header: str, keymap: Any) -> List[str]:
+    lines = ["[%s]" % header]
+    for field in dataclasses.fields(keymap):
+        lines.append(
+            "%s = %s"
+            % (
+                field.name,
+                _toml_value(getattr(keymap, field.name)),
+            )
+        )
+    lines.append("")
+    return lines
+
+
+def export_keymap(
+    emacs: EmacsKeymap,
+    macos: OsLevelKeymap,
+    ide: StdIdeKeymap,
+    modifications: List[Modification],
+) -> str:
+    """Write the structures as keymap TOML.
+
+    Events shared with the keymaps become references and modifications that
+    look like select mode variants of an earlier one are written as such.
+    """
+    refs: Dict[int, str] = {}
+    lines = [
+        "# Keymaps and modifications of the karabiner config,",
+        "# see generator/keymap_file.py for the format.",
+        "",
+    ]
+    for name in EMACS_KEYMAPS:
+        keymap = getattr(emacs, name)
+        lines += _keymap_table("emacs." + name, keymap)
+        _collect_refs(refs, "emacs." + name, keymap)
+    lines += _keymap_table("macos", macos)
+    _collect_refs(refs, "macos", macos)
+    lines += _keymap_table("ide", ide)
+    _collect_refs(refs, "ide", ide)
+
+    by_description = {
+        m["description"]: m for m in modifications
+    }
+    variants_of = {
+        m["description"][len("Select Mode: ") :]
+        for m in modifications
+        if m["description"].startswith("Select Mode: ")
+        and m["description"][len("Select Mode: ") :]
+        in by_description
+    }
+    for modification in modifications:
+        description = modification["description"]
+        lines.append("[[modifications]]")
+        lines.append(
+            "description = %s" % _toml_value(description)
+        )
+        if (
+            description.startswith("Select Mode: ")
+            and description[len("Select Mode: ") :]
+            in variants_of
+        ):
+            lines.append(
+                "select_mode_variant_of = %s"
+                % _toml_value(
+                    description[len("Select Mode: ") :]
+                )
+            )
+            lines.append("")
+            continue
+        lines.append("")
+        for manipulation in modification["manipulators"]:
+            lines.append("[[modifications.manipulators]]")
+            for name, value in manipulation.items():
+                if name == "conditions":
+                    conditions = list(value)  # type: ignore
+                    if description in variants_of:
+                        # Added back by the select mode variant
+                        conditions = conditions[:-1]
+                    value = [
+                        _condition_source(c)
+                        for c in conditions
+                    ]
+                elif name == "from":
+                    value = refs.get(id(value), value)
+                elif name in _TO_LISTS:
+                    value = [
+                        _to_source(refs, e)
+                        for e in value  # type: ignore
+                    ]
+                elif name == "to_delayed_action":
+                    value = {
+                        kind: [
+                            _to_source(refs, e)
+                            for e in events
+                        ]
+                        for kind, events in value.items()  # type: ignore
+                    }
+                lines.append(
+                    "%s = %s"
+                    % (_toml_key(name), _toml_value(value))
+                )
+            lines.append("")
+    return "\n".join(lines)
+
+
+def _collect_refs(
+    refs: Dict[int, str], prefix: str, keymap: Any
+) -> None:
+    for field in dataclasses.fields(keymap):
+        value = getattr(keymap, field.name)
+        refs[id(value)] = prefix + "." + field.name
+        if isinstance(value, list):
+            for i, event in enumerate(value):
+                refs[id(event)] = "%s.%s[%d]" % (
+                    prefix,
+                    field.name,
+                    i,
+                )
+
+
+def _condition_source(condition: Dict[str, Any]) -> Any:
+    if condition.get("type") == "variable_if" and set(
+        condition
+    ) == {"type", "name", "value"}:
+        return "%s=%s" % (
+            condition["name"],
+            condition["value"],
+        )
+    return condition
+
+
+def _to_source(refs: Dict[int, str], event: Any) -> Any:
+    if id(event) in refs:
+        return refs[id(event)]
+    if set(event) == {"set_variable"}:
+        return "set %s=%s" % (
+            event["set_variable"]["name"],
+            event["set_variable"]["value"],
+        )
+    return event
@@ -0,0 +1,453 @@
+"""Merge third-party rule sets into the generated modifications.
+
+Every layer (the Emacs layer of generate.py, or a rule set imported from the
+complex modifications gallery) has a priority. Manipulators of different layers
+conflict when some key press in some state matches both: the same key_code,
+modifiers both accept once the optional ones are counted, and conditions that
+do not exclude each other. Only the manipulator of the highest priority layer
+is kept, the others are dropped from the output instead of being emitted behind
+it. Manipulators are indexed by key_code, only those of one key, and the
+catch-alls, are compared with each other, so merging stays close to linear in
+the number of manipulators.
+
+Besides variables, conditions on the frontmost application and on the device
+can exclude each other, gallery rule sets are mostly scoped by application.
+Application patterns are compared exactly when they are anchored and hold
+nothing but literal characters and `.`, like "^com.apple.Terminal$". Any other
+regular expression is assumed to match every application.
+"""
+
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import itertools
+import json
+
+from .diff import modifiers_overlap, variables_overlap
+from .modification_utils import Manipulation, Modification
+from .modifiers import ModifierMask
+from .report import from_key, is_catch_all
+
+# (key, sorted mandatory modifier masks, conditions), for reporting
+ConflictKey = Tuple[str, Tuple[int, ...], FrozenSet[str]]
+
+# A pattern as one entry per character, None for `.`
+_Pattern = Tuple[Optional[str], ...]
+
+_SPECIAL = set("^$*+?()[]{}|")
+
+
+@dataclass
+class _Owner:
+    priority: int
+    layer: str
+    description: str
+    manipulation: Manipulation
+    # Position in priority order, the first overlapping owner wins
+    order: int
+
+
+@dataclass
+class Layer:
+    name: str
+    priority: int
+    modifications: List[Modification]
+
+
+@dataclass
+class Conflict:
+    # Of the winner
+    key: ConflictKey
+    # (layer name, rule description)
+    winner: Tuple[str, str]
+    losers: List[Tuple[str, str]] = field(
+        default_factory=list
+    )
+
+
+@dataclass
+class MergeResult:
+    modifications: List[Modification]
+    conflicts: List[Conflict]
+    dropped: int
+
+
+def _input(manipulation: Manipulation) -> str:
+    """What the `from` event consumes, "any key_code" for a catch-all."""
+    event: Dict[str, Any] = manipulation["from"]  # type: ignore
+    key = from_key(manipulation)  # type: ignore
+    if key is not None:
+        return key
+    if "any" in event:
+        return "any " + event["any"]
+    return json.dumps(
+        {
+            k: v
+            for k, v in event.items()
+            if k != "modifiers"
+        },
+        sort_keys=True,
+    )
+
+
+def conflict_key(manipulation: Manipulation) -> ConflictKey:
+    event: Dict[str, Any] = manipulation["from"]  # type: ignore
+    return (
+        _input(manipulation),
+        tuple(
+            sorted(ModifierMask.from_event(event).mandatory)
+        ),
+        frozenset(
+            json.dumps(condition, sort_keys=True)
+            for condition in manipulation.get(
+                "conditions", []
+            )
+        ),
+    )
+
+
+def _parse_pattern(pattern: str) -> Optional[_Pattern]:
+    """An anchored pattern of literals and `.`, None for anything else."""
+    if not (
+        pattern.startswith("^")
+        and pattern.endswith("$")
+        and not pattern.endswith("\\$")
+    ):
+        return None
+    parsed: List[Optional[str]] = []
+    chars = iter(pattern[1:-1])
+    for char in chars:
+        if char == "\\":
+            escaped = next(chars, None)
+            if escaped is None or escaped.isalnum():
+                return None
+            parsed.append(escaped)
+        elif char == ".":
+            parsed.append(None)
+        elif char in _SPECIAL:
+            return None
+        else:
+            parsed.append(char)
+    return tuple(parsed)
+
+
+def _patterns_meet(a: str, b: str) -> bool:
+    """Whether some string can match both patterns."""
+    pa, pb = _parse_pattern(a), _parse_pattern(b)
+    if pa is None or pb is None:
+        return True
+    return len(pa) == len(pb) and all(
+        x is None or y is None or x == y
+        for x, y in zip(pa, pb)
+    )
+
+
+def _pattern_covers(a: str, b: str) -> bool:
+    """Whether every string matching b matches a."""
+    if a == b:
+        return True
+    pa, pb = _parse_pattern(a), _parse_pattern(b)
+    if pa is None or pb is None:
+        return False
+    return len(pa) == len(pb) and all(
+        x is None or x == y for x, y in zip(pa, pb)
+    )
+
+
+# (field, pattern) of a frontmost_application condition
+_AppScope = FrozenSet[Tuple[str, str]]
+
+
+def _app_scope(condition: Dict[str, Any]) -> _AppScope:
+    return frozenset(
+        (name, pattern)
+        for name in ("bundle_identifiers", "file_paths")
+        for pattern in condition.get(name, [])
+    )
+
+
+def _apps_meet(a: _AppScope, b: _AppScope) -> bool:
+    """Whether some application can be in both scopes."""
+    fields = {name for name, _ in a} | {
+        name for name, _ in b
+    }
+    # An application has a bundle identifier and a file path, scopes on
+    # different fields can always meet
+    if len(fields) > 1:
+        return True
+    return any(
+        _patterns_meet(x, y)
+        for (_, x), (_, y) in itertools.product(a, b)
+    )
+
+
+def _apps_cover(a: _AppScope, b: _AppScope) -> bool:
+    """Whether every application in scope b is in scope a."""
+    return all(
+        any(
+            name_a == name_b and _pattern_covers(x, y)
+            for name_a, x in a
+        )
+        for name_b, y in b
+    )
+
+
+def _devices_meet(
+    a: List[Dict[str, Any]], b: List[Dict[str, Any]]
+) -> bool:
+    """Whether some device can match an identifier of both lists."""
+    return any(
+        all(x[k] == y[k] for k in x.keys() & y.keys())
+        for x, y in itertools.product(a, b)
+    )
+
+
+def _devices_cover(
+    a: List[Dict[str, Any]], b: List[Dict[str, Any]]
+) -> bool:
+    """Whether every device matching an identifier of b matches one of a."""
+    return all(
+        any(
+            all(k in y and y[k] == v for k, v in x.items())
+            for x in a
+        )
+        for y in b
+    )
+
+
+def _conditions(
+    manipulation: Manipulation, kind: str
+) -> Iterator[Dict[str, Any]]:
+    for condition in manipulation.get("conditions", []):
+        if condition["type"] == kind:  # type: ignore
+            yield condition  # type: ignore
+
+
+def _scopes_overlap(
+    a: Manipulation, b: Manipulation
+) -> bool:
+    """Whether the application and device conditions of both can hold at once."""
+    for x, y in ((a, b), (b, a)):
+        for if_condition in _conditions(
+            x, "frontmost_application_if"
+        ):
+            scope = _app_scope(if_condition)
+            if any(
+                not _apps_meet(scope, _app_scope(other))
+                for other in _conditions(
+                    y, "frontmost_application_if"
+                )
+            ) or any(
+                _apps_cover(_app_scope(other), scope)
+                for other in _conditions(
+                    y, "frontmost_application_unless"
+                )
+            ):
+                return False
+        for if_condition in _conditions(x, "device_if"):
+            identifiers = if_condition["identifiers"]
+            if any(
+                not _devices_meet(
+                    identifiers, other["identifiers"]
+                )
+                for other in _conditions(y, "device_if")
+            ) or any(
+                _devices_cover(
+                    other["identifiers"], identifiers
+                )
+                for other in _conditions(y, "device_unless")
+            ):
+                return False
+    return True
+
+
+def _same_input(a: Manipulation, b: Manipulation) -> bool:
+    if is_catch_all(a) or is_catch_all(b):  # type: ignore
+        # A catch-all only takes key codes
+        return all(
+            is_catch_all(m) or from_key(m) is not None  # type: ignore
+            for m in (a, b)
+        )
+    return _input(a) == _input(b)
+
+
+def conflicts_with(
+    a: Manipulation, b: Manipulation
+) -> bool:
+    """Whether some key press in some state, application and device matches both."""
+    return (
+        _same_input(a, b)
+        and modifiers_overlap(a, b)  # type: ignore
+        and variables_overlap(a, b)  # type: ignore
+        and _scopes_overlap(a, b)
+    )
+
+
+def parse_layer_spec(spec: str) -> Tuple[str, int]:
+    """Split "path=priority", the priority defaults to 0."""
+    path, _, priority = spec.rpartition("=")
+    if not path:
+        return spec, 0
+    try:
+        return path, int(priority)
+    except ValueError:
+        raise Exception(
+            "Expected <path>=<priority>, got " + spec
+        )
+
+
+def merge(layers: List[Layer]) -> MergeResult:
+    """Merge the layers, the highest priority first in the output.
+
+    Layers of equal priority keep their given order. Conflicts between layers of
+    equal priority cannot be resolved and raise.
+    """
+    ordered = sorted(
+        enumerate(layers),
+        key=lambda item: (-item[1].priority, item[0]),
+    )
+    # input -> the manipulators kept for it so far, highest priority first
+    owners: Dict[str, List[_Owner]] = {}
+    # Kept catch-alls, which meet every key
+    catch_alls: List[_Owner] = []
+    conflicts: Dict[int, Conflict] = {}
+    merged: List[Modification] = []
+    dropped = 0
+    kept_count = 0
+
+    for _, layer in ordered:
+        for modification in layer.modifications:
+            kept: List[Manipulation] = []
+            for manipulation in modification[
+                "manipulators"
+            ]:
+                if is_catch_all(manipulation):  # type: ignore
+                    candidates = list(
+                        itertools.chain(
+                            *owners.values(), catch_alls
+                        )
+                    )
+                    bucket = catch_alls
+                else:
+                    bucket = owners.setdefault(
+                        _input(manipulation), []
+                    )
+                    candidates = bucket + catch_alls
+                # Within a layer the author's order decides
+                owner = min(
+                    (
+                        o
+                        for o in candidates
+                        if o.layer != layer.name
+                        and conflicts_with(
+                            o.manipulation, manipulation
+                        )
+                    ),
+                    key=lambda o: o.order,
+                    default=None,
+                )
+                if owner is None:
+                    bucket.append(
+                        _Owner(
+                            layer.priority,
+                            layer.name,
+                            modification["description"],
+                            manipulation,
+                            kept_count,
+                        )
+                    )
+                    kept_count += 1
+                    kept.append(manipulation)
+                    continue
+                if owner.priority == layer.priority:
+                    raise Exception(
+                        "%r of %s and %r of %s both match %s, give the layers different priorities"
+                        % (
+                            owner.description,
+                            owner.layer,
+                            modification["description"],
+                            layer.name,
+                            _format_key(
+                                conflict_key(manipulation)
+                            ),
+                        )
+                    )
+                conflicts.setdefault(
+                    id(owner),
+                    Conflict(
+                        key=conflict_key(
+                            owner.manipulation
+                        ),
+                        winner=(
+                            owner.layer,
+                            owner.description,
+                        ),
+                    ),
+                ).losers.append(
+                    (
+                        layer.name,
+                        modification["description"],
+                    )
+                )
+                dropped += 1
+            if kept:
+                merged.append(
+                    Modification(
+                        description=modification[
+                            "description"
+                        ],
+                        manipulators=kept,
+                    )
+                )
+    return MergeResult(
+        modifications=merged,
+        conflicts=list(conflicts.values()),
+        dropped=dropped,
+    )
+
+
+def _format_key(key: ConflictKey) -> str:
+    key_code, mandatory, conditions = key
+    text = "+".join(
+        ModifierMask(mandatory).to_lists()[0] + [key_code]
+    )
+    if conditions:
+        text += " if " + ", ".join(
+            (
+                "%s=%s" % (c["name"], c["value"])
+                if c.get("type") == "variable_if"
+                else json.dumps(c)
+            )
+            for c in (
+                json.loads(c) for c in sorted(conditions)
+            )
+        )
+    return text
+
+
+def format_conflicts(result: MergeResult) -> str:
+    lines = [
+        "%d conflicts, %d manipulators dropped"
+        % (len(result.conflicts), result.dropped)
+    ]
+    for conflict in result.conflicts:
+        lines.append(
+            "%s: %s (%s) wins over %s"
+            % (
+                _format_key(conflict.key),
+                conflict.winner[1],
+                conflict.winner[0],
+                ", ".join(
+                    "%s (%s)" % (description, name)
+                    for name, description in conflict.losers
+                ),
+            )
+        )
+    return "\n".join(lines)
@@ -0,0 +1,242 @@
+"""Exhaustive model check of the emacs_mode/select_mode state machine.
+
+The state machine is extracted by replaying every key of the alphabet from every
+reachable state, breadth first from the initial states: all variables unset, as
+after Karabiner starts, and the home state every clearing manipulator writes.
+Neither has to be reachable from the other. Transitions are memoised so each
+(state, step) pair is only replayed once.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Set, Tuple
+import argparse
+import collections
+
+from .equivalence import alphabet
+from .replay import (
+    WAIT,
+    Engine,
+    KeyPress,
+    ProducedEvent,
+    State,
+    Step,
+    Variables,
+    parse_state,
+)
+
+# Keys that are typed all the time and should never silently disappear
+COMMON_KEYS = list(
+    "abcdefghijklmnopqrstuvwxyz0123456789"
+) + [
+    "spacebar",
+    "return_or_enter",
+    "delete_or_backspace",
+    "tab",
+    "period",
+    "comma",
+]
+COMMON_MODIFIERS = [
+    frozenset(),
+    frozenset({"left_shift"}),
+    frozenset({"right_shift"}),
+]
+
+
+@dataclass
+class StateMachine:
+    initials: List[State]
+    states: List[State]
+    # state -> step -> (produced events, next state)
+    transitions: Dict[
+        State,
+        Dict[Step, Tuple[List[ProducedEvent], State]],
+    ] = field(default_factory=dict)
+
+
+def explore(
+    engine: Engine, steps: List[Step], initials: List[State]
+) -> StateMachine:
+    initials = list(dict.fromkeys(initials))
+    machine = StateMachine(
+        initials=initials, states=list(initials)
+    )
+    seen = set(initials)
+    queue = collections.deque(initials)
+    while queue:
+        state = queue.popleft()
+        outgoing = machine.transitions.setdefault(state, {})
+        for step in steps:
+            produced, next_state = engine.step(state, step)
+            outgoing[step] = (produced, next_state)
+            if next_state not in seen:
+                seen.add(next_state)
+                machine.states.append(next_state)
+                queue.append(next_state)
+    return machine
+
+
+def _key_reachable(
+    machine: StateMachine, start: State
+) -> Set[State]:
+    """States reachable from `start` through key presses only."""
+    reachable = {start}
+    queue = collections.deque([start])
+    while queue:
+        state = queue.popleft()
+        for step, (_, next_state) in machine.transitions[
+            state
+        ].items():
+            if step is WAIT or next_state in reachable:
+                continue
+            reachable.add(next_state)
+            queue.append(next_state)
+    return reachable
+
+
+def _is_home(state: State, home: Variables) -> bool:
+    return all(
+        state.get(name) == value for name, value in home
+    )
+
+
+@dataclass
+class Findings:
+    states: int
+    transitions: int
+    prefix_variable: str
+    # No key press changes the variables, only the timeout does
+    stuck: List[State] = field(default_factory=list)
+    # No sequence of key presses gets back to the home state
+    no_way_home: List[State] = field(default_factory=list)
+    # Key events were produced in a prefix mode but the mode was not cleared
+    missed_clears: List[Tuple[State, Step, State]] = field(
+        default_factory=list
+    )
+    # state -> common keys that produce no key event
+    swallowed: Dict[State, List[KeyPress]] = field(
+        default_factory=dict
+    )
+
+
+def check(
+    engine: Engine,
+    home: Variables = (
+        ("emacs_mode", "none"),
+        ("select_mode", "off"),
+    ),
+    prefix_variable: str = "emacs_mode",
+) -> Findings:
+    steps = alphabet([engine])
+    common = [
+        KeyPress(key_code, modifiers)
+        for modifiers in COMMON_MODIFIERS
+        for key_code in COMMON_KEYS
+    ]
+    steps.extend(s for s in common if s not in steps)
+    machine = explore(
+        engine, steps, [State(), State(tuple(sorted(home)))]
+    )
+
+    home_value = dict(home).get(prefix_variable)
+    findings = Findings(
+        states=len(machine.states),
+        transitions=sum(
+            len(t) for t in machine.transitions.values()
+        ),
+        prefix_variable=prefix_variable,
+    )
+    for state in machine.states:
+        reachable = _key_reachable(machine, state)
+        if state not in machine.initials and all(
+            other.variables == state.variables
+            for other in reachable
+        ):
+            findings.stuck.append(state)
+        if state not in machine.initials and not any(
+            _is_home(other, home) for other in reachable
+        ):
+            findings.no_way_home.append(state)
+
+        mode = state.get(prefix_variable)
+        for step, (
+            produced,
+            next_state,
+        ) in machine.transitions[state].items():
+            if (
+                mode not in (None, home_value)
+                and produced
+                and next_state.get(prefix_variable) == mode
+            ):
+                findings.missed_clears.append(
+                    (state, step, next_state)
+                )
+
+        swallowed = [
+            key_press
+            for key_press in common
+            if not any(
+                event[0] == "key_code"
+                for event in machine.transitions[state][
+                    key_press
+                ][0]
+            )
+        ]
+        if swallowed:
+            findings.swallowed[state] = swallowed
+    return findings
+
+
+def has_errors(findings: Findings) -> bool:
+    return bool(
+        findings.stuck
+        or findings.no_way_home
+        or findings.missed_clears
+    )
+
+
+def format_findings(findings: Findings) -> str:
+    lines = [
+        "%d reachable states, %d transitions"
+        % (findings.states, findings.transitions)
+    ]
+    for state in findings.stuck:
+        lines.append(
+            "STUCK    %s: only the timeout leaves this state"
+            % state
+        )
+    for state in findings.no_way_home:
+        lines.append(
+            "LOST     %s: no key sequence returns to the home state"
+            % state
+        )
+    for state, step, next_state in findings.missed_clears:
+        lines.append(
+            "NO CLEAR %s: %s produces events but keeps %s=%s, next %s"
+            % (
+                state,
+                step,
+                findings.prefix_variable,
+                next_state.get(findings.prefix_variable),
+                next_state,
+            )
+        )
+    for state, key_presses in findings.swallowed.items():
+        lines.append(
+            "SWALLOW  %s: %d common keys produce nothing (%s)"
+            % (
+                state,
+                len(key_presses),
+                " ".join(str(k) for k in key_presses[:8])
+                + (" ..." if len(key_presses) > 8 else ""),
+            )
+        )
+    return "\n".join(lines)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    findings = check(
+        Engine.load(args.path),
+        home=parse_state(args.home).variables,
+    )
+    print(format_findings(findings))
+    return 1 if has_errors(findings) else 0
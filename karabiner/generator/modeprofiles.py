@@ -0,0 +1,368 @@
+"""Experimental: compile the emacs modes into Karabiner profiles of their own.
+
+In the generated config every manipulator of every mode is a candidate for
+every keystroke, the mode conditions are only checked once the `from` event
+matched. Here each value of the mode variable gets a profile holding only the
+manipulators whose conditions allow that value, without the then redundant mode
+conditions. Setting the mode variable becomes a switch to that mode's profile,
+through karabiner_cli in a shell_command.
+
+Karabiner has no way to turn rules on and off at runtime other than conditions,
+so switching profiles is the only mechanism that shrinks the rule set. It comes
+at a price: the switch runs a process, so a key typed right after the prefix
+may still reach the old profile, and other variables are not carried between
+profiles by this model. Compare the candidate counts before relying on it.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
+import argparse
+import copy
+import json
+
+from .equivalence import alphabet
+from .modelcheck import COMMON_KEYS
+from .replay import (
+    Engine,
+    KeyPress,
+    State,
+    Variables,
+    parse_state,
+)
+from .report import iter_manipulators, selected_profile
+
+KARABINER_CLI = "'/Library/Application Support/org.pqrs/Karabiner-Elements/bin/karabiner_cli'"
+
+# Manipulator fields holding event lists
+_EVENT_LISTS = ("to", "to_if_alone", "to_if_held_down")
+
+
+def mode_values(
+    config: Dict[str, Any], variable: str
+) -> List[Any]:
+    """Every value the config compares or sets the variable to, in order of appearance."""
+    values: List[Any] = []
+
+    def add(value: Any) -> None:
+        if value not in values:
+            values.append(value)
+
+    for _, manipulator in iter_manipulators(config):
+        for condition in manipulator.get("conditions", []):
+            if condition.get("name") == variable:
+                add(condition["value"])
+        for events in _event_lists(manipulator):
+            for event in events:
+                if (
+                    event.get("set_variable", {}).get(
+                        "name"
+                    )
+                    == variable
+                ):
+                    add(event["set_variable"]["value"])
+    return values
+
+
+def _event_lists(
+    manipulator: Dict[str, Any],
+) -> List[List[Dict[str, Any]]]:
+    lists = [
+        manipulator[name]
+        for name in _EVENT_LISTS
+        if name in manipulator
+    ]
+    lists.extend(
+        manipulator.get("to_delayed_action", {}).values()
+    )
+    return lists
+
+
+def _allows(
+    manipulator: Dict[str, Any], variable: str, value: Any
+) -> bool:
+    for condition in manipulator.get("conditions", []):
+        if condition.get("name") != variable:
+            continue
+        if (
+            condition["type"] == "variable_if"
+            and condition["value"] != value
+        ):
+            return False
+        if (
+            condition["type"] == "variable_unless"
+            and condition["value"] == value
+        ):
+            return False
+    return True
+
+
+def profile_name(base: str, value: Any, home: Any) -> str:
+    if value == home:
+        return base
+    return "%s (%s)" % (base, value)
+
+
+def _switch(name: str) -> Dict[str, Any]:
+    return {
+        "shell_command": "%s --select-profile '%s'"
+        % (KARABINER_CLI, name)
+    }
+
+
+def _rewrite(
+    events: List[Dict[str, Any]],
+    variable: str,
+    value: Any,
+    names: Dict[Any, str],
+) -> List[Dict[str, Any]]:
+    rewritten: List[Dict[str, Any]] = []
+    for event in events:
+        target = event.get("set_variable", {})
+        if target.get("name") != variable:
+            rewritten.append(event)
+        elif target["value"] != value:
+            rewritten.append(
+                _switch(names[target["value"]])
+            )
+    return rewritten
+
+
+def mode_profile(
+    config: Dict[str, Any],
+    variable: str,
+    value: Any,
+    names: Dict[Any, str],
+) -> Dict[str, Any]:
+    """The selected profile, reduced to the manipulators of one mode."""
+    profile = copy.deepcopy(selected_profile(config))
+    profile["name"] = names[value]
+    profile["selected"] = False
+    rules = []
+    for rule in profile.get(
+        "complex_modifications", {}
+    ).get("rules", []):
+        manipulators = []
+        for manipulator in rule.get("manipulators", []):
+            if not _allows(manipulator, variable, value):
+                continue
+            manipulator["conditions"] = [
+                c
+                for c in manipulator.get("conditions", [])
+                if c.get("name") != variable
+            ]
+            if not manipulator["conditions"]:
+                del manipulator["conditions"]
+            for name in _EVENT_LISTS:
+                if name in manipulator:
+                    manipulator[name] = _rewrite(
+                        manipulator[name],
+                        variable,
+                        value,
+                        names,
+                    )
+            delayed = manipulator.get(
+                "to_delayed_action", {}
+            )
+            for kind in delayed:
+                delayed[kind] = _rewrite(
+                    delayed[kind], variable, value, names
+                )
+            manipulators.append(manipulator)
+        if manipulators:
+            rule["manipulators"] = manipulators
+            rules.append(rule)
+    if "complex_modifications" in profile:
+        profile["complex_modifications"]["rules"] = rules
+    return profile
+
+
+def compile_profiles(
+    config: Dict[str, Any], variable: str, home: Any
+) -> Dict[str, Any]:
+    """The config with one profile per value of the mode variable, the home one selected."""
+    base = selected_profile(config).get("name", "Default")
+    values = mode_values(config, variable)
+    if home not in values:
+        values.insert(0, home)
+    names = {
+        value: profile_name(base, value, home)
+        for value in values
+    }
+    profiles = [
+        mode_profile(config, variable, value, names)
+        for value in values
+    ]
+    profiles[values.index(home)]["selected"] = True
+    compiled = dict(config)
+    compiled["profiles"] = [
+        p
+        for p in config.get("profiles", [])
+        if p is not selected_profile(config)
+    ] + profiles
+    return compiled
+
+
+@dataclass
+class Strategy:
+    name: str
+    manipulators: int
+    # Per keystroke: manipulators whose `from` event had to be tested
+    candidates: List[int]
+    # Per keystroke: manipulators Karabiner walks past before the match
+    scanned: List[int]
+
+
+def _measure(
+    name: str,
+    engine: Engine,
+    state: State,
+    keystrokes: List[KeyPress],
+) -> Strategy:
+    candidates: List[int] = []
+    scanned: List[int] = []
+    for key_press in keystrokes:
+        tested = engine.candidates(key_press.key_code)
+        winner, _ = engine.match(state, key_press)
+        if winner is None:
+            candidates.append(len(tested))
+            scanned.append(len(engine.manipulators))
+        else:
+            candidates.append(tested.index(winner) + 1)
+            scanned.append(winner.position + 1)
+    return Strategy(
+        name=name,
+        manipulators=len(engine.manipulators),
+        candidates=candidates,
+        scanned=scanned,
+    )
+
+
+@dataclass
+class Comparison:
+    variable: str
+    home: Any
+    keystrokes: int
+    # Manipulators of every mode's profile
+    profiles: Dict[str, int]
+    strategies: List[Strategy]
+
+
+def compare(
+    config: Dict[str, Any],
+    home: Variables,
+    variable: str = "emacs_mode",
+    compiled: Optional[Dict[str, Any]] = None,
+) -> Comparison:
+    """Candidate counts of every keystroke in the home state, in one profile and in mode profiles."""
+    home_value = dict(home).get(variable)
+    if compiled is None:
+        compiled = compile_profiles(
+            config, variable, home_value
+        )
+    single = Engine(config)
+    keystrokes = [
+        step
+        for step in alphabet([single])
+        if isinstance(step, KeyPress)
+    ]
+    seen: Set[KeyPress] = set(keystrokes)
+    for key_code in COMMON_KEYS:
+        key_press = KeyPress(key_code, frozenset())
+        if key_press not in seen:
+            keystrokes.append(key_press)
+            seen.add(key_press)
+    state = State(home)
+
+    base = selected_profile(config).get("name", "Default")
+    names = {
+        profile_name(base, value, home_value)
+        for value in mode_values(config, variable)
+        + [home_value]
+    }
+    profiles: Dict[str, int] = {}
+    for profile in compiled["profiles"]:
+        if profile.get("name") in names:
+            profiles[profile["name"]] = sum(
+                1
+                for _ in iter_manipulators(
+                    {"profiles": [profile]}
+                )
+            )
+    return Comparison(
+        variable=variable,
+        home=home_value,
+        keystrokes=len(keystrokes),
+        profiles=profiles,
+        strategies=[
+            _measure(
+                "single profile", single, state, keystrokes
+            ),
+            _measure(
+                "mode profiles",
+                Engine(compiled),
+                state,
+                keystrokes,
+            ),
+        ],
+    )
+
+
+def format_comparison(comparison: Comparison) -> str:
+    lines = [
+        "%d keystrokes with %s=%s"
+        % (
+            comparison.keystrokes,
+            comparison.variable,
+            comparison.home,
+        ),
+        "",
+        "%-16s %12s %18s %18s"
+        % (
+            "strategy",
+            "manipulators",
+            "candidates mean/max",
+            "scanned mean/max",
+        ),
+    ]
+    for strategy in comparison.strategies:
+        lines.append(
+            "%-16s %12d %13.2f %4d %13.2f %4d"
+            % (
+                strategy.name,
+                strategy.manipulators,
+                sum(strategy.candidates)
+                / max(1, len(strategy.candidates)),
+                max(strategy.candidates, default=0),
+                sum(strategy.scanned)
+                / max(1, len(strategy.scanned)),
+                max(strategy.scanned, default=0),
+            )
+        )
+    lines.append("")
+    for name, manipulators in comparison.profiles.items():
+        lines.append(
+            "profile %-30s %d manipulators"
+            % (repr(name), manipulators)
+        )
+    return "\n".join(lines)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    with open(args.path) as file:
+        config = json.load(file)
+    home = parse_state(args.home).variables
+    compiled = compile_profiles(
+        config,
+        args.variable,
+        dict(home).get(args.variable),
+    )
+    print(
+        format_comparison(
+            compare(config, home, args.variable, compiled)
+        )
+    )
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(compiled, file, indent=4)
+            file.write("\n")
+    return 0
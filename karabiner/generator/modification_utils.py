@@ -31,6 +31,21 @@ class ToDelayedAction(TypedDict):
     to_if_canceled: NotRequired[List[SetVariable]]
 
 
+# Parameter names contain dots so using the functional syntax
+ManipulationParameters = TypedDict(
+    "ManipulationParameters",
+    {
+        # to_if_alone is only sent if the key is released within this time
+        "basic.to_if_alone_timeout_milliseconds": int,
+        # to_if_held_down is sent once the key is held for this long
+        "basic.to_if_held_down_threshold_milliseconds": int,
+        # Keys of a simultaneous chord must all go down within this time
+        "basic.simultaneous_threshold_milliseconds": int,
+    },
+    total=False,
+)
+
+
 # from is a reserved keyword so using this workaround
 FromWorkaround = TypedDict(
     "From", {"from": ConsumableKeyEvent}
@@ -44,6 +59,13 @@ class Manipulation(FromWorkaround):
     # from: List[ConsumableKeyEvent]
     to: List[Union[ProducibleKeyEvent, SetVariable]]
     to_delayed_action: NotRequired[ToDelayedAction]
+    # Tap/hold: `to` is sent on key down, usually a lazy modifier for the hold.
+    # to_if_alone is sent on release if no other key was pressed in between.
+    to_if_alone: NotRequired[List[ProducibleKeyEvent]]
+    # Sent if the key is held past the threshold without another key.
+    to_if_held_down: NotRequired[List[ProducibleKeyEvent]]
+    # Overrides the profile wide parameters of the template for this manipulator
+    parameters: NotRequired[ManipulationParameters]
 
 
 class Modification(TypedDict):
@@ -0,0 +1,187 @@
+"""Karabiner modifiers as bitmasks.
+
+Every side specific modifier gets one bit, an either side modifier like
+`command` stands for both of its sides. A `from` event's modifiers become a
+ModifierMask: one mask per mandatory modifier, in order, and the mask of the
+modifiers that may be held on top. Matching the held modifiers of a key press
+then takes a few integer operations per mandatory modifier.
+
+Karabiner consumes the held modifiers mandatory by mandatory: a side specific
+one needs its bit, an either side one takes every held side of it. Whatever
+is left must be optional.
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from .keys import Modifier
+
+# Side specific modifiers, in bit order
+SIDES: Tuple[Modifier, ...] = (
+    "left_command",
+    "right_command",
+    "left_control",
+    "right_control",
+    "left_option",
+    "right_option",
+    "left_shift",
+    "right_shift",
+    "fn",
+    "caps_lock",
+)
+
+BITS: Dict[Modifier, int] = {
+    modifier: 1 << i for i, modifier in enumerate(SIDES)
+}
+ALL = (1 << len(SIDES)) - 1
+
+# Modifiers that match either side of the keyboard
+EITHER_SIDE: Dict[Modifier, FrozenSet[Modifier]] = {
+    "command": frozenset({"left_command", "right_command"}),
+    "control": frozenset({"left_control", "right_control"}),
+    "option": frozenset({"left_option", "right_option"}),
+    "shift": frozenset({"left_shift", "right_shift"}),
+}
+
+BITS.update(
+    {
+        either: sum(BITS[side] for side in sides)
+        for either, sides in EITHER_SIDE.items()
+    }
+)
+
+
+def mask(modifiers: Iterable[Modifier]) -> int:
+    bits = 0
+    for modifier in modifiers:
+        bit = BITS.get(modifier)
+        if bit is None:
+            raise Exception("Unknown modifier: " + modifier)
+        bits |= bit
+    return bits
+
+
+@lru_cache(maxsize=None)
+def held_mask(modifiers: FrozenSet[Modifier]) -> int:
+    """The mask of held modifiers, cached as traces repeat the same few."""
+    return mask(modifiers)
+
+
+@lru_cache(maxsize=None)
+def names(bits: int) -> FrozenSet[Modifier]:
+    """The side specific modifiers of a mask."""
+    return frozenset(
+        modifier
+        for modifier in SIDES
+        if bits & BITS[modifier]
+    )
+
+
+def _collapsed(bits: int) -> List[Modifier]:
+    """The names of a mask, both sides of a modifier as its either side name."""
+    collapsed: List[Modifier] = []
+    for either in EITHER_SIDE:
+        if bits & BITS[either] == BITS[either]:
+            collapsed.append(either)
+            bits &= ~BITS[either]
+    return collapsed + [
+        modifier
+        for modifier in SIDES
+        if bits & BITS[modifier]
+    ]
+
+
+@dataclass(frozen=True)
+class ModifierMask:
+    # One mask per mandatory modifier, in order
+    mandatory: Tuple[int, ...] = ()
+    # Modifiers that may be held on top, ALL for "any"
+    optional: int = 0
+
+    @staticmethod
+    def from_lists(
+        mandatory: Iterable[Modifier],
+        optional: Iterable[Modifier] = (),
+    ) -> "ModifierMask":
+        optional = list(optional)
+        return ModifierMask(
+            mandatory=tuple(mask([m]) for m in mandatory),
+            optional=(
+                ALL if "any" in optional else mask(optional)
+            ),
+        )
+
+    @staticmethod
+    def from_event(event: Dict[str, Any]) -> "ModifierMask":
+        """The modifiers of a `from` event."""
+        modifiers = event.get("modifiers", {})
+        return ModifierMask.from_lists(
+            modifiers.get("mandatory", []),
+            modifiers.get("optional", []),
+        )
+
+    def to_lists(
+        self,
+    ) -> Tuple[List[Modifier], List[Modifier]]:
+        """(mandatory, optional) modifier names, the optional ones in canonical order."""
+        return [_collapsed(m)[0] for m in self.mandatory], (
+            ["any"]
+            if self.optional == ALL
+            else _collapsed(self.optional)
+        )
+
+    @property
+    def required(self) -> int:
+        """Side specific mandatory modifiers."""
+        bits = 0
+        for m in self.mandatory:
+            if m & (m - 1) == 0:
+                bits |= m
+        return bits
+
+    @property
+    def allowed(self) -> int:
+        """Every modifier that may be held."""
+        bits = self.optional
+        for m in self.mandatory:
+            bits |= m
+        return bits
+
+    @property
+    def is_exact(self) -> bool:
+        """Only matches the exact set of its side specific mandatory modifiers."""
+        return self.optional == 0 and all(
+            m & (m - 1) == 0 for m in self.mandatory
+        )
+
+    def consume(self, held: int) -> Optional[int]:
+        """The held modifiers not consumed by the mandatory ones, or None if it does not match."""
+        for m in self.mandatory:
+            pressed = held & m
+            if not pressed:
+                return None
+            held &= ~pressed
+        if held & ~self.optional:
+            return None
+        return held
+
+    def matches(self, held: int) -> bool:
+        return self.consume(held) is not None
+
+    def overlaps(self, other: "ModifierMask") -> bool:
+        """Whether some held modifiers match both.
+
+        Holding more of the allowed modifiers only satisfies more mandatory
+        ones, so checking every modifier both allow is enough.
+        """
+        held = self.allowed & other.allowed
+        return self.matches(held) and other.matches(held)
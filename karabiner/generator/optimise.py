@@ -0,0 +1,196 @@
+"""Cost model and optimiser for the `to` lists of manipulators.
+
+Every key event in a `to` list is a synthetic event that travels through the OS
+and the focused application, while `set_variable` stays inside Karabiner.
+Karabiner may consume the key events a manipulator produces again (see
+ProducibleKeyEvent), so the variables they see must stay what they were. The
+optimiser keeps the order of the events and only drops writes nothing can
+observe:
+* in a run of `set_variable`s, every write but the last per variable
+* in the run the `to` list starts with, a write of the value the conditions
+  already guarantee
+"""
+
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypedDict,
+)
+
+from .modification_utils import Manipulation, Modification
+
+KEY_EVENT_COST = 1.0
+SET_VARIABLE_COST = 0.05
+# shell_command, software_function and the like
+OTHER_EVENT_COST = 5.0
+
+
+class ToCost(TypedDict):
+    key_events: int
+    set_variables: int
+    other_events: int
+    cost: float
+    # Events emitted before the first key event, which they delay
+    before_first_key_event: Optional[int]
+
+
+def to_cost(to: List[Any]) -> ToCost:
+    key_events = set_variables = other_events = 0
+    before_first_key_event: Optional[int] = None
+    for i, event in enumerate(to):
+        if "key_code" in event:
+            key_events += 1
+            if before_first_key_event is None:
+                before_first_key_event = i
+        elif "set_variable" in event:
+            set_variables += 1
+        else:
+            other_events += 1
+    return ToCost(
+        key_events=key_events,
+        set_variables=set_variables,
+        other_events=other_events,
+        cost=key_events * KEY_EVENT_COST
+        + set_variables * SET_VARIABLE_COST
+        + other_events * OTHER_EVENT_COST,
+        before_first_key_event=before_first_key_event,
+    )
+
+
+def _guaranteed(
+    manipulation: Manipulation,
+) -> Dict[str, Any]:
+    """Variable values the conditions require for the manipulation to fire."""
+    return {
+        condition["name"]: condition["value"]
+        for condition in manipulation.get("conditions", [])
+        if condition["type"] == "variable_if"
+    }
+
+
+def optimise_to(manipulation: Manipulation) -> List[Any]:
+    guaranteed = _guaranteed(manipulation)
+    optimised: List[Any] = []
+    run: List[Any] = []
+    leading = True
+
+    def flush() -> None:
+        last = {
+            event["set_variable"]["name"]: i
+            for i, event in enumerate(run)
+        }
+        for i, event in enumerate(run):
+            name = event["set_variable"]["name"]
+            if last[name] != i:
+                continue
+            if (
+                leading
+                and name in guaranteed
+                and guaranteed[name]
+                == event["set_variable"]["value"]
+            ):
+                continue
+            optimised.append(event)
+        run.clear()
+
+    for event in manipulation["to"]:
+        if "set_variable" in event:
+            run.append(event)
+            continue
+        flush()
+        leading = False
+        optimised.append(event)
+    flush()
+    return optimised
+
+
+def optimise(
+    modifications: List[Modification],
+) -> List[Modification]:
+    """Return copies of the modifications with optimised `to` lists.
+
+    The event dicts themselves are shared with the input, only the lists and
+    the manipulations holding them are new.
+    """
+    return [optimise_modification(m) for m in modifications]
+
+
+def optimise_modification(
+    modification: Modification,
+) -> Modification:
+    manipulators: List[Manipulation] = []
+    for manipulation in modification["manipulators"]:
+        copy = Manipulation(**manipulation)  # type: ignore
+        copy["to"] = optimise_to(manipulation)
+        manipulators.append(copy)
+    return Modification(
+        description=modification["description"],
+        manipulators=manipulators,
+    )
+
+
+def event_report(
+    before: List[Modification], after: List[Modification]
+) -> List[Tuple[str, ToCost, ToCost]]:
+    report: List[Tuple[str, ToCost, ToCost]] = []
+    for old, new in zip(before, after):
+        for old_m, new_m in zip(
+            old["manipulators"], new["manipulators"]
+        ):
+            report.append(
+                (
+                    new["description"],
+                    to_cost(old_m["to"]),
+                    to_cost(new_m["to"]),
+                )
+            )
+    return report
+
+
+def format_event_report(
+    report: List[Tuple[str, ToCost, ToCost]],
+) -> str:
+    lines = [
+        "%4s %4s %4s %6s %7s  %s"
+        % (
+            "keys",
+            "vars",
+            "drop",
+            "lead",
+            "cost",
+            "binding",
+        )
+    ]
+    total_before = total_after = 0.0
+    for description, before, after in report:
+        total_before += before["cost"]
+        total_after += after["cost"]
+        dropped = (
+            before["set_variables"] - after["set_variables"]
+        )
+        # Events sent ahead of the first key event, before -> after
+        lead = ""
+        if before["before_first_key_event"]:
+            lead = "%d->%d" % (
+                before["before_first_key_event"],
+                after["before_first_key_event"] or 0,
+            )
+        lines.append(
+            "%4d %4d %4s %6s %7.2f  %s"
+            % (
+                after["key_events"],
+                after["set_variables"],
+                dropped or "",
+                lead,
+                after["cost"],
+                description,
+            )
+        )
+    lines.append(
+        "synthetic event cost: %.2f -> %.2f"
+        % (total_before, total_after)
+    )
+    return "\n".join(lines)
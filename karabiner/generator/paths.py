@@ -0,0 +1,25 @@
+"""Locations of the repo files, independent of the working directory."""
+
+import os
+
+KARABINER_DIR = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))
+)
+REPO_DIR = os.path.dirname(KARABINER_DIR)
+
+TEMPLATE = os.path.join(KARABINER_DIR, "karabiner.jsonc")
+CONFIG = os.path.join(KARABINER_DIR, "karabiner.json")
+BACKUP = os.path.join(KARABINER_DIR, "backup.json")
+KEYMAP = os.path.join(KARABINER_DIR, "keymap.toml")
+PROFILE = os.path.join(KARABINER_DIR, "profile.bin")
+VARIANTS = os.path.join(KARABINER_DIR, "variants")
+GOLDEN = os.path.join(KARABINER_DIR, "golden")
+VSCODE = os.path.join(
+    REPO_DIR, "vscode", "keybindings.json"
+)
+INTELLIJ = os.path.join(REPO_DIR, "intellij", "keymap.xml")
+
+# Where Karabiner-Elements reads its config from
+INSTALLED = os.path.expanduser(
+    "~/.config/karabiner/karabiner.json"
+)
@@ -0,0 +1,215 @@
+"""The passes between the modification sources and the emitted config.
+
+A source is a generator of modifications, a pass takes the stream of the
+previous one and yields its own. Most passes look at one modification at a
+time and stream, so a modification is emitted before the next one is even
+built. A pass that needs the whole stream before it can yield anything says so
+with `buffers` and holds it in memory.
+
+Every pass can be left out by name, and timed in isolation on the materialised
+output of the passes before it.
+"""
+
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+import time
+
+from .catalog import check_event
+from .merge import Layer, MergeResult, merge
+from .modification_utils import Modification
+from .optimise import optimise_modification
+
+# The event lists of a manipulation, besides the delayed actions
+_TO_LISTS = ("to", "to_if_alone", "to_if_held_down")
+
+Pass = Callable[
+    [Iterable[Modification]], Iterator[Modification]
+]
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    run: Pass
+    # Needs the whole stream before it yields, so holds it in memory
+    buffers: bool = False
+
+
+@dataclass
+class Timing:
+    stage: Stage
+    seconds: float
+    modifications: int
+
+
+class Pipeline:
+    def __init__(self, stages: Sequence[Stage]):
+        self.stages = list(stages)
+
+    def without(self, names: Iterable[str]) -> "Pipeline":
+        names = set(names)
+        return Pipeline(
+            [s for s in self.stages if s.name not in names]
+        )
+
+    def __call__(
+        self, source: Iterable[Modification]
+    ) -> Iterator[Modification]:
+        stream = iter(source)
+        for stage in self.stages:
+            stream = stage.run(stream)
+        return stream
+
+    def time(
+        self, source: Iterable[Modification]
+    ) -> List[Timing]:
+        """Time every pass alone, on the materialised output of the ones before it."""
+        start = time.perf_counter()
+        modifications = list(source)
+        timings = [
+            Timing(
+                Stage("source", iter),
+                time.perf_counter() - start,
+                len(modifications),
+            )
+        ]
+        for stage in self.stages:
+            start = time.perf_counter()
+            modifications = list(stage.run(modifications))
+            timings.append(
+                Timing(
+                    stage,
+                    time.perf_counter() - start,
+                    len(modifications),
+                )
+            )
+        return timings
+
+
+def format_timings(timings: List[Timing]) -> str:
+    lines = [
+        "%-12s %10s %14s"
+        % ("pass", "time", "modifications")
+    ]
+    for timing in timings:
+        lines.append(
+            "%-12s %8.2fms %14d%s"
+            % (
+                timing.stage.name,
+                timing.seconds * 1000,
+                timing.modifications,
+                (
+                    " (buffers)"
+                    if timing.stage.buffers
+                    else ""
+                ),
+            )
+        )
+    return "\n".join(lines)
+
+
+def derive_variants(
+    descriptions: Sequence[str],
+    derive: Callable[
+        [Modification], Tuple[Modification, Modification]
+    ],
+) -> Pass:
+    """Replace every named modification by the first of derive's pair.
+
+    The second of each pair, the variant, is held back and yielded after the
+    stream ends, in the order of `descriptions`.
+    """
+
+    def run(
+        modifications: Iterable[Modification],
+    ) -> Iterator[Modification]:
+        variants: Dict[str, Modification] = {}
+        for modification in modifications:
+            description = modification["description"]
+            if description not in descriptions:
+                yield modification
+                continue
+            if description in variants:
+                raise Exception(
+                    "Duplicate modification: " + description
+                )
+            original, variants[description] = derive(
+                modification
+            )
+            yield original
+        for description in descriptions:
+            if description not in variants:
+                raise Exception(
+                    "Modification not found: " + description
+                )
+            yield variants[description]
+
+    return run
+
+
+def validate(
+    modifications: Iterable[Modification],
+) -> Iterator[Modification]:
+    """Check the events of modifications that were not built through the event constructors."""
+    for modification in modifications:
+        if not modification["manipulators"]:
+            raise Exception(
+                "No manipulators: "
+                + modification["description"]
+            )
+        for manipulation in modification["manipulators"]:
+            try:
+                check_event(manipulation["from"])  # type: ignore
+                for field in _TO_LISTS:
+                    for event in manipulation.get(field, []):  # type: ignore
+                        check_event(event)
+            except Exception as e:
+                raise Exception(
+                    "%s: %s"
+                    % (modification["description"], e)
+                )
+        yield modification
+
+
+def merge_layers(
+    name: str,
+    priority: int,
+    layers: List[Layer],
+    conflicts: Optional[
+        Callable[[MergeResult], None]
+    ] = None,
+) -> Pass:
+    """Merge the stream, as the layer `name`, with the other layers.
+
+    Which manipulator of a conflict survives depends on every layer, so this
+    pass buffers.
+    """
+
+    def run(
+        modifications: Iterable[Modification],
+    ) -> Iterator[Modification]:
+        result = merge(
+            [Layer(name, priority, list(modifications))]
+            + layers
+        )
+        if conflicts is not None:
+            conflicts(result)
+        yield from result.modifications
+
+    return run
+
+
+def optimise_stage(
+    modifications: Iterable[Modification],
+) -> Iterator[Modification]:
+    for modification in modifications:
+        yield optimise_modification(modification)
@@ -0,0 +1,388 @@
+"""A model of how Karabiner matches key events against the generated manipulators.
+
+Only the parts of Karabiner the generator emits are modelled:
+* manipulators are checked in order and the first match wins
+* `from` matches on key_code (or "any": "key_code") and mandatory/optional modifiers
+* a simultaneous chord is matched as one key press named like "j&k"
+* `variable_if`/`variable_unless` conditions
+* `to` key events and `set_variable`, and `to_delayed_action`
+* unmatched key events pass through unchanged
+
+to_if_alone and to_if_held_down depend on how long keys are held, they are
+modelled over timed traces by generator.taphold, here only `to` is sent.
+
+Events produced by a manipulator are not fed back into the manipulators.
+A `Wait` step stands for the delayed action timeout passing without key presses.
+"""
+
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+import json
+
+from .modifiers import ALL, ModifierMask, held_mask, names
+from .report import (
+    Manipulator,
+    from_key,
+    is_catch_all,
+    iter_manipulators,
+    selected_profile,
+)
+
+Variables = Tuple[Tuple[str, Any], ...]
+# Produced events are kept as hashable tuples:
+# ("key_code", key_code, sorted modifiers) or ("other", canonical json)
+ProducedEvent = Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class KeyPress:
+    key_code: str
+    modifiers: FrozenSet[str] = frozenset()
+
+    def __str__(self) -> str:
+        return "+".join(
+            sorted(self.modifiers) + [self.key_code]
+        )
+
+
+@dataclass(frozen=True)
+class Wait:
+    """The delayed action timeout passes without any key press."""
+
+    def __str__(self) -> str:
+        return "<wait>"
+
+
+Step = Union[KeyPress, Wait]
+WAIT = Wait()
+
+
+@dataclass(frozen=True)
+class State:
+    variables: Variables = ()
+    # Canonical json of the pending to_delayed_action, if any
+    pending: Optional[str] = None
+
+    def get(self, name: str) -> Any:
+        for variable, value in self.variables:
+            if variable == name:
+                return value
+        return None
+
+    def __str__(self) -> str:
+        text = ", ".join(
+            "%s=%s" % (name, value)
+            for name, value in self.variables
+        )
+        if self.pending is not None:
+            text += " (delayed action pending)"
+        return "{" + text + "}"
+
+
+def _set(
+    variables: Variables, name: str, value: Any
+) -> Variables:
+    updated = dict(variables)
+    updated[name] = value
+    return tuple(sorted(updated.items()))
+
+
+def parse_state(text: str) -> State:
+    """Parse "emacs_mode=C-x,select_mode=on" into a State."""
+    variables: Variables = ()
+    for assignment in filter(None, text.split(",")):
+        name, _, value = assignment.partition("=")
+        variables = _set(
+            variables, name.strip(), value.strip()
+        )
+    return State(variables)
+
+
+def parse_key_press(text: str) -> KeyPress:
+    """Parse "right_control+x" into a KeyPress."""
+    *modifiers, key_code = text.split("+")
+    return KeyPress(key_code, frozenset(modifiers))
+
+
+@dataclass
+class CompiledManipulator:
+    position: int
+    description: str
+    raw: Manipulator
+    key_code: Optional[str]
+    modifiers: ModifierMask
+    conditions: Tuple[Tuple[str, str, Any], ...]
+    to: Tuple[Dict[str, Any], ...]
+    delayed: Optional[str] = field(default=None)
+
+    @staticmethod
+    def compile(
+        position: int,
+        description: str,
+        manipulator: Manipulator,
+    ) -> "CompiledManipulator":
+        from_event = manipulator.get("from", {})
+        delayed = manipulator.get("to_delayed_action")
+        return CompiledManipulator(
+            position=position,
+            description=description,
+            raw=manipulator,
+            key_code=(
+                None
+                if is_catch_all(manipulator)
+                else from_key(manipulator)
+            ),
+            modifiers=ModifierMask.from_event(from_event),
+            conditions=tuple(
+                (
+                    condition["type"],
+                    condition["name"],
+                    condition["value"],
+                )
+                for condition in manipulator.get(
+                    "conditions", []
+                )
+            ),
+            to=tuple(manipulator.get("to", [])),
+            delayed=(
+                None
+                if delayed is None
+                else json.dumps(delayed, sort_keys=True)
+            ),
+        )
+
+    def matches_modifiers(
+        self, held: FrozenSet[str]
+    ) -> Optional[FrozenSet[str]]:
+        """Return the held modifiers not consumed by the mandatory ones, or None."""
+        kept = self.modifiers.consume(held_mask(held))
+        return None if kept is None else names(kept)
+
+    def matches_conditions(self, state: State) -> bool:
+        for kind, name, value in self.conditions:
+            current = state.get(name)
+            if kind == "variable_if" and current != value:
+                return False
+            if (
+                kind == "variable_unless"
+                and current == value
+            ):
+                return False
+        return True
+
+
+def _apply(
+    events: Iterable[Dict[str, Any]],
+    variables: Variables,
+    kept_modifiers: FrozenSet[str],
+    produced: List[ProducedEvent],
+) -> Variables:
+    for event in events:
+        if "set_variable" in event:
+            variables = _set(
+                variables,
+                event["set_variable"]["name"],
+                event["set_variable"]["value"],
+            )
+        elif "key_code" in event:
+            modifiers = set(event.get("modifiers", []))
+            modifiers |= kept_modifiers
+            produced.append(
+                (
+                    "key_code",
+                    event["key_code"],
+                    *sorted(modifiers),
+                )
+            )
+        else:
+            produced.append(
+                ("other", json.dumps(event, sort_keys=True))
+            )
+    return variables
+
+
+class Engine:
+    def __init__(self, config: Dict[str, Any]):
+        parameters = (
+            selected_profile(config)
+            .get("complex_modifications", {})
+            .get("parameters", {})
+        )
+        # Karabiner's default when the parameter is not set
+        self.delayed_action_delay_ms: int = parameters.get(
+            "basic.to_delayed_action_delay_milliseconds",
+            500,
+        )
+        self.manipulators = [
+            CompiledManipulator.compile(
+                position, description, manipulator
+            )
+            for position, (
+                description,
+                manipulator,
+            ) in enumerate(iter_manipulators(config))
+        ]
+        # key_code -> manipulators that can see it, in evaluation order
+        self._by_key: Dict[
+            str, List[CompiledManipulator]
+        ] = {}
+        self._catch_alls = [
+            m
+            for m in self.manipulators
+            if m.key_code is None
+        ]
+        for manipulator in self.manipulators:
+            if manipulator.key_code is not None:
+                self._by_key.setdefault(
+                    manipulator.key_code, []
+                ).append(manipulator)
+        for key_code, candidates in self._by_key.items():
+            candidates.extend(self._catch_alls)
+            candidates.sort(key=lambda m: m.position)
+
+    @staticmethod
+    def load(path: str) -> "Engine":
+        with open(path) as file:
+            return Engine(json.load(file))
+
+    def candidates(
+        self, key_code: Optional[str]
+    ) -> List[CompiledManipulator]:
+        """Manipulators that may consume the key, in evaluation order.
+
+        None stands for any key code no manipulator names, only the catch-alls
+        take those.
+        """
+        return self._by_key.get(key_code, self._catch_alls)  # type: ignore
+
+    def match(
+        self, state: State, key_press: KeyPress
+    ) -> Tuple[
+        Optional[CompiledManipulator], FrozenSet[str]
+    ]:
+        for manipulator in self.candidates(
+            key_press.key_code
+        ):
+            if not manipulator.matches_conditions(state):
+                continue
+            kept = manipulator.matches_modifiers(
+                key_press.modifiers
+            )
+            if kept is not None:
+                return manipulator, kept
+        return None, frozenset()
+
+    def step(
+        self, state: State, step: Step
+    ) -> Tuple[List[ProducedEvent], State]:
+        _, produced, state = self.resolve(state, step)
+        return produced, state
+
+    def resolve(self, state: State, step: Step) -> Tuple[
+        Optional[CompiledManipulator],
+        List[ProducedEvent],
+        State,
+    ]:
+        """Like step, also returning the manipulator that matched, if any."""
+        produced: List[ProducedEvent] = []
+        variables = state.variables
+        pending = state.pending
+
+        if isinstance(step, Wait):
+            if pending is not None:
+                delayed = json.loads(pending)
+                variables = _apply(
+                    delayed.get("to_if_invoked", []),
+                    variables,
+                    frozenset(),
+                    produced,
+                )
+            return None, produced, State(variables)
+
+        if pending is not None:
+            delayed = json.loads(pending)
+            variables = _apply(
+                delayed.get("to_if_canceled", []),
+                variables,
+                frozenset(),
+                produced,
+            )
+            state = State(variables)
+
+        manipulator, kept = self.match(state, step)
+        if manipulator is None:
+            produced.append(
+                (
+                    "key_code",
+                    step.key_code,
+                    *sorted(step.modifiers),
+                )
+            )
+            return None, produced, State(variables)
+
+        variables = _apply(
+            manipulator.to, variables, kept, produced
+        )
+        return (
+            manipulator,
+            produced,
+            State(variables, manipulator.delayed),
+        )
+
+    def run(
+        self, state: State, steps: Iterable[Step]
+    ) -> Tuple[List[List[ProducedEvent]], State]:
+        trace: List[List[ProducedEvent]] = []
+        for step in steps:
+            produced, state = self.step(state, step)
+            trace.append(produced)
+        return trace, state
+
+    def variable_domains(self) -> Dict[str, List[Any]]:
+        """Values each variable is compared against or set to, in order of appearance."""
+        domains: Dict[str, List[Any]] = {}
+
+        def add(name: str, value: Any) -> None:
+            values = domains.setdefault(name, [])
+            if value not in values:
+                values.append(value)
+
+        for manipulator in self.manipulators:
+            for _, name, value in manipulator.conditions:
+                add(name, value)
+            events = list(manipulator.to)
+            if manipulator.delayed is not None:
+                for delayed in json.loads(
+                    manipulator.delayed
+                ).values():
+                    events.extend(delayed)
+            for event in events:
+                if "set_variable" in event:
+                    add(
+                        event["set_variable"]["name"],
+                        event["set_variable"]["value"],
+                    )
+        return domains
+
+    def key_codes(self) -> List[str]:
+        return list(self._by_key)
+
+    def modifiers(self) -> List[str]:
+        """Side specific modifiers used in `from` events."""
+        bits = 0
+        for manipulator in self.manipulators:
+            modifiers = manipulator.modifiers
+            for m in modifiers.mandatory:
+                bits |= m
+            if modifiers.optional != ALL:
+                bits |= modifiers.optional
+        return sorted(names(bits))
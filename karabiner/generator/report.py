@@ -0,0 +1,259 @@
+"""Complexity metrics of a generated karabiner.json.
+
+Karabiner checks the manipulators of the selected profile in order for every key
+event and stops at the first one that matches, so the numbers here are the ones
+that drive the per-keystroke cost.
+"""
+
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypedDict,
+)
+import argparse
+import json
+import os
+
+Manipulator = Dict[str, Any]
+
+
+class KeyMetrics(TypedDict):
+    key_code: str
+    # Manipulators with this exact key_code in their `from`
+    candidates: int
+    # Catch-all manipulators that also see this key_code
+    catch_all_candidates: int
+    # Manipulators checked before the last exact candidate for this key matches
+    last_candidate_checks: int
+    # Manipulators checked before the last candidate, including catch-alls
+    worst_case_checks: int
+    descriptions: List[str]
+
+
+class Distribution(TypedDict):
+    min: int
+    max: int
+    mean: float
+    total: int
+
+
+class Report(TypedDict):
+    path: str
+    total_bytes: int
+    rules: int
+    manipulators: int
+    catch_all_manipulators: int
+    conditions_per_manipulator: Distribution
+    to_events_per_manipulator: Distribution
+    keys: List[KeyMetrics]
+
+
+def selected_profile(
+    config: Dict[str, Any],
+) -> Dict[str, Any]:
+    """The profile Karabiner evaluates, the first one if none is marked as selected."""
+    profiles = config.get("profiles", [])
+    if not profiles:
+        return {}
+    return next(
+        (p for p in profiles if p.get("selected")),
+        profiles[0],
+    )
+
+
+def iter_manipulators(
+    config: Dict[str, Any],
+) -> Iterator[Tuple[str, Manipulator]]:
+    """Yield (rule description, manipulator) in Karabiner's evaluation order."""
+    rules = (
+        selected_profile(config)
+        .get("complex_modifications", {})
+        .get("rules", [])
+    )
+    for rule in rules:
+        for manipulator in rule.get("manipulators", []):
+            yield rule.get("description", ""), manipulator
+
+
+def is_catch_all(manipulator: Manipulator) -> bool:
+    return (
+        manipulator.get("from", {}).get("any") == "key_code"
+    )
+
+
+def chord_key(keys: Iterable[str]) -> str:
+    """The name a simultaneous chord is matched under, like "j&k".
+
+    Karabiner ignores the key down order by default, so the keys are sorted.
+    """
+    return "&".join(sorted(keys))
+
+
+def from_key(manipulator: Manipulator) -> Optional[str]:
+    """The key_code, or chord name, the `from` event consumes."""
+    event = manipulator.get("from", {})
+    if "simultaneous" in event:
+        return chord_key(
+            key["key_code"] for key in event["simultaneous"]
+        )
+    return event.get("key_code")
+
+
+def _distribution(values: List[int]) -> Distribution:
+    if not values:
+        return Distribution(min=0, max=0, mean=0.0, total=0)
+    return Distribution(
+        min=min(values),
+        max=max(values),
+        mean=sum(values) / len(values),
+        total=sum(values),
+    )
+
+
+def _to_events(manipulator: Manipulator) -> int:
+    count = len(manipulator.get("to", []))
+    delayed = manipulator.get("to_delayed_action", {})
+    for events in delayed.values():
+        count += len(events)
+    return count
+
+
+def analyse(path: str) -> Report:
+    with open(path, "rb") as file:
+        raw = file.read()
+    config = json.loads(raw)
+
+    rules = set()
+    conditions: List[int] = []
+    to_events: List[int] = []
+    catch_all_positions: List[int] = []
+    by_key: Dict[str, List[int]] = {}
+    descriptions: Dict[str, List[str]] = {}
+
+    position = 0
+    for position, (description, manipulator) in enumerate(
+        iter_manipulators(config), start=1
+    ):
+        rules.add(description)
+        conditions.append(
+            len(manipulator.get("conditions", []))
+        )
+        to_events.append(_to_events(manipulator))
+        if is_catch_all(manipulator):
+            catch_all_positions.append(position)
+            continue
+        key_code = from_key(manipulator)
+        if key_code is None:
+            continue
+        by_key.setdefault(key_code, []).append(position)
+        descriptions.setdefault(key_code, []).append(
+            description
+        )
+
+    keys: List[KeyMetrics] = []
+    for key_code, positions in by_key.items():
+        all_positions = positions + catch_all_positions
+        keys.append(
+            KeyMetrics(
+                key_code=key_code,
+                candidates=len(positions),
+                catch_all_candidates=len(
+                    catch_all_positions
+                ),
+                last_candidate_checks=max(positions),
+                worst_case_checks=max(all_positions),
+                descriptions=descriptions[key_code],
+            )
+        )
+    keys.sort(
+        key=lambda k: (
+            -k["worst_case_checks"],
+            -k["last_candidate_checks"],
+            k["key_code"],
+        )
+    )
+
+    return Report(
+        path=path,
+        total_bytes=len(raw),
+        rules=len(rules),
+        manipulators=position,
+        catch_all_manipulators=len(catch_all_positions),
+        conditions_per_manipulator=_distribution(
+            conditions
+        ),
+        to_events_per_manipulator=_distribution(to_events),
+        keys=keys,
+    )
+
+
+def format_report(report: Report) -> str:
+    lines = [
+        "%s: %d bytes, %d rules, %d manipulators, %d catch-all"
+        % (
+            os.path.relpath(report["path"]),
+            report["total_bytes"],
+            report["rules"],
+            report["manipulators"],
+            report["catch_all_manipulators"],
+        )
+    ]
+    for name, field in [
+        ("conditions", "conditions_per_manipulator"),
+        ("to events", "to_events_per_manipulator"),
+    ]:
+        dist: Distribution = report[field]  # type: ignore
+        lines.append(
+            "%-10s per manipulator: min %d  mean %.2f  max %d  total %d"
+            % (
+                name,
+                dist["min"],
+                dist["mean"],
+                dist["max"],
+                dist["total"],
+            )
+        )
+    lines.append("")
+    lines.append(
+        "%-22s %10s %10s %12s %12s  %s"
+        % (
+            "key_code",
+            "candidates",
+            "catch-all",
+            "last exact",
+            "worst checks",
+            "bindings",
+        )
+    )
+    for key in report["keys"]:
+        lines.append(
+            "%-22s %10d %10d %12d %12d  %s"
+            % (
+                key["key_code"],
+                key["candidates"],
+                key["catch_all_candidates"],
+                key["last_candidate_checks"],
+                key["worst_case_checks"],
+                ", ".join(key["descriptions"]),
+            )
+        )
+    return "\n".join(lines)
+
+
+def to_json(report: Report) -> str:
+    return json.dumps(report, indent=4)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    analysis = analyse(args.path)
+    print(
+        to_json(analysis)
+        if args.json
+        else format_report(analysis)
+    )
+    return 0
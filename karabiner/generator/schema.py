@@ -0,0 +1,519 @@
+"""Structural validation of the emitted config against Karabiner's schema.
+
+The TypedDicts of modification_utils stop at the `# type: ignore` lines and the
+`**` splices, and Karabiner silently drops what it cannot parse. The subset of
+its schema this generator emits is described below as data, and compiled once
+into one check function per node kind: the allowed and required keys become
+frozensets, every field gets its own compiled check, so checking a node never
+looks at the description again.
+
+Checks raise _Invalid, which collects the path on its way up, so a valid
+config never builds a path string.
+"""
+
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
+import argparse
+import json
+import sys
+
+from .catalog import KEY_CODES, MODIFIERS, POINTING_BUTTONS
+from .modification_utils import Modification
+
+Check = Callable[[Any], None]
+
+
+@dataclass(frozen=True)
+class Type:
+    types: Tuple[type, ...]
+
+
+@dataclass(frozen=True)
+class Enum:
+    values: FrozenSet[Any]
+
+
+@dataclass(frozen=True)
+class ListOf:
+    item: "Spec"
+    min_length: int = 0
+
+
+@dataclass(frozen=True)
+class MapOf:
+    value: "Spec"
+
+
+@dataclass(frozen=True)
+class Obj:
+    fields: Dict[str, "Spec"]
+    required: FrozenSet[str] = frozenset()
+    # Exactly one of these keys must be present
+    one_of: FrozenSet[str] = frozenset()
+    # Unknown keys are allowed, for parts owned by the template
+    open: bool = False
+
+
+@dataclass(frozen=True)
+class Tagged:
+    """An object whose shape depends on the value of one key."""
+
+    key: str
+    variants: Dict[str, "Spec"] = field(
+        default_factory=dict
+    )
+
+
+Spec = Union[Type, Enum, ListOf, MapOf, Obj, Tagged]
+
+
+class _Invalid(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+        self.path: List[Union[str, int]] = []
+
+    def where(self) -> str:
+        where = ""
+        for part in self.path:
+            if isinstance(part, int):
+                where += "[%d]" % part
+            else:
+                where += ("." if where else "") + part
+        return where or "<root>"
+
+
+def _kind(value: Any) -> str:
+    return type(value).__name__
+
+
+def _compile_type(spec: Type) -> Check:
+    # type() rather than isinstance, a bool is no int here
+    types = frozenset(spec.types)
+    expected = " or ".join(t.__name__ for t in spec.types)
+
+    def check(value: Any) -> None:
+        if type(value) not in types:
+            raise _Invalid(
+                "expected %s, got %s"
+                % (expected, _kind(value))
+            )
+
+    return check
+
+
+def _compile_enum(spec: Enum) -> Check:
+    values = spec.values
+
+    def check(value: Any) -> None:
+        if value not in values:
+            raise _Invalid("unknown value %r" % (value,))
+
+    return check
+
+
+def _compile_list(spec: ListOf) -> Check:
+    item = compile_spec(spec.item)
+    min_length = spec.min_length
+
+    def check(value: Any) -> None:
+        if type(value) is not list:
+            raise _Invalid(
+                "expected list, got %s" % _kind(value)
+            )
+        if len(value) < min_length:
+            raise _Invalid(
+                "expected at least %d items" % min_length
+            )
+        for i, element in enumerate(value):
+            try:
+                item(element)
+            except _Invalid as e:
+                e.path.insert(0, i)
+                raise
+
+    return check
+
+
+def _compile_map(spec: MapOf) -> Check:
+    item = compile_spec(spec.value)
+
+    def check(value: Any) -> None:
+        if type(value) is not dict:
+            raise _Invalid(
+                "expected object, got %s" % _kind(value)
+            )
+        for key, element in value.items():
+            try:
+                item(element)
+            except _Invalid as e:
+                e.path.insert(0, key)
+                raise
+
+    return check
+
+
+def _compile_object(spec: Obj) -> Check:
+    checks = {
+        name: compile_spec(field)
+        for name, field in spec.fields.items()
+    }
+    allowed = frozenset(checks)
+    required = spec.required
+    one_of = spec.one_of
+    closed = not spec.open
+
+    def check(value: Any) -> None:
+        if type(value) is not dict:
+            raise _Invalid(
+                "expected object, got %s" % _kind(value)
+            )
+        keys = value.keys()
+        if closed and not keys <= allowed:
+            raise _Invalid(
+                "unknown keys %s"
+                % ", ".join(sorted(keys - allowed))
+            )
+        if not required <= keys:
+            raise _Invalid(
+                "missing %s"
+                % ", ".join(sorted(required - keys))
+            )
+        if one_of and len(one_of & keys) != 1:
+            raise _Invalid(
+                "expected exactly one of %s, got %s"
+                % (
+                    ", ".join(sorted(one_of)),
+                    ", ".join(sorted(one_of & keys))
+                    or "none",
+                )
+            )
+        for key, element in value.items():
+            field = checks.get(key)
+            if field is None:
+                continue
+            try:
+                field(element)
+            except _Invalid as e:
+                e.path.insert(0, key)
+                raise
+
+    return check
+
+
+def _compile_tagged(spec: Tagged) -> Check:
+    variants = {
+        tag: compile_spec(variant)
+        for tag, variant in spec.variants.items()
+    }
+    key = spec.key
+
+    def check(value: Any) -> None:
+        if type(value) is not dict:
+            raise _Invalid(
+                "expected object, got %s" % _kind(value)
+            )
+        variant = variants.get(value.get(key))
+        if variant is None:
+            raise _Invalid(
+                "unknown %s %r" % (key, value.get(key))
+            )
+        variant(value)
+
+    return check
+
+
+_COMPILERS: Dict[type, Callable[[Any], Check]] = {
+    Type: _compile_type,
+    Enum: _compile_enum,
+    ListOf: _compile_list,
+    MapOf: _compile_map,
+    Obj: _compile_object,
+    Tagged: _compile_tagged,
+}
+
+
+def compile_spec(spec: Spec) -> Check:
+    return _COMPILERS[type(spec)](spec)
+
+
+STRING = Type((str,))
+INT = Type((int,))
+BOOL = Type((bool,))
+SCALAR = Type((str, int, bool))
+ANY_OBJECT = Obj({}, open=True)
+
+KEY_CODE = Enum(KEY_CODES)
+POINTING_BUTTON = Enum(POINTING_BUTTONS)
+# "any" only matches in a from event
+FROM_MODIFIERS = ListOf(Enum(MODIFIERS))
+TO_MODIFIERS = ListOf(Enum(MODIFIERS - {"any"}))
+
+PARAMETERS = Obj(
+    {
+        "basic.simultaneous_threshold_milliseconds": INT,
+        "basic.to_delayed_action_delay_milliseconds": INT,
+        "basic.to_if_alone_timeout_milliseconds": INT,
+        "basic.to_if_held_down_threshold_milliseconds": INT,
+        "mouse_motion_to_scroll.speed": INT,
+    }
+)
+
+TO_EVENT = Obj(
+    {
+        "key_code": KEY_CODE,
+        "consumer_key_code": STRING,
+        "pointing_button": POINTING_BUTTON,
+        "shell_command": STRING,
+        "select_input_source": ANY_OBJECT,
+        "set_variable": Obj(
+            {"name": STRING, "value": SCALAR},
+            required=frozenset({"name", "value"}),
+        ),
+        "mouse_key": ANY_OBJECT,
+        "software_function": ANY_OBJECT,
+        "sticky_modifier": MapOf(
+            Enum(frozenset({"on", "off", "toggle"}))
+        ),
+        "modifiers": TO_MODIFIERS,
+        "lazy": BOOL,
+        "repeat": BOOL,
+        "halt": BOOL,
+        "hold_down_milliseconds": INT,
+    },
+    one_of=frozenset(
+        {
+            "key_code",
+            "consumer_key_code",
+            "pointing_button",
+            "shell_command",
+            "select_input_source",
+            "set_variable",
+            "mouse_key",
+            "software_function",
+            "sticky_modifier",
+        }
+    ),
+)
+TO_EVENTS = ListOf(TO_EVENT)
+
+ORDER = Enum(
+    frozenset({"insensitive", "strict", "strict_inverse"})
+)
+
+FROM_EVENT = Obj(
+    {
+        "key_code": KEY_CODE,
+        "consumer_key_code": STRING,
+        "pointing_button": POINTING_BUTTON,
+        "any": Enum(
+            frozenset(
+                {
+                    "key_code",
+                    "consumer_key_code",
+                    "pointing_button",
+                }
+            )
+        ),
+        "simultaneous": ListOf(
+            Obj(
+                {"key_code": KEY_CODE},
+                required=frozenset({"key_code"}),
+            ),
+            min_length=1,
+        ),
+        "simultaneous_options": Obj(
+            {
+                "detect_key_down_uninterruptedly": BOOL,
+                "key_down_order": ORDER,
+                "key_up_order": ORDER,
+                "key_up_when": Enum(
+                    frozenset({"any", "all"})
+                ),
+                "to_after_key_up": TO_EVENTS,
+            }
+        ),
+        "modifiers": Obj(
+            {
+                "mandatory": FROM_MODIFIERS,
+                "optional": FROM_MODIFIERS,
+            }
+        ),
+    },
+    one_of=frozenset(
+        {
+            "key_code",
+            "consumer_key_code",
+            "pointing_button",
+            "any",
+            "simultaneous",
+        }
+    ),
+)
+
+
+def _condition(
+    fields: Dict[str, Spec], *required: str
+) -> Obj:
+    return Obj(
+        dict(fields, type=STRING, description=STRING),
+        required=frozenset(("type",) + required),
+    )
+
+
+_VARIABLE = _condition(
+    {"name": STRING, "value": SCALAR}, "name", "value"
+)
+_DEVICE = _condition(
+    {
+        "identifiers": ListOf(
+            Obj(
+                {
+                    "vendor_id": INT,
+                    "product_id": INT,
+                    "location_id": INT,
+                    "is_keyboard": BOOL,
+                    "is_pointing_device": BOOL,
+                }
+            )
+        )
+    },
+    "identifiers",
+)
+_APPLICATION = _condition(
+    {
+        "bundle_identifiers": ListOf(STRING),
+        "file_paths": ListOf(STRING),
+    }
+)
+
+CONDITION = Tagged(
+    "type",
+    {
+        "variable_if": _VARIABLE,
+        "variable_unless": _VARIABLE,
+        "device_if": _DEVICE,
+        "device_unless": _DEVICE,
+        "frontmost_application_if": _APPLICATION,
+        "frontmost_application_unless": _APPLICATION,
+    },
+)
+
+MANIPULATOR = Obj(
+    {
+        "type": Enum(frozenset({"basic"})),
+        "description": STRING,
+        "from": FROM_EVENT,
+        "to": TO_EVENTS,
+        "to_if_alone": TO_EVENTS,
+        "to_if_held_down": TO_EVENTS,
+        "to_after_key_up": TO_EVENTS,
+        "to_delayed_action": Obj(
+            {
+                "to_if_invoked": TO_EVENTS,
+                "to_if_canceled": TO_EVENTS,
+            }
+        ),
+        "conditions": ListOf(CONDITION),
+        "parameters": PARAMETERS,
+    },
+    required=frozenset({"type", "from"}),
+)
+
+RULE = Obj(
+    {
+        "description": STRING,
+        "manipulators": ListOf(MANIPULATOR, min_length=1),
+    },
+    required=frozenset({"description", "manipulators"}),
+)
+
+# Only the complex modifications are generated, the rest of a profile comes
+# from the template and is Karabiner's business
+CONFIG = Obj(
+    {
+        "global": ANY_OBJECT,
+        "profiles": ListOf(
+            Obj(
+                {
+                    "name": STRING,
+                    "selected": BOOL,
+                    "complex_modifications": Obj(
+                        {
+                            "parameters": PARAMETERS,
+                            "rules": ListOf(RULE),
+                        }
+                    ),
+                },
+                required=frozenset({"name"}),
+                open=True,
+            ),
+            min_length=1,
+        ),
+    },
+    required=frozenset({"profiles"}),
+    open=True,
+)
+
+_check_rule = compile_spec(RULE)
+_check_config = compile_spec(CONFIG)
+
+
+def check_rule(modification: Modification) -> None:
+    try:
+        _check_rule(modification)
+    except _Invalid as e:
+        raise Exception(
+            "%s: %s: %s"
+            % (
+                modification.get("description"),
+                e.where(),
+                e.message,
+            )
+        )
+
+
+def check_config(config: Dict[str, Any]) -> None:
+    try:
+        _check_config(config)
+    except _Invalid as e:
+        raise Exception("%s: %s" % (e.where(), e.message))
+
+
+def check_config_file(path: str) -> None:
+    with open(path) as file:
+        try:
+            config = json.load(file)
+        except ValueError as e:
+            raise Exception("%s: not JSON: %s" % (path, e))
+    try:
+        check_config(config)
+    except Exception as e:
+        raise Exception("%s: %s" % (path, e))
+
+
+def check_schema(
+    modifications: Iterable[Modification],
+) -> Iterator[Modification]:
+    for modification in modifications:
+        check_rule(modification)
+        yield modification
+
+
+def run_command(args: argparse.Namespace) -> int:
+    try:
+        check_config_file(args.path)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
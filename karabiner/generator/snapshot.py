@@ -0,0 +1,250 @@
+"""Golden snapshots of every generated output.
+
+Every profile x device variant of the Karabiner config and the VSCode and
+IntelliJ keymaps are rendered in worker processes and brought into a
+canonical form, JSON parsed and dumped again with sorted keys, so only changes
+in content count. Each output is compared to its golden file by the hash of
+the canonical form, the hashes are kept in golden/manifest.json, so a run where
+nothing changed never reads a golden file. Only a mismatch is explained, with
+the semantic diff for Karabiner configs and a unified diff for the others.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import difflib
+import hashlib
+import io
+import json
+import os
+
+from .backends import intellij, vscode
+from .diff import diff, format_diff
+from .ir import KeymapIR
+from .variants import DEVICES, PROFILES, render
+
+MANIFEST = "manifest.json"
+# Lines of a unified diff shown per mismatch
+DIFF_LINES = 40
+
+# (output name, profile, device), the profile and device only for Karabiner
+Job = Tuple[str, Optional[str], Optional[str]]
+
+
+def jobs() -> List[Job]:
+    return [
+        ("karabiner-%s-%s.json" % (p, d), p, d)
+        for p in PROFILES
+        for d in DEVICES
+    ] + [
+        ("vscode.json", None, None),
+        ("intellij.xml", None, None),
+    ]
+
+
+def canonical(name: str, text: str) -> str:
+    if name.endswith(".json"):
+        # The VSCode header comment is no JSON
+        body = "\n".join(
+            line
+            for line in text.splitlines()
+            if not line.startswith("//")
+        )
+        return (
+            json.dumps(
+                json.loads(body),
+                sort_keys=True,
+                indent=1,
+                ensure_ascii=False,
+            )
+            + "\n"
+        )
+    return (
+        "\n".join(
+            line.rstrip() for line in text.splitlines()
+        )
+        + "\n"
+    )
+
+
+def digest(content: str) -> str:
+    return hashlib.blake2b(
+        content.encode(), digest_size=16
+    ).hexdigest()
+
+
+_ir: Optional[KeymapIR] = None
+_no_optimise = False
+
+
+def _init_worker(ir: KeymapIR, no_optimise: bool) -> None:
+    global _ir, _no_optimise
+    _ir = ir
+    _no_optimise = no_optimise
+
+
+def _render(job: Job) -> Tuple[str, str, str]:
+    """Returns (name, hash, canonical content)."""
+    assert _ir is not None
+    name, profile, device = job
+    if profile is not None and device is not None:
+        text, _ = render(
+            _ir,
+            PROFILES[profile],
+            DEVICES[device],
+            _no_optimise,
+        )
+    else:
+        out = io.StringIO()
+        (vscode if name.startswith("vscode") else intellij)(
+            _ir, out
+        )
+        text = out.getvalue()
+    content = canonical(name, text)
+    return name, digest(content), content
+
+
+def render_all(
+    ir: KeymapIR,
+    no_optimise: bool = False,
+    workers: Optional[int] = None,
+) -> Dict[str, Tuple[str, str]]:
+    """name -> (hash, canonical content) of every output."""
+    todo = jobs()
+    with ProcessPoolExecutor(
+        max_workers=workers
+        or min(len(todo), os.cpu_count() or 1),
+        initializer=_init_worker,
+        initargs=(ir, no_optimise),
+    ) as pool:
+        return {
+            name: (hash, content)
+            for name, hash, content in pool.map(
+                _render, todo
+            )
+        }
+
+
+@dataclass
+class Mismatch:
+    name: str
+    # None for an output without a golden file yet
+    explanation: Optional[str]
+
+
+def _load_manifest(golden_dir: str) -> Dict[str, str]:
+    path = os.path.join(golden_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _explain(name: str, golden: str, content: str) -> str:
+    if name.startswith("karabiner"):
+        explanation = format_diff(
+            diff(json.loads(golden), json.loads(content))
+        )
+        if explanation:
+            return explanation
+    lines = list(
+        difflib.unified_diff(
+            golden.splitlines(),
+            content.splitlines(),
+            "golden/" + name,
+            name,
+            lineterm="",
+        )
+    )
+    if len(lines) > DIFF_LINES:
+        lines = lines[:DIFF_LINES] + [
+            "... %d more lines" % (len(lines) - DIFF_LINES)
+        ]
+    return "\n".join(lines)
+
+
+def check(
+    outputs: Dict[str, Tuple[str, str]], golden_dir: str
+) -> List[Mismatch]:
+    manifest = _load_manifest(golden_dir)
+    mismatches: List[Mismatch] = []
+    for name, (hash, content) in outputs.items():
+        if manifest.get(name) == hash:
+            continue
+        path = os.path.join(golden_dir, name)
+        if name not in manifest or not os.path.exists(path):
+            mismatches.append(Mismatch(name, None))
+            continue
+        with open(path) as file:
+            golden = file.read()
+        mismatches.append(
+            Mismatch(name, _explain(name, golden, content))
+        )
+    for name in sorted(manifest.keys() - outputs.keys()):
+        mismatches.append(
+            Mismatch(name, "no longer generated")
+        )
+    return mismatches
+
+
+def update(
+    outputs: Dict[str, Tuple[str, str]], golden_dir: str
+) -> List[str]:
+    """Write the changed golden files and the manifest, returns the names written."""
+    os.makedirs(golden_dir, exist_ok=True)
+    manifest = _load_manifest(golden_dir)
+    written: List[str] = []
+    for name, (hash, content) in sorted(outputs.items()):
+        if manifest.get(name) == hash:
+            continue
+        with open(
+            os.path.join(golden_dir, name), "w"
+        ) as file:
+            file.write(content)
+        written.append(name)
+    for name in manifest.keys() - outputs.keys():
+        path = os.path.join(golden_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+    with open(
+        os.path.join(golden_dir, MANIFEST), "w"
+    ) as file:
+        json.dump(
+            {
+                name: hash
+                for name, (hash, _) in sorted(
+                    outputs.items()
+                )
+            },
+            file,
+            indent=4,
+        )
+        file.write("\n")
+    return written
+
+
+def format_mismatches(
+    mismatches: List[Mismatch], total: int, seconds: float
+) -> str:
+    if not mismatches:
+        return "%d snapshots match (%.2fs)" % (
+            total,
+            seconds,
+        )
+    lines = [
+        "%d of %d snapshots differ (%.2fs)"
+        % (len(mismatches), total, seconds)
+    ]
+    for mismatch in mismatches:
+        if mismatch.explanation is None:
+            lines.append(
+                "%s: no golden file, run with --update"
+                % mismatch.name
+            )
+        else:
+            lines.append("%s:" % mismatch.name)
+            lines.extend(
+                "    " + line
+                for line in mismatch.explanation.splitlines()
+            )
+    return "\n".join(lines)
@@ -0,0 +1,326 @@
+"""Timing model of tap/hold keys, replayed over keystroke traces.
+
+A tap/hold manipulator decides between its branches from timing alone:
+* `to` is sent on key down, for a tap/hold key a lazy modifier, so every key
+  pressed while it is held becomes a chord with it
+* to_if_alone is sent on release if no other key went down in between and the
+  key was released within basic.to_if_alone_timeout_milliseconds
+* to_if_held_down is sent once the key is held for
+  basic.to_if_held_down_threshold_milliseconds without another key going down
+
+What the typist meant is read from the same traces: a press is a hold if some
+other key went down and up again while it was held, anything else, including
+a roll where the next key goes down before this one comes up, is a tap. Every
+press where the branch Karabiner picks differs from that is a misfire. Fast
+typing misfires the hold branch through rolls, slow taps drop the tap once they
+cross the threshold.
+"""
+
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+)
+
+import argparse
+import json
+import sys
+
+from .report import iter_manipulators, selected_profile
+from .trace import TraceEvent, read_trace
+
+# Karabiner's defaults when the parameters are not set
+ALONE_TIMEOUT_MS = 1000
+HELD_DOWN_THRESHOLD_MS = 500
+
+THRESHOLDS_MS = [100, 150, 200, 250, 300, 400, 500]
+
+TAP = "tap"
+HOLD = "hold"
+# Neither branch sent anything
+DROPPED = "dropped"
+
+
+@dataclass(frozen=True)
+class DualRole:
+    key_code: str
+    # `to` sends a key event, so keys pressed while it is held are the hold
+    hold_on_interrupt: bool = True
+    held_down: bool = False
+    alone_timeout_ms: int = ALONE_TIMEOUT_MS
+    held_down_threshold_ms: int = HELD_DOWN_THRESHOLD_MS
+
+    def with_threshold(
+        self, threshold_ms: int
+    ) -> "DualRole":
+        return DualRole(
+            key_code=self.key_code,
+            hold_on_interrupt=self.hold_on_interrupt,
+            held_down=self.held_down,
+            alone_timeout_ms=threshold_ms,
+            held_down_threshold_ms=threshold_ms,
+        )
+
+    def outcome(self, press: "Press") -> str:
+        interrupted = press.interrupted_after is not None
+        if (
+            self.held_down
+            and press.duration
+            >= self.held_down_threshold_ms
+            and (
+                press.interrupted_after is None
+                or press.interrupted_after
+                >= self.held_down_threshold_ms
+            )
+        ):
+            return HOLD
+        if interrupted:
+            return (
+                HOLD if self.hold_on_interrupt else DROPPED
+            )
+        if press.duration < self.alone_timeout_ms:
+            return TAP
+        return DROPPED
+
+
+@dataclass(frozen=True)
+class Press:
+    duration: int
+    # From the key going down to the first other key going down, if any did
+    interrupted_after: Optional[int]
+    # Another key went down and up again while it was held
+    nested: bool
+
+    @property
+    def intended(self) -> str:
+        return HOLD if self.nested else TAP
+
+
+def dual_roles(config: Dict[str, Any]) -> List[DualRole]:
+    """The tap/hold manipulators of a config, with their effective timing."""
+    parameters = (
+        selected_profile(config)
+        .get("complex_modifications", {})
+        .get("parameters", {})
+    )
+    roles: List[DualRole] = []
+    for _, manipulator in iter_manipulators(config):
+        if (
+            "to_if_alone" not in manipulator
+            and "to_if_held_down" not in manipulator
+        ):
+            continue
+        key_code = manipulator.get("from", {}).get(
+            "key_code"
+        )
+        if key_code is None:
+            continue
+        timing = dict(parameters)
+        timing.update(manipulator.get("parameters", {}))
+        roles.append(
+            DualRole(
+                key_code=key_code,
+                hold_on_interrupt=any(
+                    "key_code" in e
+                    for e in manipulator.get("to", [])
+                ),
+                held_down="to_if_held_down" in manipulator,
+                alone_timeout_ms=timing.get(
+                    "basic.to_if_alone_timeout_milliseconds",
+                    ALONE_TIMEOUT_MS,
+                ),
+                held_down_threshold_ms=timing.get(
+                    "basic.to_if_held_down_threshold_milliseconds",
+                    HELD_DOWN_THRESHOLD_MS,
+                ),
+            )
+        )
+    return roles
+
+
+def collect_presses(
+    events: Iterable[TraceEvent], key_codes: Sequence[str]
+) -> Dict[str, List[Press]]:
+    """The presses of the given keys, with what happened while they were held."""
+    presses: Dict[str, List[Press]] = {
+        key_code: [] for key_code in key_codes
+    }
+    # key_code -> (down timestamp, first other key down, others down, nested)
+    open_presses: Dict[str, List[Any]] = {}
+    for event in events:
+        if event.timestamp is None:
+            raise Exception(
+                "Tap/hold timing needs a trace with timestamps"
+            )
+        for key_code, held in open_presses.items():
+            if key_code == event.key_code:
+                continue
+            if event.down:
+                if held[1] is None:
+                    held[1] = event.timestamp
+                held[2].add(event.key_code)
+            elif event.key_code in held[2]:
+                held[3] = True
+        if event.key_code not in presses:
+            continue
+        if event.down:
+            # Auto repeat sends more downs for a key already held
+            open_presses.setdefault(
+                event.key_code,
+                [event.timestamp, None, set(), False],
+            )
+            continue
+        held = open_presses.pop(event.key_code, None)
+        if held is None:
+            continue
+        down, first_other, _, nested = held
+        presses[event.key_code].append(
+            Press(
+                duration=event.timestamp - down,
+                interrupted_after=(
+                    None
+                    if first_other is None
+                    else first_other - down
+                ),
+                nested=nested,
+            )
+        )
+    return presses
+
+
+@dataclass
+class ThresholdRow:
+    threshold_ms: int
+    taps: int
+    holds: int
+    # The hold branch fired for a press meant as a tap, e.g. a roll
+    hold_misfires: int
+    # A press meant as a tap sent nothing, e.g. released after the timeout
+    dropped_taps: int
+    # A press meant as a hold did not send the hold
+    missed_holds: int
+
+
+@dataclass
+class Sweep:
+    role: DualRole
+    presses: int
+    rolls: int
+    rows: List[ThresholdRow]
+
+
+def sweep(
+    role: DualRole,
+    presses: List[Press],
+    thresholds_ms: Sequence[int] = THRESHOLDS_MS,
+) -> Sweep:
+    rows: List[ThresholdRow] = []
+    for threshold_ms in thresholds_ms:
+        timed = role.with_threshold(threshold_ms)
+        counts = {TAP: 0, HOLD: 0, DROPPED: 0}
+        hold_misfires = dropped_taps = missed_holds = 0
+        for press in presses:
+            outcome = timed.outcome(press)
+            counts[outcome] += 1
+            if press.intended == TAP:
+                if outcome == HOLD:
+                    hold_misfires += 1
+                elif outcome == DROPPED:
+                    dropped_taps += 1
+            elif outcome != HOLD:
+                missed_holds += 1
+        rows.append(
+            ThresholdRow(
+                threshold_ms=threshold_ms,
+                taps=counts[TAP],
+                holds=counts[HOLD],
+                hold_misfires=hold_misfires,
+                dropped_taps=dropped_taps,
+                missed_holds=missed_holds,
+            )
+        )
+    return Sweep(
+        role=role,
+        presses=len(presses),
+        rolls=sum(
+            p.interrupted_after is not None and not p.nested
+            for p in presses
+        ),
+        rows=rows,
+    )
+
+
+def format_sweeps(sweeps: List[Sweep]) -> str:
+    lines: List[str] = []
+    for result in sweeps:
+        role = result.role
+        lines.append(
+            "%s: %d presses, %d rolled into the next key (configured %dms alone, %dms held down)"
+            % (
+                role.key_code,
+                result.presses,
+                result.rolls,
+                role.alone_timeout_ms,
+                role.held_down_threshold_ms,
+            )
+        )
+        lines.append(
+            "  threshold   taps  holds  hold misfires  dropped taps  missed holds"
+        )
+        for row in result.rows:
+            lines.append(
+                "  %7dms %6d %6d %8d %5.1f%% %13d %13d"
+                % (
+                    row.threshold_ms,
+                    row.taps,
+                    row.holds,
+                    row.hold_misfires,
+                    100.0
+                    * row.hold_misfires
+                    / max(1, result.presses),
+                    row.dropped_taps,
+                    row.missed_holds,
+                )
+            )
+    return "\n".join(lines)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    """Sweep the thresholds for every dual role key over the traces."""
+    with open(args.config) as file:
+        roles = dual_roles(json.load(file))
+    roles += [DualRole(key) for key in args.key]
+    if not roles:
+        print(
+            "No tap/hold manipulators in %s, try --key"
+            % args.config,
+            file=sys.stderr,
+        )
+        return 1
+    key_codes = [role.key_code for role in roles]
+    presses: Dict[str, List[Press]] = {
+        key_code: [] for key_code in key_codes
+    }
+    for trace in args.traces:
+        for key_code, found in collect_presses(
+            read_trace(trace, args.format), key_codes
+        ).items():
+            presses[key_code] += found
+    thresholds = [
+        int(t) for t in args.thresholds.split(",")
+    ]
+    print(
+        format_sweeps(
+            [
+                sweep(
+                    role, presses[role.key_code], thresholds
+                )
+                for role in roles
+            ]
+        )
+    )
+    return 0
@@ -0,0 +1,438 @@
+"""Streaming keystroke trace ingestion and frequency profiles.
+
+Three input formats are understood:
+* Karabiner-EventViewer exports, a JSON array of objects like
+  {"type": "down", "name": {"key_code": "a"}, ...}
+* a simple trace with one "<timestamp ms> <down|up> <key_code>" line per event,
+  blank lines and lines starting with "#" are ignored
+* binary traces converted from either, see generator.binarytrace
+
+All are read in fixed size chunks, so memory stays constant however long the
+logs are. Key presses are folded into a Profile whose tables are stored as
+arrays of counts behind a small JSON header.
+"""
+
+from dataclasses import dataclass, field
+from typing import (
+    IO,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import argparse
+import json
+import os
+import struct
+
+from .ir import keymap_fields
+from .replay import (
+    WAIT,
+    Engine,
+    KeyPress,
+    State,
+    Step,
+    parse_state,
+)
+
+CHUNK_SIZE = 1 << 16
+# Starts every binary trace
+BINARY_MAGIC = b"KCTR"
+
+MODIFIER_KEY_CODES = frozenset(
+    {
+        "left_control",
+        "right_control",
+        "left_shift",
+        "right_shift",
+        "left_option",
+        "right_option",
+        "left_command",
+        "right_command",
+        "fn",
+    }
+)
+
+
+@dataclass(frozen=True)
+class TraceEvent:
+    # Milliseconds, None when the source has no timestamps
+    timestamp: Optional[int]
+    key_code: str
+    down: bool
+
+
+def _read_eventviewer(
+    file: IO[str],
+) -> Iterator[TraceEvent]:
+    """Decode the exported objects one at a time from a sliding buffer."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+    while True:
+        start = buffer.find("{")
+        if start == -1:
+            if eof:
+                return
+            chunk = file.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = chunk
+            continue
+        try:
+            obj, end = decoder.raw_decode(buffer, start)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = file.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[start:] + chunk
+            continue
+        buffer = buffer[end:]
+        event = _from_eventviewer(obj)
+        if event is not None:
+            yield event
+
+
+def _from_eventviewer(
+    obj: Dict[str, Any],
+) -> Optional[TraceEvent]:
+    name = obj.get("name")
+    if not isinstance(name, dict) or "key_code" not in name:
+        # Pointing buttons, consumer keys and other non key events
+        return None
+    if obj.get("type") not in ("down", "up"):
+        return None
+    timestamp = obj.get("time_stamp")
+    return TraceEvent(
+        timestamp=(
+            None if timestamp is None else int(timestamp)
+        ),
+        key_code=name["key_code"],  # type: ignore
+        down=obj["type"] == "down",
+    )
+
+
+def _read_simple(file: IO[str]) -> Iterator[TraceEvent]:
+    for number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split()
+        if len(parts) != 3 or parts[1] not in (
+            "down",
+            "up",
+        ):
+            raise Exception(
+                "%s:%d: expected '<ms> <down|up> <key_code>', got %r"
+                % (
+                    getattr(file, "name", "<trace>"),
+                    number,
+                    line,
+                )
+            )
+        yield TraceEvent(
+            timestamp=int(parts[0]),
+            key_code=parts[2],
+            down=parts[1] == "down",
+        )
+
+
+def read_trace(
+    path: str, format: str = "auto"
+) -> Iterator[TraceEvent]:
+    if format == "auto":
+        with open(path, "rb") as binary:
+            if (
+                binary.read(len(BINARY_MAGIC))
+                == BINARY_MAGIC
+            ):
+                format = "binary"
+    if format == "binary":
+        # Only binary traces need numpy
+        from .binarytrace import read_binary_trace
+
+        yield from read_binary_trace(path)
+        return
+    with open(path) as file:
+        if format == "auto":
+            head = file.read(CHUNK_SIZE).lstrip()
+            file.seek(0)
+            format = (
+                "eventviewer"
+                if head[:1] in ("[", "{")
+                else "simple"
+            )
+        if format == "eventviewer":
+            yield from _read_eventviewer(file)
+        elif format == "simple":
+            yield from _read_simple(file)
+        else:
+            raise Exception(
+                "Unknown trace format: " + format
+            )
+
+
+def key_presses(
+    events: Iterable[TraceEvent],
+) -> Iterator[Tuple[Optional[int], KeyPress]]:
+    """Turn down/up events into key presses carrying the modifiers held at the time."""
+    held: FrozenSet[str] = frozenset()
+    for event in events:
+        if event.key_code in MODIFIER_KEY_CODES:
+            if event.down:
+                held = held | {event.key_code}
+            else:
+                held = held - {event.key_code}
+            continue
+        if event.down:
+            yield event.timestamp, KeyPress(
+                event.key_code, held
+            )
+
+
+def steps(
+    events: Iterable[TraceEvent], delay_ms: int
+) -> Iterator[Step]:
+    """Key presses, with a Wait wherever the delayed action timeout passed in between."""
+    last: Optional[int] = None
+    for timestamp, key_press in key_presses(events):
+        if (
+            timestamp is not None
+            and last is not None
+            and timestamp - last >= delay_ms
+        ):
+            yield WAIT
+        last = timestamp
+        yield key_press
+
+
+def _event_key(event: Dict[str, Any]) -> str:
+    return json.dumps(event, sort_keys=True)
+
+
+class FieldIndex:
+    """Maps a fired manipulator back to the keymap field it implements."""
+
+    def __init__(self) -> None:
+        self._by_from: Dict[str, List[Tuple[str, Any]]] = {}
+        for path, consumed, produced in keymap_fields():
+            if isinstance(consumed, list):
+                # Multi key sequences, only the first key is a binding
+                consumed = consumed[0]
+                if isinstance(produced, list):
+                    produced = produced[0]
+            self._by_from.setdefault(
+                _event_key(consumed), []
+            ).append((path, produced))
+
+    def lookup(
+        self, manipulator: Dict[str, Any]
+    ) -> Optional[str]:
+        candidates = self._by_from.get(
+            _event_key(manipulator.get("from", {})), []
+        )
+        if len(candidates) <= 1:
+            return candidates[0][0] if candidates else None
+        # Several fields share the key, tell them apart by what gets produced.
+        # Select mode variants add a shift to the produced event.
+        produced = [
+            (
+                event["key_code"],
+                frozenset(event.get("modifiers", []))
+                - {"left_shift"},
+            )
+            for event in manipulator.get("to", [])
+            if "key_code" in event
+        ]
+        for path, event in candidates:
+            if event is None:
+                continue
+            key = (
+                event["key_code"],
+                frozenset(event.get("modifiers", []))
+                - {"left_shift"},
+            )
+            if key in produced:
+                return path
+        return None
+
+
+@dataclass
+class Profile:
+    # "right_control+x" -> count
+    presses: Dict[str, int] = field(default_factory=dict)
+    # "emacs_mode=C-x right_control+s" -> count
+    chords: Dict[str, int] = field(default_factory=dict)
+    # "os_level_keymap.up" -> count
+    fields: Dict[str, int] = field(default_factory=dict)
+
+    MAGIC = b"KCPF"
+    VERSION = 2
+    TABLES = ("presses", "chords", "fields")
+
+    def fold(
+        self,
+        events: Iterable[TraceEvent],
+        engine: Optional[Engine] = None,
+        prefix_variable: str = "emacs_mode",
+        initial: State = State(),
+    ) -> None:
+        """Count the key presses of a trace.
+
+        With an engine the trace is replayed to know which emacs mode each press
+        happened in and which keymap field it triggered.
+        """
+        if engine is None:
+            for _, key_press in key_presses(events):
+                key = str(key_press)
+                self.presses[key] = (
+                    self.presses.get(key, 0) + 1
+                )
+            return
+
+        index = FieldIndex()
+        state = initial
+        for step in steps(
+            events, engine.delayed_action_delay_ms
+        ):
+            if not isinstance(step, KeyPress):
+                _, state = engine.step(state, step)
+                continue
+            key = str(step)
+            self.presses[key] = self.presses.get(key, 0) + 1
+            mode = state.get(prefix_variable)
+            if mode not in (None, "none"):
+                chord = "%s=%s %s" % (
+                    prefix_variable,
+                    mode,
+                    key,
+                )
+                self.chords[chord] = (
+                    self.chords.get(chord, 0) + 1
+                )
+            manipulator, _, state = engine.resolve(
+                state, step
+            )
+            if manipulator is None:
+                continue
+            path = index.lookup(manipulator.raw)
+            if path is not None:
+                self.fields[path] = (
+                    self.fields.get(path, 0) + 1
+                )
+
+    def save(self, path: str) -> None:
+        """Header with the table keys, then one array of little endian uint64 counts per table.
+
+        Written aside and moved in place, so a failed save keeps the old profile.
+        """
+        tables = [
+            getattr(self, name) for name in self.TABLES
+        ]
+        header = json.dumps(
+            [list(table) for table in tables]
+        ).encode()
+        with open(path + ".tmp", "wb") as file:
+            file.write(self.MAGIC)
+            file.write(
+                struct.pack(
+                    "<II", self.VERSION, len(header)
+                )
+            )
+            file.write(header)
+            for table in tables:
+                file.write(
+                    struct.pack(
+                        "<%dQ" % len(table), *table.values()
+                    )
+                )
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path: str) -> "Profile":
+        with open(path, "rb") as file:
+            if file.read(4) != Profile.MAGIC:
+                raise Exception(
+                    "Not a profile file: " + path
+                )
+            version, header_size = struct.unpack(
+                "<II", file.read(8)
+            )
+            if version not in (1, Profile.VERSION):
+                raise Exception(
+                    "Unsupported profile version %d"
+                    % version
+                )
+            # Version 1 stored native uint32 counts
+            count_format = "<%dQ" if version > 1 else "=%dI"
+            keys = json.loads(file.read(header_size))
+            profile = Profile()
+            for name, table_keys in zip(
+                Profile.TABLES, keys
+            ):
+                counts_format = count_format % len(
+                    table_keys
+                )
+                counts = struct.unpack(
+                    counts_format,
+                    file.read(
+                        struct.calcsize(counts_format)
+                    ),
+                )
+                setattr(
+                    profile,
+                    name,
+                    dict(zip(table_keys, counts)),
+                )
+            return profile
+
+    def merge(self, other: "Profile") -> None:
+        for name in self.TABLES:
+            table: Dict[str, int] = getattr(self, name)
+            for key, count in getattr(other, name).items():
+                table[key] = table.get(key, 0) + count
+
+
+def format_profile(profile: Profile, top: int = 20) -> str:
+    lines: List[str] = []
+    for title, table in [
+        ("key presses", profile.presses),
+        ("emacs mode chords", profile.chords),
+        ("keymap fields", profile.fields),
+    ]:
+        total = sum(table.values())
+        lines.append("%s (%d total)" % (title, total))
+        ranked = sorted(
+            table.items(),
+            key=lambda item: (-item[1], item[0]),
+        )
+        for key, count in ranked[:top]:
+            lines.append(
+                "%8d %5.1f%%  %s"
+                % (count, 100 * count / total, key)
+            )
+        lines.append("")
+    return "\n".join(lines).rstrip()
+
+
+def run_command(args: argparse.Namespace) -> int:
+    """Fold the traces into the profile at args.out."""
+    engine = Engine.load(args.config)
+    usage = (
+        Profile.load(args.out)
+        if os.path.exists(args.out)
+        else Profile()
+    )
+    for trace in args.traces:
+        usage.fold(
+            read_trace(trace, args.format),
+            engine,
+            initial=parse_state(args.initial),
+        )
+    usage.save(args.out)
+    print(format_profile(usage, args.top))
+    return 0
@@ -0,0 +1,252 @@
+"""Build a matrix of Karabiner config variants in parallel.
+
+A variant is a profile (which rules to keep) crossed with a device (which
+keyboard the rules apply to). The keymap IR is built once in the parent and
+handed to every worker process when it starts, each worker then only filters,
+optimises and renders. Outputs are named after a hash of their content, so an
+unchanged variant keeps its filename and stale files are easy to spot.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Tuple,
+)
+import hashlib
+import io
+import json
+import os
+
+from .backends import karabiner
+from .ir import KeymapIR
+from .modification_utils import Manipulation, Modification
+from .optimise import optimise
+
+# Conditions that hold when no emacs or select mode is active
+HOME_CONDITIONS = frozenset(
+    {("emacs_mode", "none"), ("select_mode", "off")}
+)
+
+
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    # Descriptions of the rules to keep, None keeps all
+    include: Optional[FrozenSet[str]] = None
+    # Keep only single chord bindings, with the mode conditions removed, so
+    # nothing depends on the emacs or select mode variables
+    home_only: bool = False
+
+
+@dataclass(frozen=True)
+class Device:
+    name: str
+    # Karabiner device identifiers, None applies to every keyboard
+    identifiers: Optional[Tuple[Tuple[str, int], ...]] = (
+        None
+    )
+
+
+PROFILES: Dict[str, Profile] = {
+    "full": Profile("full"),
+    "pairing": Profile("pairing", home_only=True),
+    "gaming": Profile("gaming", include=frozenset()),
+}
+
+DEVICES: Dict[str, Device] = {
+    "any": Device("any"),
+    "moonlander": Device(
+        "moonlander",
+        (("vendor_id", 12951), ("product_id", 6505)),
+    ),
+    "macbook": Device(
+        "macbook",
+        (("vendor_id", 1452), ("product_id", 834)),
+    ),
+}
+
+
+def _home_only(
+    manipulation: Manipulation,
+) -> Optional[Manipulation]:
+    if "to_delayed_action" in manipulation:
+        return None
+    if any("set_variable" in e for e in manipulation["to"]):
+        return None
+    for condition in manipulation.get("conditions", []):
+        if (
+            condition["type"] != "variable_if"
+            or (condition["name"], condition["value"])
+            not in HOME_CONDITIONS
+        ):
+            return None
+    copy = Manipulation(**manipulation)  # type: ignore
+    copy.pop("conditions", None)
+    return copy
+
+
+def _for_device(
+    manipulation: Manipulation, device: Device
+) -> Manipulation:
+    if device.identifiers is None:
+        return manipulation
+    copy = Manipulation(**manipulation)  # type: ignore
+    copy["conditions"] = list(
+        manipulation.get("conditions", [])
+    ) + [
+        {  # type: ignore
+            "type": "device_if",
+            "identifiers": [dict(device.identifiers)],
+        }
+    ]
+    return copy
+
+
+def variant_modifications(
+    modifications: List[Modification],
+    profile: Profile,
+    device: Device,
+) -> List[Modification]:
+    selected: List[Modification] = []
+    for modification in modifications:
+        if (
+            profile.include is not None
+            and modification["description"]
+            not in profile.include
+        ):
+            continue
+        manipulators: List[Manipulation] = []
+        for manipulation in modification["manipulators"]:
+            kept: Optional[Manipulation] = manipulation
+            if profile.home_only:
+                kept = _home_only(manipulation)
+            if kept is not None:
+                manipulators.append(
+                    _for_device(kept, device)
+                )
+        if manipulators:
+            selected.append(
+                Modification(
+                    description=modification["description"],
+                    manipulators=manipulators,
+                )
+            )
+    return selected
+
+
+_ir: Optional[KeymapIR] = None
+
+
+def _init_worker(ir: KeymapIR) -> None:
+    global _ir
+    _ir = ir
+
+
+def render(
+    ir: KeymapIR,
+    profile: Profile,
+    device: Device,
+    no_optimise: bool = False,
+) -> Tuple[str, int]:
+    """The config of one variant, and its number of rules."""
+    modifications = variant_modifications(
+        list(ir.modifications), profile, device
+    )
+    if not no_optimise:
+        modifications = optimise(modifications)
+    out = io.StringIO()
+    karabiner(
+        KeymapIR(
+            bindings=ir.bindings,
+            modifications=tuple(modifications),
+        ),
+        out,
+    )
+    return out.getvalue(), len(modifications)
+
+
+def _build(
+    profile: Profile,
+    device: Device,
+    out_dir: str,
+    no_optimise: bool,
+) -> Tuple[str, str, int]:
+    assert _ir is not None
+    rendered, rules = render(
+        _ir, profile, device, no_optimise
+    )
+    content = rendered.encode()
+    digest = hashlib.blake2b(
+        content, digest_size=6
+    ).hexdigest()
+    filename = "karabiner-%s-%s-%s.json" % (
+        profile.name,
+        device.name,
+        digest,
+    )
+    path = os.path.join(out_dir, filename)
+    if not os.path.exists(path):
+        with open(path, "wb") as file:
+            file.write(content)
+    return (
+        "%s/%s" % (profile.name, device.name),
+        filename,
+        rules,
+    )
+
+
+def build_matrix(
+    ir: KeymapIR,
+    profiles: List[Profile],
+    devices: List[Device],
+    out_dir: str,
+    jobs: Optional[int] = None,
+    no_optimise: bool = False,
+) -> Dict[str, Tuple[str, int]]:
+    """Build every profile x device variant, returns variant -> (filename, rules).
+
+    A manifest.json mapping the variants to their files is written next to them.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    matrix = [(p, d) for p in profiles for d in devices]
+    with ProcessPoolExecutor(
+        max_workers=jobs
+        or min(len(matrix), os.cpu_count() or 1),
+        initializer=_init_worker,
+        initargs=(ir,),
+    ) as pool:
+        futures = [
+            pool.submit(_build, p, d, out_dir, no_optimise)
+            for p, d in matrix
+        ]
+        built = {
+            name: (filename, rules)
+            for name, filename, rules in (
+                f.result() for f in futures
+            )
+        }
+    with open(
+        os.path.join(out_dir, "manifest.json"), "w"
+    ) as file:
+        json.dump(
+            {
+                name: filename
+                for name, (filename, _) in built.items()
+            },
+            file,
+            indent=4,
+        )
+    return built
+
+
+def format_matrix(
+    built: Dict[str, Tuple[str, int]],
+) -> str:
+    return "\n".join(
+        "%-24s %4d rules  %s" % (name, rules, filename)
+        for name, (filename, rules) in built.items()
+    )